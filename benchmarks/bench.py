@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Benchmark dashboard and journal processing of the EDMC-Telemetry plugin.
+
+Recorded Status.json and journal streams are fed through the plugin's
+dashboard_entry() and journal_entry() hooks, which queue them for the plugin's
+publisher thread to publish to an in-process loopback broker.  For each stream, the
+per-event CPU time of the hooks and of the whole process, wall time, memory
+allocations and the MQTT packets and bytes received by the broker are measured, and
+the results are written as JSON.
+
+Run from the repository root with, for example:
+
+    python benchmarks/bench.py --count 5000 --rate 0 --output results.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR.parent))
+sys.path.insert(0, str(BENCHMARK_DIR))
+
+import stubs  # noqa: E402
+
+stubs.install()
+
+from broker import LoopbackBroker  # noqa: E402
+from settings import Settings  # noqa: E402
+
+# keep the benchmark's settings file out of the plugin folder
+Settings._FOLDER = Path(tempfile.mkdtemp(prefix="telemetry-bench-"))
+
+import load  # noqa: E402
+from serializer import Serializer  # noqa: E402
+
+Event = Dict[str, Any]
+
+
+def read_stream(path: Path) -> List[Event]:
+    """Read a stream of JSON objects, one per line (i.e. a journal file)."""
+    with open(path, mode="r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if len(line.strip())]
+
+
+def dashboard_driver(events: List[Event]) -> Callable[[int], None]:
+    """Return a function that passes the Nth recorded status update to the plugin."""
+
+    def drive(index: int) -> None:
+        load.dashboard_entry("Benchmark", False, events[index % len(events)])
+
+    return drive
+
+
+def journal_driver(events: List[Event]) -> Callable[[int], None]:
+    """Return a function that passes the Nth recorded journal entry to the plugin.
+
+    EDMC's tracking of the current system, station and state is roughly emulated so
+    that the location and state processing is exercised as well.
+    """
+    tracking: Dict[str, Any] = {"system": None, "station": None}
+    state: Dict[str, Any] = {"Credits": 0, "Cargo": {}, "Friends": set()}
+
+    def drive(index: int) -> None:
+        entry = events[index % len(events)]
+        event = entry["event"]
+        if "StarSystem" in entry:
+            tracking["system"] = entry["StarSystem"]
+        if event in ("Docked", "Location"):
+            tracking["station"] = entry.get("StationName")
+        elif event in ("Undocked", "FSDJump", "SupercruiseEntry"):
+            tracking["station"] = None
+        if "Credits" in entry:
+            state["Credits"] = entry["Credits"]
+        elif event in ("RedeemVoucher", "RefuelAll"):
+            state["Credits"] += entry.get("Amount", 0) - entry.get("Cost", 0)
+        load.journal_entry(
+            "Benchmark",
+            False,
+            tracking["system"],
+            tracking["station"],
+            entry,
+            state,
+        )
+
+    return drive
+
+
+def reset_plugin() -> None:
+    """Forget everything the plugin has published so each pass starts the same."""
+    load.this.publisher.flush()
+    load.reset_published()
+    load.this.state_tracker.reset()
+    load.this.coalescer.clear()
+
+
+def percentile(samples: List[int], fraction: float) -> float:
+    """Return the specified percentile of the samples, in microseconds."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] / 1000
+
+
+def run_pass(drive: Callable[[int], None], count: int, rate: float) -> List[int]:
+    """Call drive() count times at the specified rate (0 = unlimited).
+
+    Returns the wall time of each call, in nanoseconds.
+    """
+    samples = []
+    interval = 1.0 / rate if rate > 0 else 0.0
+    start = time.perf_counter()
+    for index in range(count):
+        if interval:
+            delay = start + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        before = time.perf_counter_ns()
+        drive(index)
+        samples.append(time.perf_counter_ns() - before)
+    return samples
+
+
+def benchmark(
+    broker: LoopbackBroker, drive: Callable[[int], None], count: int, rate: float
+) -> Dict[str, Any]:
+    """Benchmark one stream and return its results."""
+    # timing pass
+    reset_plugin()
+    broker.wait_idle()
+    broker.reset()
+    dropped = load.this.publisher.dropped
+    thread_start = time.thread_time_ns()
+    process_start = time.process_time_ns()
+    wall_start = time.perf_counter()
+    samples = run_pass(drive, count, rate)
+    thread_cpu = time.thread_time_ns() - thread_start
+    load.this.publisher.flush()
+    broker.wait_idle()
+    elapsed = time.perf_counter() - wall_start
+    process_cpu = time.process_time_ns() - process_start
+    traffic = broker.stats()
+    dropped = load.this.publisher.dropped - dropped
+
+    # allocation pass (tracemalloc slows everything down, so it is measured apart)
+    reset_plugin()
+    broker.wait_idle()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    run_pass(drive, count, rate)
+    load.this.publisher.flush()
+    broker.wait_idle()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    growth = after.compare_to(before, "filename")
+
+    return {
+        "events": count,
+        "elapsed_s": round(elapsed, 4),
+        "events_per_s": round(count / elapsed, 1),
+        "hook_cpu_us_per_event": round(thread_cpu / count / 1000, 3),
+        "process_cpu_us_per_event": round(process_cpu / count / 1000, 3),
+        "wall_us_per_event": {
+            "mean": round(statistics.fmean(samples) / 1000, 3),
+            "p50": percentile(samples, 0.50),
+            "p99": percentile(samples, 0.99),
+            "max": max(samples) / 1000,
+        },
+        "allocations": {
+            "peak_bytes": peak - baseline,
+            "retained_bytes": sum(stat.size_diff for stat in growth),
+            "retained_blocks": sum(stat.count_diff for stat in growth),
+        },
+        "dropped": dropped,
+        "traffic": traffic,
+        "publishes_per_event": round(
+            traffic["packets_by_type"].get("PUBLISH", 0) / count, 3
+        ),
+        "bytes_per_event": round(traffic["bytes"] / count, 1),
+    }
+
+
+def main(arguments: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Run the benchmarks and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--status",
+        type=Path,
+        default=BENCHMARK_DIR / "data" / "status.jsonl",
+        help="recorded Status.json updates, one per line",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        default=BENCHMARK_DIR / "data" / "journal.log",
+        help="recorded journal file",
+    )
+    parser.add_argument(
+        "--count", type=int, default=2000, help="events to send per stream"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0, help="events per second (0 = unlimited)"
+    )
+    parser.add_argument("--qos", type=int, choices=(0, 1, 2), default=0)
+    parser.add_argument(
+        "--dashboard-format",
+        choices=("Raw", "Processed", "Packed"),
+        default="Processed",
+    )
+    parser.add_argument(
+        "--journal-format", choices=("Raw", "Processed"), default="Processed"
+    )
+    parser.add_argument(
+        "--topic-aliases",
+        action="store_true",
+        help="connect using MQTT v5 with topic aliases",
+    )
+    parser.add_argument(
+        "--serializer",
+        choices=Serializer.available(),
+        help="JSON encoder to use (default: fastest available)",
+    )
+    parser.add_argument(
+        "--stream",
+        choices=("dashboard", "journal"),
+        action="append",
+        help="stream to benchmark (default: all)",
+    )
+    parser.add_argument("--output", type=Path, help="write results to this file")
+    options = parser.parse_args(arguments)
+
+    broker = LoopbackBroker(topic_alias_maximum=65535)
+    settings = load.this.settings
+    settings.broker = "127.0.0.1"
+    settings.port = broker.port
+    settings.qos = options.qos
+    settings.dashboard_format = options.dashboard_format
+    settings.journal_format = options.journal_format
+    settings.topic_aliases = options.topic_aliases
+    load.this.serializer = Serializer(options.serializer)
+    # unlimited-rate passes queue far more than the plugin normally would
+    load.this.publisher.limit = max(load.PUBLISH_QUEUE_LIMIT, options.count + 1)
+
+    load.plugin_start3(str(BENCHMARK_DIR.parent))
+    deadline = time.monotonic() + 10.0
+    while not load.this.mqtt_connected:
+        if time.monotonic() > deadline:
+            sys.exit("Unable to connect to the loopback broker.")
+        time.sleep(0.01)
+
+    drivers = {
+        "dashboard": lambda: dashboard_driver(read_stream(options.status)),
+        "journal": lambda: journal_driver(read_stream(options.journal)),
+    }
+    results = {
+        "plugin_version": load.TELEMETRY_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "count": options.count,
+            "rate": options.rate,
+            "qos": options.qos,
+            "dashboard_format": options.dashboard_format,
+            "journal_format": options.journal_format,
+            "topic_aliases": options.topic_aliases,
+            "serializer": load.this.serializer.backend,
+        },
+        "results": {
+            stream: benchmark(broker, drivers[stream](), options.count, options.rate)
+            for stream in options.stream or drivers
+        },
+    }
+
+    load.plugin_stop()
+    broker.close()
+
+    output = json.dumps(results, indent=4)
+    if options.output is not None:
+        options.output.write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
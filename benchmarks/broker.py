@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""A minimal, in-process MQTT broker stand-in for benchmarking.
+
+The broker accepts connections on the loopback interface, acknowledges everything
+it receives and counts packets and bytes, but doesn't route messages anywhere.
+"""
+
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict
+
+PACKET_NAMES = {
+    0x10: "CONNECT",
+    0x30: "PUBLISH",
+    0x40: "PUBACK",
+    0x50: "PUBREC",
+    0x60: "PUBREL",
+    0x70: "PUBCOMP",
+    0x80: "SUBSCRIBE",
+    0xA0: "UNSUBSCRIBE",
+    0xC0: "PINGREQ",
+    0xE0: "DISCONNECT",
+}
+
+
+class LoopbackBroker:
+    """Accepts MQTT clients on 127.0.0.1 and counts everything they send."""
+
+    def __init__(self, topic_alias_maximum: int = 0) -> None:
+        """Start listening on a free loopback port (see the port attribute).
+
+        MQTT v5 clients are offered the specified Topic Alias Maximum.
+        """
+        self._topic_alias_maximum = topic_alias_maximum
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(5)
+        self.port: int = self._listener.getsockname()[1]
+        self._lock = threading.Lock()
+        self._packets: Counter = Counter()
+        self._bytes = 0
+        self._payload_bytes = 0
+        self._reads = 0
+        self._last_received = 0.0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def publishes(self) -> int:
+        """Number of PUBLISH packets received since the last reset()."""
+        return self._packets["PUBLISH"]
+
+    @property
+    def last_received(self) -> float:
+        """time.perf_counter() at which anything was last received."""
+        return self._last_received
+
+    def reset(self) -> None:
+        """Reset all counters."""
+        with self._lock:
+            self._packets.clear()
+            self._bytes = self._payload_bytes = self._reads = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the counters as a dictionary."""
+        with self._lock:
+            return {
+                "packets": sum(self._packets.values()),
+                "packets_by_type": dict(self._packets),
+                "bytes": self._bytes,
+                "publish_payload_bytes": self._payload_bytes,
+                "socket_reads": self._reads,
+            }
+
+    def wait_idle(self, settle: float = 0.2, timeout: float = 10.0) -> None:
+        """Wait until nothing has been received for the specified settle time."""
+        deadline = time.monotonic() + timeout
+        last = -1
+        while time.monotonic() < deadline:
+            current = self._bytes
+            if current == last:
+                return
+            last = current
+            time.sleep(settle)
+
+    def close(self) -> None:
+        """Stop accepting connections."""
+        self._listener.close()
+
+    def _accept(self) -> None:
+        """Accept connections until the listening socket is closed."""
+        while True:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self._serve, args=(connection,), daemon=True
+            ).start()
+
+    def _serve(self, connection: socket.socket) -> None:
+        """Handle one client connection."""
+        buffer = bytearray()
+        version = 4
+        try:
+            while True:
+                data = connection.recv(65536)
+                if not len(data):
+                    return
+                buffer += data
+                with self._lock:
+                    self._reads += 1
+                    self._last_received = time.perf_counter()
+                position = 0
+                replies = bytearray()
+                while True:
+                    packet = self._parse(buffer, position)
+                    if packet is None:
+                        break
+                    header, start, end = packet
+                    size, position = end - position, end
+                    packet_type = header & 0xF0
+                    body = bytes(buffer[start:end])
+                    with self._lock:
+                        self._packets[PACKET_NAMES.get(packet_type, "UNKNOWN")] += 1
+                        self._bytes += size
+                    if packet_type == 0x10:
+                        version = body[6]
+                        if version == 5:
+                            replies += self._connack_v5()
+                        else:
+                            replies += b"\x20\x02\x00\x00"
+                    elif packet_type == 0x30:
+                        self._publish(header, body, version, replies)
+                    elif packet_type == 0x60:
+                        replies += b"\x70\x02" + body[:2]
+                    elif packet_type == 0xC0:
+                        replies += b"\xd0\x00"
+                    elif packet_type == 0xE0:
+                        return
+                del buffer[:position]
+                if len(replies):
+                    connection.sendall(replies)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def _connack_v5(self) -> bytes:
+        """Return an MQTT v5 CONNACK packet."""
+        properties = b""
+        if self._topic_alias_maximum:
+            properties = struct.pack("!BH", 0x22, self._topic_alias_maximum)
+        return bytes([0x20, 3 + len(properties), 0, 0, len(properties)]) + properties
+
+    def _publish(
+        self, header: int, body: bytes, version: int, replies: bytearray
+    ) -> None:
+        """Count the payload of a PUBLISH packet and queue its acknowledgement."""
+        qos = (header >> 1) & 0x03
+        position = 2 + struct.unpack_from("!H", body)[0]
+        mid = body[position : position + 2]
+        if qos:
+            position += 2
+        if version == 5:
+            length, position = self._varint(body, position)
+            position += length
+        with self._lock:
+            self._payload_bytes += len(body) - position
+        if qos == 1:
+            replies += b"\x40\x02" + mid
+        elif qos == 2:
+            replies += b"\x50\x02" + mid
+
+    @staticmethod
+    def _varint(buffer: Any, position: int):
+        """Decode an MQTT variable byte integer, returning (value, next position)."""
+        value = 0
+        multiplier = 1
+        while True:
+            byte = buffer[position]
+            position += 1
+            value += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                return value, position
+
+    def _parse(self, buffer: bytearray, position: int):
+        """Return (header, body start, body end) of the next complete packet or None."""
+        if len(buffer) - position < 2:
+            return None
+        try:
+            length, start = self._varint(buffer, position + 1)
+        except IndexError:
+            return None
+        if start + length > len(buffer):
+            return None
+        return buffer[position], start, start + length
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+"""Replay recorded game sessions through the EDMC-Telemetry plugin.
+
+Journal.*.log files and Status.json snapshots are merged into a single timeline by
+their timestamps and fed through the plugin's journal_entry() and dashboard_entry()
+hooks, with the current system, station and state reconstructed from the journal
+the way EDMC tracks them.  The session is played back in real time, accelerated or
+as fast as possible to an in-process loopback broker, and the throughput, hook
+latency and MQTT traffic are written as JSON.
+
+Run from the repository root with, for example:
+
+    python benchmarks/replay.py --speed 100 --output results.json path/to/journals
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bench  # noqa: F401 (installs the EDMC stand-ins before the plugin is loaded)
+import load
+from bench import percentile
+from broker import LoopbackBroker
+
+Event = Dict[str, Any]
+
+# (time, source, entry), where source is "journal" or "dashboard"
+TimelineEntry = Tuple[float, str, Event]
+
+# Journal events that add to/remove from the cargo hold, with the key of the count.
+CARGO_ADDED = {
+    "buydrones": "Count",
+    "collectcargo": None,
+    "marketbuy": "Count",
+    "miningrefined": None,
+}
+CARGO_REMOVED = {
+    "ejectcargo": "Count",
+    "launchdrone": None,
+    "marketsell": "Count",
+    "selldrones": "Count",
+}
+
+# Journal events that change the credit balance, with the key of the amount.
+CREDITS_ADDED = {
+    "marketsell": "TotalSale",
+    "missioncompleted": "Reward",
+    "redeemvoucher": "Amount",
+    "sellexplorationdata": "TotalEarnings",
+    "multisellexplorationdata": "TotalEarnings",
+}
+CREDITS_REMOVED = {
+    "buyammo": "Cost",
+    "buydrones": "TotalCost",
+    "marketbuy": "TotalCost",
+    "modulebuy": "BuyPrice",
+    "refuelall": "Cost",
+    "repair": "Cost",
+    "repairall": "Cost",
+    "restockvehicle": "Cost",
+    "shipyardbuy": "ShipPrice",
+}
+
+MATERIAL_CATEGORIES = ("Raw", "Manufactured", "Encoded")
+
+# Events fed to the plugin more than this many seconds late are counted as behind.
+LATE = 0.001
+
+
+class Tracker:
+    """Reconstructs the commander, system, station and state that EDMC would pass.
+
+    This follows EDMC's journal monitor closely enough to exercise the plugin
+    realistically (including updating container entries in place, as EDMC does),
+    but only covers the commonly seen events.
+    """
+
+    def __init__(self) -> None:
+        """Create a tracker for a new session."""
+        self.cmdr: Optional[str] = None
+        self.is_beta = False
+        self.system: Optional[str] = None
+        self.station: Optional[str] = None
+        self.state: Dict[str, Any] = {}
+        self._reset()
+
+    def _reset(self) -> None:
+        """Forget the state of the previous game session."""
+        self.state.clear()
+        self.state.update(
+            {
+                "Captain": None,
+                "Cargo": {},
+                "Credits": None,
+                "FID": None,
+                "Horizons": None,
+                "Odyssey": None,
+                "Loan": None,
+                "Raw": {},
+                "Manufactured": {},
+                "Encoded": {},
+                "Engineers": {},
+                "Rank": {},
+                "Reputation": {},
+                "Statistics": {},
+                "Friends": set(),
+                "ShipID": None,
+                "ShipIdent": None,
+                "ShipName": None,
+                "ShipType": None,
+                "HullValue": None,
+                "ModulesValue": None,
+                "Rebuy": None,
+                "Modules": None,
+                "CargoJSON": None,
+                "NavRoute": None,
+            }
+        )
+
+    def update(self, entry: Event) -> None:
+        """Update the tracked values with a journal entry."""
+        event = str(entry.get("event", "")).lower()
+        state = self.state
+
+        if event == "fileheader":
+            self.is_beta = "beta" in str(entry.get("gameversion", "")).lower()
+            self.cmdr = self.system = self.station = None
+            self._reset()
+        elif event == "commander":
+            self.cmdr = entry.get("Name")
+            state["FID"] = entry.get("FID")
+        elif event == "loadgame":
+            self.cmdr = entry.get("Commander")
+            self.station = None
+            for key in ("FID", "Credits", "Loan", "Horizons", "Odyssey"):
+                state[key] = entry.get(key)
+            self._ship(entry)
+        elif event in ("location", "carrierjump"):
+            self.system = entry.get("StarSystem")
+            self.station = entry.get("StationName") if entry.get("Docked") else None
+        elif event == "fsdjump":
+            self.system = entry.get("StarSystem")
+            self.station = None
+        elif event == "docked":
+            self.system = entry.get("StarSystem", self.system)
+            self.station = entry.get("StationName")
+        elif event in ("undocked", "died"):
+            self.station = None
+        elif event == "loadout":
+            self._ship(entry)
+            for key in ("HullValue", "ModulesValue", "Rebuy"):
+                state[key] = entry.get(key)
+            state["Modules"] = {
+                module["Slot"]: module for module in entry.get("Modules", [])
+            }
+        elif event == "cargo":
+            if entry.get("Vessel", "Ship") == "Ship":
+                state["CargoJSON"] = entry
+                if "Inventory" in entry:
+                    state["Cargo"] = {
+                        item["Name"].lower(): item["Count"]
+                        for item in entry["Inventory"]
+                    }
+        elif event == "materials":
+            for category in MATERIAL_CATEGORIES:
+                state[category] = {
+                    item["Name"].lower(): item["Count"]
+                    for item in entry.get(category, [])
+                }
+        elif event in ("materialcollected", "materialdiscarded"):
+            materials = state.get(entry.get("Category"))
+            if isinstance(materials, dict):
+                name = str(entry.get("Name", "")).lower()
+                sign = 1 if event == "materialcollected" else -1
+                materials[name] = materials.get(name, 0) + sign * entry.get("Count", 1)
+        elif event in ("rank", "progress"):
+            position = 0 if event == "rank" else 1
+            for key, value in entry.items():
+                if key not in ("timestamp", "event"):
+                    rank = list(state["Rank"].get(key, (0, 0)))
+                    rank[position] = value
+                    state["Rank"][key] = tuple(rank)
+        elif event == "reputation":
+            state["Reputation"].update(
+                (key, value)
+                for key, value in entry.items()
+                if key not in ("timestamp", "event")
+            )
+        elif event == "statistics":
+            state["Statistics"] = entry
+        elif event == "engineerprogress":
+            for engineer in entry.get("Engineers", [entry]):
+                if "Engineer" in engineer:
+                    state["Engineers"][engineer["Engineer"]] = engineer.get(
+                        "Rank", engineer.get("Progress")
+                    )
+        elif event == "friends":
+            if entry.get("Status") in ("Online", "Added"):
+                state["Friends"].add(entry.get("Name"))
+            else:
+                state["Friends"].discard(entry.get("Name"))
+        elif event == "navroute":
+            if "Route" in entry:
+                state["NavRoute"] = entry
+        elif event == "navrouteclear":
+            state["NavRoute"] = None
+
+        if event in CARGO_ADDED or event in CARGO_REMOVED:
+            self._cargo(event, entry)
+        if event in CREDITS_ADDED and state["Credits"] is not None:
+            state["Credits"] += entry.get(CREDITS_ADDED[event], 0)
+        elif event in CREDITS_REMOVED and state["Credits"] is not None:
+            state["Credits"] -= entry.get(CREDITS_REMOVED[event], 0)
+
+    def _ship(self, entry: Event) -> None:
+        """Update the current ship from a LoadGame or Loadout entry."""
+        self.state["ShipID"] = entry.get("ShipID")
+        self.state["ShipIdent"] = entry.get("ShipIdent")
+        self.state["ShipName"] = entry.get("ShipName")
+        self.state["ShipType"] = str(entry.get("Ship", "")).lower() or None
+
+    def _cargo(self, event: str, entry: Event) -> None:
+        """Add/remove cargo in place, as EDMC does between Cargo events."""
+        cargo = self.state["Cargo"]
+        name = "drones" if "drone" in event else str(entry.get("Type", "")).lower()
+        count_key = CARGO_ADDED.get(event, CARGO_REMOVED.get(event))
+        count = entry.get(count_key, 1) if count_key is not None else 1
+        if event in CARGO_ADDED:
+            cargo[name] = cargo.get(name, 0) + count
+        elif cargo.get(name, 0) > count:
+            cargo[name] -= count
+        else:
+            cargo.pop(name, None)
+
+
+def parse_time(entry: Event) -> Optional[float]:
+    """Return the timestamp of a journal or status entry in seconds, or None."""
+    try:
+        return datetime.fromisoformat(
+            str(entry["timestamp"]).replace("Z", "+00:00")
+        ).timestamp()
+    except (KeyError, ValueError):
+        return None
+
+
+def read_entries(path: Path) -> Iterator[Event]:
+    """Read the JSON objects in a file, either one per line or a single object.
+
+    Lines that can't be parsed (e.g. the partial last line of a journal that was
+    being written) are skipped.
+    """
+    text = path.read_text(encoding="utf-8", errors="replace")
+    if path.suffix.lower() == ".json":
+        try:
+            yield json.loads(text)
+        except ValueError:
+            pass
+        return
+    for line in text.splitlines():
+        if len(line.strip()):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def collect_files(paths: List[Path]) -> Tuple[List[Path], List[Path]]:
+    """Return the journal and status files in the specified files and folders.
+
+    Folders are searched for journal (*.log) and status (*.json, *.jsonl) files
+    whose names start with "journal" and "status" respectively, in any case.
+    """
+    journals: List[Path] = []
+    statuses: List[Path] = []
+    for path in paths:
+        if path.is_dir():
+            for file in sorted(path.iterdir()):
+                name = file.name.lower()
+                if name.startswith("journal") and file.suffix.lower() == ".log":
+                    journals.append(file)
+                elif name.startswith("status") and file.suffix.lower() in (
+                    ".json",
+                    ".jsonl",
+                ):
+                    statuses.append(file)
+        elif path.suffix.lower() == ".log":
+            journals.append(path)
+        else:
+            statuses.append(path)
+    return journals, statuses
+
+
+def build_timeline(journals: List[Path], statuses: List[Path]) -> List[TimelineEntry]:
+    """Merge the journal and status entries into one list in order of time.
+
+    Entries without a valid timestamp are given the time of the entry before them,
+    and status updates identical to the previous one are dropped, since EDMC only
+    calls dashboard_entry() when Status.json actually changes.
+    """
+    timeline: List[Tuple[float, int, str, Event]] = []
+    for source, paths in (("journal", journals), ("dashboard", statuses)):
+        previous_time = 0.0
+        previous_status = None
+        for path in paths:
+            for entry in read_entries(path):
+                if not isinstance(entry, dict) or "event" not in entry:
+                    continue
+                if source == "dashboard":
+                    if entry == previous_status:
+                        continue
+                    previous_status = entry
+                timestamp = parse_time(entry)
+                if timestamp is not None:
+                    previous_time = timestamp
+                timeline.append((previous_time, len(timeline), source, entry))
+    timeline.sort(key=lambda item: item[:2])
+    return [(timestamp, source, entry) for timestamp, _, source, entry in timeline]
+
+
+def latency(samples: List[int]) -> Dict[str, Any]:
+    """Summarize hook latencies (in nanoseconds), in microseconds."""
+    if not len(samples):
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "p50": percentile(samples, 0.50),
+        "p99": percentile(samples, 0.99),
+        "max": max(samples) / 1000,
+    }
+
+
+def replay(
+    timeline: List[TimelineEntry], speed: float, broker: LoopbackBroker
+) -> Dict[str, Any]:
+    """Play the timeline back at the specified speed (0 = unlimited)."""
+    tracker = Tracker()
+    samples: Dict[str, List[int]] = {"journal": [], "dashboard": []}
+    late = 0
+    max_late = 0.0
+    first = timeline[0][0] if len(timeline) else 0.0
+    broker.wait_idle()
+    broker.reset()
+    dropped = load.this.publisher.dropped
+    process_start = time.process_time_ns()
+    start = time.perf_counter()
+    for timestamp, source, entry in timeline:
+        if speed > 0:
+            due = start + (timestamp - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -LATE:
+                late += 1
+                max_late = max(max_late, -delay)
+        if source == "journal":
+            tracker.update(entry)
+            before = time.perf_counter_ns()
+            load.journal_entry(
+                tracker.cmdr,
+                tracker.is_beta,
+                tracker.system,
+                tracker.station,
+                entry,
+                tracker.state,
+            )
+        else:
+            before = time.perf_counter_ns()
+            load.dashboard_entry(tracker.cmdr, tracker.is_beta, entry)
+        samples[source].append(time.perf_counter_ns() - before)
+    played = time.perf_counter() - start
+    load.this.publisher.flush()
+    broker.wait_idle()
+    # the broker has been idle for a while by now, so time up to the last data
+    elapsed = max(played, broker.last_received - start)
+    process_cpu = time.process_time_ns() - process_start
+    traffic = broker.stats()
+    count = len(timeline)
+
+    return {
+        "events": count,
+        "session_s": round(timeline[-1][0] - first, 1) if count else 0.0,
+        "elapsed_s": round(elapsed, 4),
+        "drain_s": round(elapsed - played, 4),
+        "events_per_s": round(count / elapsed, 1) if elapsed else 0.0,
+        "process_cpu_us_per_event": (
+            round(process_cpu / count / 1000, 3) if count else 0.0
+        ),
+        "hook_us": {
+            "all": latency(samples["journal"] + samples["dashboard"]),
+            "journal": latency(samples["journal"]),
+            "dashboard": latency(samples["dashboard"]),
+        },
+        "behind_schedule": {
+            "events": late,
+            "max_ms": round(max_late * 1000, 3),
+        },
+        "dropped": load.this.publisher.dropped - dropped,
+        "traffic": traffic,
+        "bytes_per_s": round(traffic["bytes"] / elapsed, 1) if elapsed else 0.0,
+        "bytes_per_event": round(traffic["bytes"] / count, 1) if count else 0.0,
+    }
+
+
+def main(arguments: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Replay the recorded session and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "paths",
+        type=Path,
+        nargs="+",
+        help="journal folders, Journal.*.log files and Status.json snapshots "
+        "(single objects, or one per line in .jsonl files)",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="playback speed relative to real time, e.g. 1 or 100 (0 = unlimited)",
+    )
+    parser.add_argument("--qos", type=int, choices=(0, 1, 2), default=0)
+    parser.add_argument(
+        "--dashboard-format",
+        choices=("Raw", "Processed", "Packed"),
+        default="Processed",
+    )
+    parser.add_argument(
+        "--journal-format", choices=("Raw", "Processed"), default="Processed"
+    )
+    parser.add_argument(
+        "--state-format",
+        choices=("Keys", "Patch", "Full"),
+        help="also publish EDMC's state, in the specified format",
+    )
+    parser.add_argument(
+        "--topic-aliases",
+        action="store_true",
+        help="connect using MQTT v5 with topic aliases",
+    )
+    parser.add_argument("--output", type=Path, help="write results to this file")
+    options = parser.parse_args(arguments)
+
+    journals, statuses = collect_files(options.paths)
+    timeline = build_timeline(journals, statuses)
+    if not len(timeline):
+        sys.exit("No journal or status entries found.")
+
+    broker = LoopbackBroker(topic_alias_maximum=65535)
+    settings = load.this.settings
+    settings.broker = "127.0.0.1"
+    settings.port = broker.port
+    settings.qos = options.qos
+    settings.dashboard_format = options.dashboard_format
+    settings.journal_format = options.journal_format
+    settings.state = options.state_format is not None
+    if options.state_format is not None:
+        settings.state_format = options.state_format
+    settings.topic_aliases = options.topic_aliases
+    if options.speed <= 0:
+        # unlimited playback queues far more than the plugin normally would
+        load.this.publisher.limit = max(load.PUBLISH_QUEUE_LIMIT, len(timeline) + 1)
+
+    load.plugin_start3(str(bench.BENCHMARK_DIR.parent))
+    deadline = time.monotonic() + 10.0
+    while not load.this.mqtt_connected:
+        if time.monotonic() > deadline:
+            sys.exit("Unable to connect to the loopback broker.")
+        time.sleep(0.01)
+
+    results = {
+        "plugin_version": load.TELEMETRY_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "journals": [str(path) for path in journals],
+            "statuses": [str(path) for path in statuses],
+            "speed": options.speed,
+            "qos": options.qos,
+            "dashboard_format": options.dashboard_format,
+            "journal_format": options.journal_format,
+            "state_format": options.state_format,
+            "topic_aliases": options.topic_aliases,
+            "serializer": load.this.serializer.backend,
+        },
+        "results": replay(timeline, options.speed, broker),
+    }
+
+    load.plugin_stop()
+    broker.close()
+
+    output = json.dumps(results, indent=4)
+    if options.output is not None:
+        options.output.write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
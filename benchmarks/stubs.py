@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Stand-ins for the EDMC modules that the EDMC-Telemetry plugin imports.
+
+These allow load.py to be imported and driven outside of EDMC, without a display.
+install() must be called before the plugin modules are imported.
+"""
+
+import sys
+import types
+from typing import Any, Optional
+
+
+class Version:
+    """Minimal replacement for semantic_version.Version (major.minor.patch only)."""
+
+    def __init__(self, version: str) -> None:
+        """Parse a 'major.minor.patch' version string."""
+        self._parts = tuple(int(part) for part in str(version).split("."))
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Version) and self._parts == other._parts
+
+    def __lt__(self, other: "Version") -> bool:
+        return self._parts < other._parts
+
+    def __le__(self, other: "Version") -> bool:
+        return self._parts <= other._parts
+
+    def __gt__(self, other: "Version") -> bool:
+        return self._parts > other._parts
+
+    def __ge__(self, other: "Version") -> bool:
+        return self._parts >= other._parts
+
+    def __str__(self) -> str:
+        return ".".join(str(part) for part in self._parts)
+
+
+class Variable:
+    """Replacement for tkinter variables, which normally require a Tk root window."""
+
+    def __init__(self, master: Any = None, value: Any = None, name: Any = None):
+        """Create a variable holding the specified value."""
+        self._value = value
+
+    def get(self) -> Any:
+        """Return the value of the variable."""
+        return self._value
+
+    def set(self, value: Any) -> None:
+        """Set the value of the variable."""
+        self._value = value
+
+
+class Widget:
+    """Replacement for any EDMC/tkinter widget; accepts and ignores everything."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Any:
+        return lambda *args, **kwargs: None
+
+
+class Config:
+    """Replacement for EDMC's config object."""
+
+    shutting_down = False
+
+
+class Monitor:
+    """Replacement for EDMC's journal monitor."""
+
+    def __init__(self) -> None:
+        """Create a monitor that reports the game as running."""
+        self.running = True
+
+    def game_running(self) -> bool:
+        """Return True if the game is (supposedly) running."""
+        return self.running
+
+
+def _module(name: str, **attributes: Any) -> types.ModuleType:
+    """Create a module with the specified attributes and register it."""
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install(edmc_version: str = "5.9.0", monitor: Optional[Monitor] = None) -> None:
+    """Register the stand-in modules, reporting the specified EDMC version."""
+    try:
+        import tkinter
+    except ImportError:
+        tkinter = _module("tkinter", W="w", E="e", EW="ew", NSEW="nsew")
+        tkinter.HORIZONTAL = "horizontal"
+        tkinter.Label = tkinter.Frame = Widget
+        tkinter.ttk = _module("tkinter.ttk", Notebook=Widget, Separator=Widget)
+        tkinter.ttk.Style = Widget
+    tkinter.StringVar = tkinter.IntVar = tkinter.BooleanVar = Variable
+
+    try:
+        import semantic_version  # noqa: F401 (use the real one if available)
+    except ImportError:
+        _module("semantic_version", Version=Version)
+
+    version = sys.modules["semantic_version"].Version(edmc_version)
+    _module("config", appname="EDMarketConnector", appversion=lambda: version)
+    sys.modules["config"].config = Config()
+    _module("monitor", monitor=monitor if monitor is not None else Monitor())
+    _module(
+        "myNotebook",
+        Notebook=Widget,
+        Frame=Widget,
+        Label=Widget,
+        Entry=Widget,
+        Checkbutton=Widget,
+        OptionMenu=Widget,
+    )
+    _module("ttkHyperlinkLabel", HyperlinkLabel=Widget)
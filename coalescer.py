@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Code related to coalescing of outgoing messages for the EDMC-Telemetry plugin."""
+
+import threading
+from typing import Dict, Iterable, Tuple
+
+import paho.mqtt.client as mqtt_client
+from serializer import Message, Payload
+
+
+class Coalescer:
+    """Holds the latest pending payload for each topic until it can be sent.
+
+    Messages are only handed to the MQTT client when it has nothing of the same (or
+    higher) priority queued.  While the link to the broker is slow, newer payloads
+    simply replace older pending payloads for the same topic, so the backlog is
+    bounded by the number of distinct topics rather than by the rate of updates.
+    """
+
+    def __init__(
+        self, client: mqtt_client.Client, priority: int = mqtt_client.PRIORITY_NORMAL
+    ) -> None:
+        """Create an empty coalescer that publishes via the specified client."""
+        self._client = client
+        self._priority = priority
+        self._lock = threading.Lock()
+        # Pending (payload, qos, retain) by topic, in order of first update.
+        self._pending: Dict[bytes, Tuple[Payload, int, bool]] = {}
+
+    def put(self, messages: Iterable[Message]) -> None:
+        """Queue the specified messages, then send them if the client is writable."""
+        with self._lock:
+            for topic, payload, qos, retain in messages:
+                self._pending[topic] = (payload, qos, retain)
+        self.flush()
+
+    def flush(self) -> None:
+        """Send all pending messages as one batch if the client has nothing queued."""
+        with self._lock:
+            if not len(self._pending) or self._client.want_write(self._priority):
+                return
+            batch = [(topic, *message) for topic, message in self._pending.items()]
+            self._pending.clear()
+        self._client.publish_many(batch, priority=self._priority)
+
+    def clear(self) -> None:
+        """Discard all pending messages."""
+        with self._lock:
+            self._pending.clear()
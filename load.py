@@ -8,12 +8,14 @@
 # Uses the Eclipse Paho MQTT Python Client (https://github.com/eclipse/paho.mqtt.python)
 # for all MQTT protocol (http://mqtt.org/) interactions.
 
-import json
 import logging
 import os
+import threading
 import time
 import tkinter as tk
-from typing import Any, Dict, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import myNotebook as nb  # type: ignore (provided by EDMC)
 import semantic_version  # type: ignore (provided by EDMC)
@@ -21,18 +23,67 @@ from config import appname, appversion, config  # type: ignore (provided by EDMC
 from monitor import monitor  # type: ignore (provided by EDMC)
 
 import paho.mqtt.client as mqtt_client
+from coalescer import Coalescer
+from packer import DashboardPacker
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.selectorloop import SelectorLoop
+from publisher import Publisher
+from serializer import Message, Payload, Serializer
+from session import SessionStore
 from settings import Settings
+from spool import Spool
+from statetracker import StateTracker
+from targets import Target, create_targets
+from throttle import Throttle
+from topics import Topics
 
 # plugin constants
-TELEMETRY_VERSION = "0.5.0"
+TELEMETRY_VERSION = "0.6.0"
 TELEMETRY_PIPS = ("sys", "eng", "wep")
 GAME_STATE_EVENTS = ("startup", "loadgame", "shutdown")
+JOURNAL_EXCLUDED_KEYS = frozenset(("event", "timestamp"))
+DASHBOARD_KEYS = (
+    "Flags",
+    "Flags2",
+    "Pips",
+    "FireGroup",
+    "GuiFocus",
+    "Fuel",
+    "Cargo",
+    "LegalState",
+    "Latitude",
+    "Longitude",
+    "Altitude",
+    "Heading",
+    "BodyName",
+    "PlanetRadius",
+    "Balance",
+    "Destination",
+    "Oxygen",
+    "Health",
+    "Temperature",
+    "SelectedWeapon",
+    "Gravity",
+)
+FUEL_TANKS = ("FuelMain", "FuelReservoir")
+SPOOL_REPLAY_INTERVAL = 0.1  # seconds
+TOPIC_ALIAS_MAXIMUM = 128
+PUBLISH_QUEUE_LIMIT = 1000  # entries
+DISCONNECT_TIMEOUT = 5.0  # seconds
+SESSION_EXPIRY_INTERVAL = 7 * 24 * 60 * 60  # seconds, MQTT v5 only
 
 
 # set up logging
 logger = logging.getLogger(f"{appname}.{os.path.basename(os.path.dirname(__file__))}")
 
 
+class Batch(threading.local):
+    """Messages being collected by publish_batch() on the current thread."""
+
+    messages: Optional[List[Message]] = None
+
+
 # Globals
 class Globals:
     """Holds module globals."""
@@ -44,11 +95,32 @@ class Globals:
         self.status_color: str = "grey"
         self.modifying_preferences = False
         self.mqtt_connected: bool = False
+        self.mqtt_disconnected = threading.Event()
         self.current_db = {}
         self.current_location = {"system": "N/A", "station": "N/A"}
-        self.current_state = {}
+        # latest (payload, retain) of each dashboard and location topic, which is
+        # published again on connect
+        self.snapshot: Dict[bytes, Tuple[Payload, bool]] = {}
+        self.batch = Batch()
         self.settings = Settings(TELEMETRY_VERSION, logger)
+        self.topics = Topics(self.settings)
         self.mqtt = mqtt_client.Client()
+        # cockpit indicators are the most latency-sensitive telemetry
+        self.coalescer = Coalescer(self.mqtt, mqtt_client.PRIORITY_HIGH)
+        self.packer = DashboardPacker()
+        self.serializer = Serializer()
+        self.state_tracker = StateTracker(self.serializer)
+        self.packed_schema_sent = False
+        self.spool = Spool(Path(__file__).parent / "spool", self.settings, logger)
+        self.spool_replaying = False
+        self.spool_inflight: List[mqtt_client.MQTTMessageInfo] = []
+        self.session = SessionStore(Path(__file__).parent / "session.bin", logger)
+        self.targets: List[Target] = []
+        # network loop shared by the additional brokers' clients
+        self.targets_loop = SelectorLoop()
+        self.publisher = Publisher(logger, PUBLISH_QUEUE_LIMIT)
+        self.throttle = Throttle(self.settings.throttles, logger)
+        self.throttle_release: Optional[float] = None
 
 
 this = Globals()
@@ -58,7 +130,10 @@ this = Globals()
 def plugin_start3(plugin_dir: str) -> str:
     """Start the telemetry plugin."""
     if callable(appversion) and appversion() >= semantic_version.Version("5.0.0"):
-        connect_telemetry()
+        precompile_topics()
+        this.spool.open()
+        this.publisher.start()
+        this.publisher.put(connect_telemetry, force=True)
     else:
         logger.fatal("EDMC-Telemetry requires EDMC 5.0.0 or newer.")
         status_message(message="ERROR: EDMC < 5.0.0", color="red", immediate=True)
@@ -67,7 +142,10 @@ def plugin_start3(plugin_dir: str) -> str:
 
 def plugin_stop() -> None:
     """Stop the telemetry plugin."""
-    disconnect_telemetry()
+    # the publisher finishes the work already queued before it disconnects
+    this.publisher.put(disconnect_telemetry, force=True)
+    this.publisher.stop(DISCONNECT_TIMEOUT + 1.0)
+    this.spool.close()
 
 
 def plugin_app(parent: tk.Frame) -> Tuple[tk.Label, tk.Label]:
@@ -87,15 +165,32 @@ def plugin_prefs(parent: nb.Notebook, cmdr: str, is_beta: bool) -> Optional[tk.F
 
 def prefs_changed(cmdr: str, is_beta: bool) -> None:
     """Update settings after they've been modified in UI."""
+    published = published_settings()
     # update_preferences() returns True if a connection reset is required
-    if this.settings.update_preferences():
+    reset_connection = this.settings.update_preferences()
+    if this.settings.topics_modified:
+        this.topics.invalidate()
+        precompile_topics()
+    if this.settings.topics_modified or published_settings() != published:
+        # the latest values were published to other topics, or in another format
+        this.publisher.put(reset_published, force=True)
+    if reset_connection:
         logger.info("MQTT broker settings modified, connection will now restart.")
-        disconnect_telemetry()
-        connect_telemetry()
+        this.publisher.put(reconnect_telemetry, force=True)
     this.modifying_preferences = False
     status_message(immediate=True)
 
 
+def published_settings() -> Tuple[Any, ...]:
+    """Return the settings that determine which dashboard and location topics exist."""
+    return (
+        this.settings.dashboard,
+        this.settings.dashboard_format,
+        this.settings.location,
+        this.settings.retain_latest,
+    )
+
+
 def status_message(message: str = "", color: str = "", immediate=False) -> None:
     """Update the status message and color to be displayed on the main UI."""
     if len(message):
@@ -120,20 +215,111 @@ def _update_status(event=None) -> None:
         this.status["foreground"] = this.status_color
 
 
-def publish(topic: str, payload: str, retain: bool = False):
-    """Publish the specified payload to the specified MQTT topic."""
-    topic = f"{this.settings.topic('root')}/{topic}"
-    if this.settings.lowercase_topics:
-        topic = topic.lower()
-    this.mqtt.publish(topic, payload=payload, qos=this.settings.qos, retain=retain)
+def precompile_topics() -> None:
+    """Build the topics for all known dashboard and location data ahead of time."""
+    topics = [("feedactive",), ("gamerunning",), ("journal",), ("state",)]
+    topics += [("location", "system"), ("location", "station"), ("dashboard",)]
+    topics += [("dashboard", "packed"), ("dashboard", "packed", "schema")]
+    topics += [("dashboard", key) for key in DASHBOARD_KEYS]
+    topics += [("dashboard", "Pips", pip) for pip in TELEMETRY_PIPS]
+    topics += [("dashboard", "Fuel", tank) for tank in FUEL_TANKS]
+    topics += [("dashboard", "Flags", name) for name in FLAGS_MAP.values()]
+    topics += [("dashboard", "Flags2", name) for name in FLAGS2_MAP.values()]
+    this.topics.precompile(topics)
+
+
+def publish(topic: bytes, payload: Payload, retain: bool = False):
+    """Publish the specified payload to the specified (resolved) MQTT topic."""
+    if this.batch.messages is not None:
+        this.batch.messages.append((topic, payload, this.settings.qos, retain))
+    else:
+        this.mqtt.publish(topic, payload=payload, qos=this.settings.qos, retain=retain)
+
+
+@contextmanager
+def publish_batch(
+    coalesce: bool = False,
+    spool: bool = False,
+    priority: int = mqtt_client.PRIORITY_NORMAL,
+    snapshot: bool = False,
+) -> Iterator[None]:
+    """Collect everything published within the context and send it as one batch.
+
+    If coalesce is True, the batch is passed through the throttle and the coalescer
+    so that only the latest value for each topic is sent when the topic is throttled
+    or the broker link can't keep up.  If spool
+    is True, the batch is written to the spool while offline, and also while older
+    spooled messages are still being replayed so that message order is preserved.
+    If snapshot is True, the payloads are kept as the latest values of their topics,
+    and are published as retained messages if the settings say so.
+
+    The batch is always handed to the additional brokers, which keep track of their
+    own connections; it is only published to the main broker while connected to it.
+    """
+    this.batch.messages = []
+    try:
+        yield
+    finally:
+        batch, this.batch.messages = this.batch.messages, None
+        if snapshot:
+            if this.settings.retain_latest:
+                batch = [
+                    (topic, payload, qos, True) for topic, payload, qos, _ in batch
+                ]
+            for topic, payload, _, retain in batch:
+                this.snapshot[topic] = (payload, retain)
+        if coalesce:
+            if this.throttle.active:
+                batch = this.throttle.filter(batch, time.monotonic())
+                schedule_throttle_release()
+            if this.mqtt_connected:
+                this.coalescer.put(batch)
+        elif len(batch):
+            spooled = spool and this.spool.append(batch, this.mqtt_connected)
+            if not spooled and this.mqtt_connected:
+                this.mqtt.publish_many(batch, priority=priority)
+        for target in this.targets:
+            target.put(batch)
+
+
+def schedule_throttle_release() -> None:
+    """Arrange for held back (throttled) messages to be sent once they are due."""
+    due = this.throttle.next_release
+    if due is not None and (
+        this.throttle_release is None or due < this.throttle_release
+    ):
+        this.throttle_release = due
+        this.publisher.call_at(due, release_throttled)
+
+
+def release_throttled() -> None:
+    """Send the held back messages that are due (runs on the publisher thread)."""
+    this.throttle_release = None
+    released = this.throttle.release(time.monotonic())
+    if this.mqtt_connected:
+        this.coalescer.put(released)
+    for target in this.targets:
+        target.put(released)
+    schedule_throttle_release()
 
 
 # --- New helper function for Flags/Flags2 ---
-def publish_flags(base_topic: str, value: int, flag_map: Dict[int, str]):
-    """Publish individual bits as separate MQTT topics."""
-    for bit, name in flag_map.items():
+def publish_flags(
+    key: str, value: int, previous: Optional[int], flag_map: Dict[int, str]
+):
+    """Publish individual bits as separate MQTT topics.
+
+    Only the bits that differ from the previously published value are sent; every
+    bit is published if there is no previous value (i.e. after a new connection).
+    """
+    if previous is None:
+        changed = [bit for bit in flag_map]
+    else:
+        diff = value ^ previous
+        changed = [bit for bit in flag_map if diff & bit]
+    for bit in changed:
         bit_set = 1 if (value & bit) else 0
-        publish(f"{base_topic}/{name}", str(bit_set))
+        publish(this.topics.resolve("dashboard", key, flag_map[bit]), str(bit_set))
 
 
 # Flag mappings
@@ -201,13 +387,32 @@ def dashboard_entry(cmdr: str, is_beta: bool, entry: Dict[str, Any]) -> None:
     if not this.settings.dashboard:
         return
 
-    if not this.mqtt_connected:
-        return
+    this.publisher.put(publish_dashboard, entry)
+
 
-    dashboard_topic = this.settings.topic("dashboard")
+def publish_dashboard(entry: Dict[str, Any]) -> None:
+    """Publish a dashboard status update (runs on the publisher thread)."""
+    with publish_batch(coalesce=True, snapshot=True):
+        process_dashboard(entry)
 
+
+def process_dashboard(entry: Dict[str, Any]) -> None:
+    """Publish the contents of a dashboard status update."""
     if this.settings.dashboard_format == "Raw":
-        publish(dashboard_topic, payload=json.dumps(entry))
+        publish(this.topics.resolve("dashboard"), payload=this.serializer.dumps(entry))
+    elif this.settings.dashboard_format == "Packed":
+        # consumers need the (retained) schema descriptor to decode the records
+        if not this.packed_schema_sent:
+            publish(
+                this.topics.resolve("dashboard", "packed", "schema"),
+                payload=this.packer.schema(),
+                retain=True,
+            )
+            this.packed_schema_sent = True
+        record = this.packer.pack(entry)
+        if this.current_db.get("Packed") != record:
+            publish(this.topics.resolve("dashboard", "packed"), payload=record)
+            this.current_db["Packed"] = record
     else:
         for key in entry:
             # always ignore these keys
@@ -216,13 +421,11 @@ def dashboard_entry(cmdr: str, is_beta: bool, entry: Dict[str, Any]) -> None:
 
             # publish any updated dashboard data
             if key not in this.current_db or this.current_db[key] != entry[key]:
-                topic = f"{dashboard_topic}/{this.settings.topic(key)}"
-
                 # additional processing for pip updates
                 if key.lower() == "pips":
                     for i, pips in enumerate(entry[key]):
                         publish(
-                            f"{topic}/{this.settings.topic(TELEMETRY_PIPS[i])}",
+                            this.topics.resolve("dashboard", key, TELEMETRY_PIPS[i]),
                             payload=str(pips),
                         )
 
@@ -230,20 +433,22 @@ def dashboard_entry(cmdr: str, is_beta: bool, entry: Dict[str, Any]) -> None:
                 elif key.lower() == "fuel":
                     for tank in entry[key]:
                         publish(
-                            f"{topic}/{this.settings.topic(tank)}",
+                            this.topics.resolve("dashboard", key, tank),
                             payload=str(entry[key][tank]),
                         )
 
                 # additional processing for Flags
                 elif key.lower() == "flags":
-                    publish_flags(topic, entry[key], FLAGS_MAP)
+                    publish_flags(key, entry[key], this.current_db.get(key), FLAGS_MAP)
 
                 elif key.lower() == "flags2":
-                    publish_flags(topic, entry[key], FLAGS2_MAP)
+                    publish_flags(key, entry[key], this.current_db.get(key), FLAGS2_MAP)
 
                 # standard processing for most status updates
                 else:
-                    publish(topic, payload=str(entry[key]))
+                    publish(
+                        this.topics.resolve("dashboard", key), payload=str(entry[key])
+                    )
 
                 # update internal tracking variable (used to filter unnecessary updates)
                 this.current_db[key] = entry[key]
@@ -258,63 +463,234 @@ def journal_entry(
     state: Dict[str, Any],
 ) -> None:
     """Process player journal entries."""
-    if not this.mqtt_connected:
-        return
+    # EDMC keeps modifying its state in place on the main thread, so it is diffed here
+    # and only the (immutable) serialized changes are handed to the publisher thread
+    state_messages = []
+    if this.settings.state:
+        changed, removed = this.state_tracker.update(state, str(entry["event"]).lower())
+        if len(changed) or len(removed):
+            state_messages = encode_state(state, changed, removed)
 
+    if not this.publisher.put(publish_journal, system, station, entry, state_messages):
+        # the publisher is backed up and dropped the changes, so report them again
+        # with the next journal entry rather than losing them for good
+        if this.settings.state:
+            this.state_tracker.revert()
+
+
+def publish_journal(
+    system: str,
+    station: str,
+    entry: Dict[str, Any],
+    state_messages: List[Tuple[bytes, Payload]],
+) -> None:
+    """Publish a journal entry (runs on the publisher thread)."""
     if this.settings.location:
-        if this.current_location["system"] != system:
-            publish(
-                f"{this.settings.topic('location')}/{this.settings.topic('system')}",
-                payload="" if system is None else system,
-            )
-            this.current_location["system"] = system
+        # the latest location is published on connect, so it isn't spooled
+        with publish_batch(snapshot=True):
+            process_location(system, station)
+
+    # while the spool is being replayed, new messages are queued behind it even if
+    # spooling is disabled, so that they aren't published ahead of older ones
+    spool = this.settings.spool or this.spool_replaying
+    with publish_batch(spool=spool):
+        process_journal(entry)
+
+    # state updates can be large, so they are queued behind everything else
+    if len(state_messages):
+        with publish_batch(spool=spool, priority=mqtt_client.PRIORITY_LOW):
+            for topic, payload in state_messages:
+                publish(topic, payload=payload)
+
+
+def process_location(system: str, station: str) -> None:
+    """Publish the current system and station if they have changed."""
+    if this.current_location["system"] != system:
+        publish(
+            this.topics.resolve("location", "system"),
+            payload="" if system is None else system,
+        )
+        this.current_location["system"] = system
 
-        if this.current_location["station"] != station:
-            publish(
-                f"{this.settings.topic('location')}/{this.settings.topic('station')}",
-                payload="" if station is None else station,
-            )
-            this.current_location["station"] = station
+    if this.current_location["station"] != station:
+        publish(
+            this.topics.resolve("location", "station"),
+            payload="" if station is None else station,
+        )
+        this.current_location["station"] = station
 
-    if this.settings.state:
-        if this.current_state != state:
-            new_state = state.copy()
-            if "Friends" in new_state and isinstance(new_state["Friends"], set):
-                new_state["Friends"] = list(new_state["Friends"])
-            publish(this.settings.topic("state"), payload=json.dumps(new_state))
-            this.current_state = state.copy()
 
+def process_journal(entry: Dict[str, Any]) -> None:
+    """Publish game and journal data associated with a journal entry."""
     if str(entry["event"]).lower() in GAME_STATE_EVENTS:
         publish(
-            topic=this.settings.topic("gamerunning"),
+            topic=this.topics.resolve("gamerunning"),
             payload=str(monitor.game_running()),
         )
 
     if not this.settings.journal:
         return
 
-    topic = this.settings.topic("journal")
-
     if this.settings.journal_format == "Raw":
-        data = entry
+        topic = this.topics.resolve("journal")
+        payload = this.serializer.dumps(entry)
     else:
-        topic = f"{topic}/{this.settings.topic(entry['event'])}"
-        data = entry.copy()
-        del data["event"]
-        del data["timestamp"]
+        topic = this.topics.resolve("journal", entry["event"])
+        # leave out the event (already named by the topic) and the timestamp
+        payload = this.serializer.dumps(
+            {
+                key: value
+                for key, value in entry.items()
+                if key not in JOURNAL_EXCLUDED_KEYS
+            }
+        )
+
+    publish(topic, payload=payload)
+
+
+def publish_snapshot() -> None:
+    """Publish the latest value of every dashboard and location topic as one batch.
+
+    Runs on the publisher thread after connecting, so that subscribers get the full
+    current state straight away instead of waiting for the game to update it.
+    """
+    if not len(this.snapshot):
+        return
+    qos = this.settings.qos
+    this.mqtt.publish_many(
+        [
+            (topic, payload, qos, retain)
+            for topic, (payload, retain) in this.snapshot.items()
+        ],
+        priority=mqtt_client.PRIORITY_HIGH,
+    )
+
 
-    publish(topic, payload=json.dumps(data))
+def reset_published() -> None:
+    """Forget the latest values, so that everything is published again on update.
+
+    Runs on the publisher thread, after the topics have changed.
+    """
+    this.snapshot.clear()
+    this.current_db = {}
+    this.current_location = {"system": "N/A", "station": "N/A"}
+    this.packed_schema_sent = False
+
+
+def start_spool_replay() -> None:
+    """Start replaying spooled telemetry (runs on the publisher thread).
+
+    Called after connecting; spooled messages that were read, but not delivered,
+    before the connection was lost are replayed again.
+    """
+    if not confirm_spool_replay():
+        this.spool.rewind()
+        this.spool_inflight = []
+    if this.mqtt_connected and not this.spool_replaying and this.spool.pending:
+        logger.info("Replaying spooled telemetry")
+        this.spool_replaying = True
+        replay_spool()
+
+
+def confirm_spool_replay() -> bool:
+    """Remove the replayed messages from the spool if they have all been delivered.
+
+    QoS 0 messages count as delivered once they have been written to the socket, QoS 1
+    and 2 messages once the broker has acknowledged them.
+    """
+    for info in this.spool_inflight:
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS or not info.is_published():
+            return False
+    this.spool_inflight = []
+    this.spool.acknowledge()
+    this.spool.compact()
+    return True
+
+
+def replay_spool() -> None:
+    """Publish the next spooled messages (runs on the publisher thread).
+
+    Reschedules itself at the configured rate until the spool is empty or the
+    connection is lost.  Messages are published in the same lane as live journal
+    messages, which are spooled behind them until the replay has finished.
+    """
+    if not this.mqtt_connected:
+        this.spool_replaying = False
+        return
+
+    # let the client catch up if the broker link is slower than the replay rate
+    if confirm_spool_replay() and not this.mqtt.want_write():
+        count = max(1, int(this.settings.spool_rate * SPOOL_REPLAY_INTERVAL))
+        messages = this.spool.read(count)
+        if not len(messages):
+            logger.info("Finished replaying spooled telemetry")
+            this.spool_replaying = False
+            return
+        this.spool_inflight = this.mqtt.publish_many(
+            messages, priority=mqtt_client.PRIORITY_NORMAL
+        )
+
+    this.publisher.call_at(time.monotonic() + SPOOL_REPLAY_INTERVAL, replay_spool)
+
+
+def encode_state(
+    state: Dict[str, Any], changed: Dict[str, Payload], removed: List[str]
+) -> List[Tuple[bytes, Payload]]:
+    """Return the (topic, payload) messages for changes to EDMC's state."""
+    if this.settings.state_format == "Full":
+        # sets (i.e. Friends) are converted to lists by the serializer
+        return [(this.topics.resolve("state"), this.serializer.dumps(state))]
+    elif this.settings.state_format == "Patch":
+        # JSON Merge Patch (RFC 7386) of the top-level entries
+        patch = {key: state[key] for key in changed}
+        patch.update({key: None for key in removed})
+        return [(this.topics.resolve("state"), this.serializer.dumps(patch))]
+    else:
+        messages = [
+            (this.topics.resolve("state", key), payload)
+            for key, payload in changed.items()
+        ]
+        messages += [(this.topics.resolve("state", key), "") for key in removed]
+        return messages
 
 
 def connect_telemetry() -> None:
-    """Establish a connection with the MQTT broker."""
+    """Establish connections with the MQTT broker(s) (runs on the publisher thread).
+
+    The connections themselves are made, and re-established if they are lost, by the
+    MQTT clients' network threads.
+    """
     status_message(message="Connecting", color="steel blue")
-    this.mqtt.reinitialise(client_id=this.settings.client_id)
+    persistent = this.settings.persistent_session
+    if persistent and not len(this.settings.client_id):
+        logger.warning("A persistent session requires a Client ID.")
+        persistent = False
+    clean_start = mqtt_client.MQTT_CLEAN_START_FIRST_ONLY
+    properties = None
+    if this.settings.topic_aliases:
+        this.mqtt.reinitialise(
+            client_id=this.settings.client_id, protocol=mqtt_client.MQTTv5
+        )
+        this.mqtt.topic_alias_maximum_set(TOPIC_ALIAS_MAXIMUM)
+        if persistent:
+            clean_start = False
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = SESSION_EXPIRY_INTERVAL
+    else:
+        this.mqtt.reinitialise(
+            client_id=this.settings.client_id, clean_session=not persistent
+        )
+    if persistent:
+        this.session.open()
+        this.mqtt.session_store_set(this.session)
+    else:
+        this.session.clear()
     this.mqtt.on_connect = mqttCallback_on_connect
     this.mqtt.on_disconnect = mqttCallback_on_disconnect
+    this.mqtt.on_priority_drained = mqttCallback_on_priority_drained
     this.mqtt.username_pw_set(this.settings.username, this.settings.password)
     this.mqtt.will_set(
-        topic=f"{this.settings.topic('root')}/{this.settings.topic('feedactive')}",
+        topic=this.topics.resolve("feedactive"),
         payload="False",
         qos=0,
         retain=True,
@@ -339,6 +715,8 @@ def connect_telemetry() -> None:
             this.settings.broker,
             this.settings.port,
             this.settings.keepalive,
+            clean_start=clean_start,
+            properties=properties,
         )
         this.mqtt.loop_start()
 
@@ -346,42 +724,95 @@ def connect_telemetry() -> None:
         status_message(message="CONFIG ERROR", color="red")
         logger.error(f"MQTT configuration error - check your connection settings. {e}")
 
+    this.targets = []
+    feedactive = this.topics.resolve("feedactive")
+    brokers = this.settings.brokers
+    for target in create_targets(brokers, feedactive, this.targets_loop, logger):
+        try:
+            target.connect()
+        except Exception as e:
+            logger.error(
+                f"MQTT configuration error - check {target.name} settings. {e}"
+            )
+        else:
+            this.targets.append(target)
+    if len(this.targets):
+        this.targets_loop.loop_start()
+
 
 def disconnect_telemetry() -> None:
-    """Break connection to the MQTT broker."""
+    """Break connection to the MQTT broker(s) (runs on the publisher thread).
+
+    Waits for the final FeedActive message to be sent (and acknowledged, at QoS 1 or 2)
+    and for the clients to disconnect, for at most DISCONNECT_TIMEOUT seconds in total.
+    """
     status_message(message="Disconnecting", color="steel blue")
-    if this.mqtt_connected:
-        publish(topic=this.settings.topic("feedactive"), payload="False", retain=True)
-        time.sleep(0.5)
-        this.mqtt.disconnect()
-        start = time.monotonic()
-        while this.mqtt_connected:
-            time.sleep(0.1)
-            if (time.monotonic() - start) >= 5.0:
+    deadline = time.monotonic() + DISCONNECT_TIMEOUT
+    try:
+        if this.mqtt_connected:
+            this.mqtt_disconnected.clear()
+            info = this.mqtt.publish(
+                this.topics.resolve("feedactive"),
+                payload="False",
+                qos=this.settings.qos,
+                retain=True,
+            )
+            # raises ValueError if the message could not be queued
+            if not info.wait_for_publish(deadline - time.monotonic()):
+                logger.warning("Timeout waiting for final FeedActive message.")
+            this.mqtt.disconnect()
+            if not this.mqtt_disconnected.wait(max(0.0, deadline - time.monotonic())):
                 logger.error("Timeout waiting for MQTT to disconnect.")
-                break
-    this.mqtt.loop_stop()
+    finally:
+        # the network threads are always stopped, so that a reconnect starts afresh
+        this.mqtt.loop_stop()
+        this.mqtt.session_store_set(None)
+        this.session.close()
+        try:
+            for target in this.targets:
+                target.disconnect(deadline)
+        finally:
+            if len(this.targets):
+                this.targets_loop.loop_stop()
+            this.targets = []
+
+
+def reconnect_telemetry() -> None:
+    """Restart the connection to the MQTT broker with the current settings."""
+    disconnect_telemetry()
+    connect_telemetry()
 
 
-def mqttCallback_on_connect(client, userdata, flags, rc):
+def mqttCallback_on_connect(client, userdata, flags, rc, properties=None):
     """Run this callback when connection to a broker is established."""
-    this.current_db = {}
-    this.current_location["system"] = "N/A"
-    this.current_location["station"] = "N/A"
-    this.current_state = {}
+    this.state_tracker.reset()
+    this.coalescer.clear()
+    this.publisher.put(this.throttle.clear, force=True)
+    this.publisher.put(publish_snapshot, force=True)
     if this.mqtt_connected is False:
         logger.info("Connected to MQTT Broker")
     this.mqtt_connected = True
     status_message(message="Online", color="dark green")
-    publish(topic=this.settings.topic("feedactive"), payload="True", retain=True)
+    publish(topic=this.topics.resolve("feedactive"), payload="True", retain=True)
     publish(
-        topic=this.settings.topic("gamerunning"), payload=str(monitor.game_running())
+        topic=this.topics.resolve("gamerunning"), payload=str(monitor.game_running())
     )
+    this.publisher.put(start_spool_replay, force=True)
 
 
-def mqttCallback_on_disconnect(client, userdata, rc):
+def mqttCallback_on_disconnect(client, userdata, rc, properties=None):
     """Run this callback when the connection to the broker is lost."""
     if this.mqtt_connected is True:
         logger.info("Disconnected from MQTT Broker")
     this.mqtt_connected = False
+    this.mqtt_disconnected.set()
     status_message(message="Offline", color="orange red")
+
+
+def mqttCallback_on_priority_drained(client, userdata, priority):
+    """Run this callback when everything of a priority has been written to the socket.
+
+    Lower priority packets may still be waiting, but the coalescer only holds its
+    messages back while packets of its own (or higher) priority are.
+    """
+    this.coalescer.flush()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Code related to the packed binary dashboard format for the EDMC-Telemetry plugin."""
+
+import json
+import struct
+from typing import Any, Dict, Tuple
+
+# Bump SCHEMA_VERSION whenever the layout below changes.
+SCHEMA_VERSION = 1
+
+# Dashboard fields in the order they are packed: (name, struct format).  Every field
+# has a bit in the 'Present' mask (bit 0 for the first field, and so on) which is set
+# if the field was in the status update; fields that weren't are packed as zero.
+FIELDS: Tuple[Tuple[str, str], ...] = (
+    ("Flags", "I"),
+    ("Flags2", "I"),
+    ("Pips", "3B"),  # sys, eng, wep (in half pips)
+    ("FireGroup", "B"),
+    ("GuiFocus", "B"),
+    ("Fuel", "2f"),  # main, reservoir
+    ("Cargo", "H"),
+    ("LegalState", "B"),  # index into LEGAL_STATES
+    ("Latitude", "f"),
+    ("Longitude", "f"),
+    ("Altitude", "f"),
+    ("Heading", "H"),
+)
+
+LEGAL_STATES = (
+    "Clean",
+    "IllegalCargo",
+    "Speeding",
+    "Wanted",
+    "Hostile",
+    "PassengerWanted",
+    "Warrant",
+)
+LEGAL_STATE_UNKNOWN = 0xFF
+
+# Little-endian and unpadded: schema version, present mask, then the fields.
+FORMAT = "<BH" + "".join(format for _, format in FIELDS)
+
+
+class DashboardPacker:
+    """Packs dashboard status updates into fixed-layout binary records."""
+
+    def __init__(self) -> None:
+        """Create a packer for the current schema version."""
+        self._struct = struct.Struct(FORMAT)
+        self._legal_states = {state: index for index, state in enumerate(LEGAL_STATES)}
+
+    @property
+    def size(self) -> int:
+        """Size of a packed record in bytes."""
+        return self._struct.size
+
+    def pack(self, entry: Dict[str, Any]) -> bytes:
+        """Return the packed record for the specified status update."""
+        present = 0
+        values = [SCHEMA_VERSION, 0]
+        for bit, (name, _) in enumerate(FIELDS):
+            value = entry.get(name)
+            if value is not None:
+                present |= 1 << bit
+            if name == "Pips":
+                values.extend(value if value is not None else (0, 0, 0))
+            elif name == "Fuel":
+                value = value or {}
+                values.append(value.get("FuelMain", 0.0))
+                values.append(value.get("FuelReservoir", 0.0))
+            elif name == "LegalState":
+                values.append(self._legal_states.get(value, LEGAL_STATE_UNKNOWN))
+            elif name in ("Cargo", "Heading"):
+                values.append(min(int(round(value or 0)), 0xFFFF))
+            else:
+                values.append(value or 0)
+        values[1] = present
+        return self._struct.pack(*values)
+
+    def schema(self) -> str:
+        """Return a JSON descriptor of the record layout for consumers."""
+        offset = struct.calcsize("<BH")
+        fields = []
+        for bit, (name, format) in enumerate(FIELDS):
+            size = struct.calcsize(f"<{format}")
+            fields.append(
+                {"name": name, "format": format, "offset": offset, "bit": bit}
+            )
+            offset += size
+        return json.dumps(
+            {
+                "version": SCHEMA_VERSION,
+                "format": FORMAT,
+                "size": self.size,
+                "header": [
+                    {"name": "Version", "format": "B", "offset": 0},
+                    {"name": "Present", "format": "H", "offset": 1},
+                ],
+                "fields": fields,
+                "legal_states": LEGAL_STATES,
+            }
+        )
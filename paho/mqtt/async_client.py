@@ -0,0 +1,267 @@
+# Copyright (c) 2012-2019 Roger Light and others
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# and Eclipse Distribution License v1.0 which accompany this distribution.
+#
+# The Eclipse Public License is available at
+#    http://www.eclipse.org/legal/epl-v10.html
+# and the Eclipse Distribution License is available at
+#   http://www.eclipse.org/org/documents/edl-v10.php.
+
+"""
+This module provides AsyncClient, which drives a Client from an asyncio event
+loop instead of a network thread. The client socket is watched with the event
+loop's add_reader()/add_writer(), reconnection back-off uses asyncio.sleep(),
+and publish() can be awaited until the message has been delivered. Any number
+of AsyncClients can share one event loop.
+"""
+import asyncio
+import socket
+import threading
+
+from . import client as paho
+from .. import mqtt
+
+
+class AsyncClient(object):
+    """asyncio driver for a paho.mqtt.client.Client.
+
+    General usage flow:
+
+    * Create and configure a Client (credentials, TLS, will, etc.)
+    * Wrap it: async_client = AsyncClient(client)
+    * await async_client.connect(host, port)
+    * await async_client.publish(topic, payload, qos)
+    * await async_client.disconnect()
+
+    AsyncClient takes over the on_connect, on_disconnect and on_publish
+    callbacks and the socket callbacks of the wrapped client. Callbacks already
+    set on the client when it is wrapped are still called; afterwards set them
+    on the AsyncClient instead (on_connect, on_disconnect and on_publish
+    attributes, same signatures as on Client). All other Client callbacks work
+    as usual, and are called from the event loop.
+
+    Do not call loop(), loop_forever() or loop_start() on the wrapped client.
+    """
+
+    def __init__(self, client=None, loop=None):
+        """client is the Client to drive, a new Client() by default.
+        loop is the asyncio event loop to use, by default the running loop."""
+        self._client = client if client is not None else paho.Client()
+        self._loop = loop
+        self._loop_thread = None
+        self._supervisor = None
+        self._lost = None
+        self._connected = None
+        self._closing = False
+        self._futures = {}
+
+        self.on_connect = self._client.on_connect
+        self.on_disconnect = self._client.on_disconnect
+        self.on_publish = self._client.on_publish
+
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    @property
+    def client(self):
+        """The wrapped Client."""
+        return self._client
+
+    async def connect(self, host, port=1883, keepalive=60, **kwargs):
+        """Connect to a broker, returning once the connection is accepted.
+
+        Takes the same arguments as Client.connect_async(). Once connected, the
+        client reconnects by itself after connection failures (using the
+        delays set with reconnect_delay_set()) until disconnect() is called.
+
+        Raises MQTTException if the broker refuses the connection, or
+        socket.error/OSError if the first connection attempt fails."""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.current_thread()
+        self._closing = False
+        self._lost = asyncio.Event()
+        self._connected = self._loop.create_future()
+
+        self._client.connect_async(host, port, keepalive, **kwargs)
+        await self._loop.run_in_executor(None, self._client.reconnect)
+        self._loop.add_reader(self._client._sockpairR, self._wake)
+        self._supervisor = self._loop.create_task(self._supervise())
+        try:
+            await self._connected
+        except BaseException:
+            await self._stop()
+            raise
+
+    async def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """Publish a message, returning once it has been delivered.
+
+        Takes the same arguments as Client.publish(). For QoS 0 this returns
+        once the message has been written to the socket, for QoS 1 and 2 once
+        the broker has acknowledged it. If the connection is lost in the
+        meantime, QoS 1 and 2 messages are resent after reconnecting.
+
+        Returns the MQTTMessageInfo for the message. The call returns at once,
+        without waiting, if the message could not be queued (info.rc is
+        MQTT_ERR_QUEUE_SIZE, or MQTT_ERR_NO_CONN for QoS 0)."""
+        info = self._client.publish(topic, payload, qos, retain, properties)
+        await self._wait_for(info, qos)
+        return info
+
+    async def publish_many(self, msgs):
+        """Publish a batch of messages, returning once all have been delivered.
+
+        Takes the same argument as Client.publish_many() and returns its list
+        of MQTTMessageInfo."""
+        msgs = list(msgs)
+        infos = self._client.publish_many(msgs)
+        waits = []
+        for msg, info in zip(msgs, infos):
+            if isinstance(msg, dict):
+                qos = msg.get('qos', 0)
+            else:
+                qos = msg[2] if len(msg) > 2 else 0
+            waits.append(self._wait_for(info, qos))
+        await asyncio.gather(*waits)
+        return infos
+
+    async def disconnect(self, reasoncode=None, properties=None):
+        """Disconnect from the broker and stop reconnecting. Messages that have
+        not been delivered are abandoned and their publish() calls cancelled."""
+        self._closing = True
+        if self._client.socket() is not None:
+            self._client.disconnect(reasoncode, properties)
+            # Give the DISCONNECT packet a chance to be written.
+            try:
+                await asyncio.wait_for(self._lost.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+        await self._stop()
+
+    async def _wait_for(self, info, qos):
+        if info.rc == paho.MQTT_ERR_QUEUE_SIZE:
+            return
+        if qos == 0 and info.rc == paho.MQTT_ERR_NO_CONN:
+            return
+        if info.is_published():
+            return
+        future = self._futures.get(info.mid)
+        if future is None:
+            future = self._futures[info.mid] = self._loop.create_future()
+        await future
+
+    async def _supervise(self):
+        # Handle keepalive and retries, and reconnect after connection loss.
+        while not self._closing:
+            if self._client.socket() is None:
+                await asyncio.sleep(self._client._reconnect_delay_next())
+                if self._closing:
+                    break
+                self._lost.clear()
+                try:
+                    await self._loop.run_in_executor(None, self._client.reconnect)
+                except (socket.error, OSError, paho.WebsocketConnectionError):
+                    self._client._easy_log(
+                        paho.MQTT_LOG_DEBUG, "Connection failed, retrying")
+                continue
+
+            self._client.loop_misc()
+            try:
+                await asyncio.wait_for(self._lost.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _stop(self):
+        self._closing = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+            self._supervisor = None
+        if self._client._sockpairR is not None:
+            self._loop.remove_reader(self._client._sockpairR)
+        self._client._sock_close()
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+    def _call_in_loop(self, func, *args):
+        # Socket callbacks can come from the executor thread during reconnect().
+        if threading.current_thread() is self._loop_thread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if self.on_connect:
+            self.on_connect(client, userdata, flags, rc, *args)
+        self._call_in_loop(self._connect_result, rc)
+
+    def _connect_result(self, rc):
+        if self._connected is None or self._connected.done():
+            return
+        if rc == 0:
+            self._connected.set_result(None)
+        elif isinstance(rc, int):
+            self._connected.set_exception(mqtt.MQTTException(paho.connack_string(rc)))
+        else:
+            self._connected.set_exception(mqtt.MQTTException(str(rc)))
+
+    def _on_disconnect(self, client, userdata, rc, *args):
+        if self.on_disconnect:
+            self.on_disconnect(client, userdata, rc, *args)
+        if self._lost is not None:
+            self._call_in_loop(self._lost.set)
+
+    def _on_publish(self, client, userdata, mid):
+        if self.on_publish:
+            self.on_publish(client, userdata, mid)
+        self._call_in_loop(self._publish_result, mid)
+
+    def _publish_result(self, mid):
+        future = self._futures.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call_in_loop(self._loop.add_reader, sock, self._readable)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call_in_loop(self._remove, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_in_loop(self._loop.add_writer, sock, self._writable)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_in_loop(self._loop.remove_writer, sock)
+
+    def _remove(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        if self._lost is not None:
+            self._lost.set()
+
+    def _wake(self):
+        # Something was queued from another thread; drain the wake-up socket
+        # and write it out.
+        try:
+            self._client._sockpairR.recv(4096)
+        except socket.error:
+            pass
+        if self._client.socket() is not None:
+            self._client.loop_write()
+
+    def _readable(self):
+        self._client.loop_read()
+
+    def _writable(self):
+        self._client.loop_write()
@@ -15,7 +15,7 @@
 
 from .subscribeoptions import SubscribeOptions
 from .reasoncodes import ReasonCodes
-from .properties import Properties
+from .properties import Properties, VariableByteIntegers
 from .matcher import MQTTMatcher
 import logging
 import hashlib
@@ -32,6 +32,8 @@ protocol that is easy to implement and suitable for low powered devices.
 """
 import collections
 import errno
+import heapq
+import itertools
 import os
 import platform
 import select
@@ -171,6 +173,115 @@ MQTT_CLEAN_START_FIRST_ONLY = 3
 
 sockpair_data = b"0"
 
+# Maximum number of queued packets written to the socket in a single call
+MAX_GATHER_PACKETS = 64
+
+# Priorities of outgoing packets. Queued packets are written in order of
+# priority (lowest number first) at packet boundaries, and in the order they
+# were queued within each priority. Acknowledgements, pings, CONNECT and
+# (UN)SUBSCRIBE use PRIORITY_CONTROL, DISCONNECT uses PRIORITY_LOW so that it
+# follows everything queued before it, and publish() uses PRIORITY_NORMAL
+# unless told otherwise.
+PRIORITY_CONTROL = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+PRIORITY_LANES = 4
+
+# Initial size of the buffer used to read incoming packets
+READ_BUFFER_SIZE = 16384
+
+# Directions of the messages kept in a session store
+SESSION_OUTGOING = 0
+SESSION_INCOMING = 1
+
+# Maximum number of length prefixed PUBLISH topics to keep for reuse
+_TOPIC_STR16_CACHE_MAX = 1024
+
+_UINT16 = struct.Struct('!H')
+
+
+class _OutPacket(object):
+    """An outgoing packet queued for writing, and how much of it is written."""
+
+    __slots__ = 'command', 'mid', 'qos', 'pos', 'to_process', 'packet', 'info', 'batch', 'priority'
+
+    def __init__(self, command, mid, qos, packet, info=None, batch=None, priority=PRIORITY_CONTROL):
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.pos = 0
+        self.to_process = len(packet)
+        self.packet = packet
+        self.info = info
+        self.batch = batch
+        self.priority = priority
+
+
+class _InPacket(object):
+    """The incoming packet being handled. A single instance is reused for
+    every packet read on a connection."""
+
+    __slots__ = 'command', 'remaining_length', 'packet', 'pos'
+
+    def __init__(self):
+        self.command = 0
+        self.remaining_length = 0
+        self.packet = b""
+        self.pos = 0
+
+
+class _PacketLanes(object):
+    """Queue of outgoing packets with one FIFO lane per priority.
+
+    Behaves like the deque it replaces: popleft() returns the oldest packet of
+    the highest priority, and iterating yields packets in the order popleft()
+    would return them."""
+
+    __slots__ = '_lanes', '_length'
+
+    def __init__(self):
+        self._lanes = tuple(collections.deque() for _ in range(PRIORITY_LANES))
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._lanes)
+
+    def append(self, packet):
+        self._lanes[packet.priority].append(packet)
+        self._length += 1
+
+    def popleft(self):
+        for lane in self._lanes:
+            if lane:
+                self._length -= 1
+                return lane.popleft()
+        raise IndexError('pop from an empty queue')
+
+    def remove_first(self, packet):
+        # Remove a packet that is at the front of its own lane (i.e. one that
+        # was gathered and partly written before higher priority packets were
+        # queued).
+        lane = self._lanes[packet.priority]
+        if lane and lane[0] is packet:
+            lane.popleft()
+            self._length -= 1
+
+    def count(self, priority):
+        # Number of queued packets with the specified priority or higher.
+        return sum(len(lane) for lane in self._lanes[:priority + 1])
+
+    def first_priority(self):
+        # Priority of the first lane with packets queued, or PRIORITY_LANES if
+        # all lanes are empty.
+        for priority, lane in enumerate(self._lanes):
+            if lane:
+                return priority
+        return PRIORITY_LANES
+
 
 class WebsocketConnectionError(ValueError):
     pass
@@ -287,6 +398,10 @@ def _socketpair_compat():
     return (sock1, sock2)
 
 
+# Guards the lazy creation of MQTTMessageInfo conditions.
+_info_condition_lock = threading.Lock()
+
+
 class MQTTMessageInfo(object):
     """This is a class returned from Client.publish() and can be used to find
     out the mid of the message that was published, and to determine whether the
@@ -298,7 +413,8 @@ class MQTTMessageInfo(object):
     def __init__(self, mid):
         self.mid = mid
         self._published = False
-        self._condition = threading.Condition()
+        # Only created if someone waits for the message to be published.
+        self._condition = None
         self.rc = 0
         self._iterpos = 0
 
@@ -331,25 +447,46 @@ class MQTTMessageInfo(object):
             raise IndexError("index out of range")
 
     def _set_as_published(self):
-        with self._condition:
-            self._published = True
-            self._condition.notify()
-
-    def wait_for_publish(self):
-        """Block until the message associated with this object is published."""
+        # _published must be set before _condition is read; a waiter creates
+        # _condition before it checks _published, so one of them sees the other.
+        self._published = True
+        condition = self._condition
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+
+    def wait_for_publish(self, timeout=None):
+        """Block until the message associated with this object is published, or
+        until the timeout occurs. If timeout is None, this will never time out.
+        Set timeout to a positive number of seconds, e.g. 1.2, to enable the
+        timeout.
+
+        Returns True if the message was published."""
         if self.rc == MQTT_ERR_QUEUE_SIZE:
             raise ValueError('Message is not queued due to ERR_QUEUE_SIZE')
+        if self._published:
+            return True
+        with _info_condition_lock:
+            if self._condition is None:
+                self._condition = threading.Condition()
+        deadline = None if timeout is None else time_func() + timeout
         with self._condition:
             while not self._published:
-                self._condition.wait()
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time_func()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            return self._published
 
     def is_published(self):
         """Returns True if the message associated with this object has been
         published, else returns False."""
         if self.rc == MQTT_ERR_QUEUE_SIZE:
             raise ValueError('Message is not queued due to ERR_QUEUE_SIZE')
-        with self._condition:
-            return self._published
+        return self._published
 
 
 class MQTTMessage(object):
@@ -368,7 +505,7 @@ class MQTTMessage(object):
     On Python 3, topic must be bytes.
     """
 
-    __slots__ = 'timestamp', 'state', 'dup', 'mid', '_topic', 'payload', 'qos', 'retain', 'info', 'properties'
+    __slots__ = 'timestamp', 'state', 'dup', 'mid', '_topic', 'payload', 'qos', 'retain', 'info', 'properties', 'priority'
 
     def __init__(self, mid=0, topic=b""):
         self.timestamp = 0
@@ -380,6 +517,7 @@ class MQTTMessage(object):
         self.qos = 0
         self.retain = False
         self.info = MQTTMessageInfo(mid)
+        self.priority = PRIORITY_NORMAL
 
     def __eq__(self, other):
         """Override the default Equals behavior"""
@@ -565,6 +703,7 @@ class Client(object):
         self._protocol = protocol
         self._userdata = userdata
         self._sock = None
+        self._sock_sendmsg_ok = False
         self._sockpairR, self._sockpairW = (None, None,)
         self._sockpairR, self._sockpairW = _socketpair_compat()
         self._keepalive = 60
@@ -584,17 +723,15 @@ class Client(object):
 
         self._username = None
         self._password = None
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
-        self._out_packet = collections.deque()
+        self._in_packet = _InPacket()
+        self._in_buffer = bytearray(READ_BUFFER_SIZE)
+        self._in_start = 0
+        self._in_end = 0
+        self._out_packet = _PacketLanes()
         self._current_out_packet = None
+        # (gathered packets, joined buffer or None) of a write that hasn't
+        # made progress yet, see _packet_write().
+        self._out_retry = None
         self._last_msg_in = time_func()
         self._last_msg_out = time_func()
         self._reconnect_min_delay = 1
@@ -605,9 +742,33 @@ class Client(object):
         self._state = mqtt_cs_new
         self._out_messages = collections.OrderedDict()
         self._in_messages = collections.OrderedDict()
+        # Min-heaps of (timestamp, mid) used to find messages that are due to be
+        # retried without scanning every message. Entries are not removed when
+        # a message is acknowledged or its timestamp changes; they are skipped
+        # if they no longer match the message when they are popped.
+        self._out_retries = []
+        self._in_retries = []
+        # Outgoing messages waiting for an inflight slot, in order.
+        self._out_queued = collections.deque()
+        self._session_store = None
         self._max_inflight_messages = 20
         self._inflight_messages = 0
         self._max_queued_messages = 0
+        # Topic aliases for outgoing messages (MQTT v5.0): the limit set by
+        # topic_alias_maximum_set(), the maximum in use for the current
+        # connection, the next alias that hasn't been used yet, and for each
+        # priority, the alias of each topic in least recently used order.
+        # Packets of different priorities can be written out of order, so an
+        # alias is only ever used by the priority it was first assigned to, and
+        # a share of the aliases is reserved for each priority (see
+        # _topic_alias_available()).
+        self._topic_alias_limit = 0
+        self._topic_alias_maximum = 0
+        self._topic_alias_next = 1
+        self._topic_aliases = tuple(
+            collections.OrderedDict() for _ in range(PRIORITY_LANES))
+        # Length prefixed topic by topic, as packed into PUBLISH packets
+        self._topic_str16 = {}
         self._connect_properties = None
         self._will_properties = None
         self._will = False
@@ -650,6 +811,7 @@ class Client(object):
         self._on_socket_close = None
         self._on_socket_register_write = None
         self._on_socket_unregister_write = None
+        self._on_priority_drained = None
         self._websocket_path = "/mqtt"
         self._websocket_extra_headers = None
         # for clean_start == MQTT_CLEAN_START_FIRST_ONLY
@@ -672,6 +834,23 @@ class Client(object):
                 raise WouldBlockError()
             raise
 
+    def _sock_recv_into(self, buffer):
+        try:
+            if hasattr(self._sock, 'recv_into'):
+                return self._sock.recv_into(buffer)
+            data = self._sock.recv(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        except socket.error as err:
+            if self._ssl and err.errno == ssl.SSL_ERROR_WANT_READ:
+                raise WouldBlockError()
+            if self._ssl and err.errno == ssl.SSL_ERROR_WANT_WRITE:
+                self._call_socket_register_write()
+                raise WouldBlockError()
+            if err.errno == EAGAIN:
+                raise WouldBlockError()
+            raise
+
     def _sock_send(self, buf):
         try:
             return self._sock.send(buf)
@@ -686,6 +865,15 @@ class Client(object):
                 raise WouldBlockError()
             raise
 
+    def _sock_sendmsg(self, buffers):
+        try:
+            return self._sock.sendmsg(buffers)
+        except socket.error as err:
+            if err.errno == EAGAIN:
+                self._call_socket_register_write()
+                raise WouldBlockError()
+            raise
+
     def _sock_close(self):
         """Close the connection to the server."""
         if not self._sock:
@@ -710,10 +898,14 @@ class Client(object):
             self._sockpairW.close()
             self._sockpairW = None
 
-    def reinitialise(self, client_id="", clean_session=True, userdata=None):
+    def reinitialise(self, client_id="", clean_session=True, userdata=None,
+                     protocol=MQTTv311, transport="tcp"):
         self._reset_sockets()
 
-        self.__init__(client_id, clean_session, userdata)
+        if protocol == MQTTv5:
+            # Not used for MQTT v5.0, see __init__().
+            clean_session = None
+        self.__init__(client_id, clean_session, userdata, protocol, transport)
 
     def ws_set_options(self, path="/mqtt", headers=None):
         """ Set the path and headers for a websocket connection
@@ -1044,21 +1236,23 @@ class Client(object):
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._in_packet = _InPacket()
+        self._in_buffer = bytearray(READ_BUFFER_SIZE)
+        self._in_start = 0
+        self._in_end = 0
 
         with self._out_packet_mutex:
-            self._out_packet = collections.deque()
+            self._out_packet = _PacketLanes()
 
         with self._current_out_packet_mutex:
             self._current_out_packet = None
+            self._out_retry = None
+
+        # Topic aliases only last as long as the connection; none are used
+        # until the broker's Topic Alias Maximum is known.
+        with self._out_message_mutex:
+            self._topic_alias_maximum = 0
+            self._topic_aliases_clear()
 
         with self._msgtime_mutex:
             self._last_msg_in = time_func()
@@ -1113,6 +1307,10 @@ class Client(object):
 
         self._sock = sock
         self._sock.setblocking(0)
+        # Vectored writes are only possible on plain (non TLS, non websocket)
+        # sockets, and not at all on some platforms.
+        self._sock_sendmsg_ok = (
+            not self._ssl and self._transport == "tcp" and hasattr(sock, 'sendmsg'))
         self._registered_write = False
         self._call_socket_open()
 
@@ -1200,13 +1398,15 @@ class Client(object):
 
         return self.loop_misc()
 
-    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None, priority=PRIORITY_NORMAL):
         """Publish a message on a topic.
 
         This causes a message to be sent to the broker and subsequently from
         the broker to any clients subscribing to matching topics.
 
-        topic: The topic that the message should be published on.
+        topic: The topic that the message should be published on. May be given
+        as a string or as UTF-8 encoded bytes, which avoids re-encoding topics
+        that are published repeatedly.
         payload: The actual message to send. If not given, or set to None a
         zero length message will be used. Passing an int or float will result
         in the payload being converted to a string representing that number. If
@@ -1217,6 +1417,9 @@ class Client(object):
         good"/retained message for the topic.
         properties: (MQTT v5.0 only) the MQTT v5.0 properties to be included.
         Use the Properties class.
+        priority: One of PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW. Queued
+        messages with a higher priority are written to the network first, at
+        packet boundaries; messages with the same priority stay in order.
 
         Returns a MQTTMessageInfo class, which can be used to determine whether
         the message has been delivered (using info.is_published()) or to block
@@ -1239,39 +1442,15 @@ class Client(object):
 
         A ValueError will be raised if qos is not one of 0, 1 or 2, or if
         the length of the payload is greater than 268435455 bytes."""
-        if self._protocol != MQTTv5:
-            if topic is None or len(topic) == 0:
-                raise ValueError('Invalid topic.')
-
-        topic = topic.encode('utf-8')
-
-        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-            raise ValueError('Publish topic cannot contain wildcards.')
-
-        if qos < 0 or qos > 2:
-            raise ValueError('Invalid QoS level.')
-
-        if isinstance(payload, unicode):
-            local_payload = payload.encode('utf-8')
-        elif isinstance(payload, (bytes, bytearray)):
-            local_payload = payload
-        elif isinstance(payload, (int, float)):
-            local_payload = str(payload).encode('ascii')
-        elif payload is None:
-            local_payload = b''
-        else:
-            raise TypeError(
-                'payload must be a string, bytearray, int, float or None.')
-
-        if len(local_payload) > 268435455:
-            raise ValueError('Payload too large.')
+        topic, local_payload = self._publish_args_check(topic, payload, qos)
+        self._priority_check(priority)
 
         local_mid = self._mid_generate()
 
         if qos == 0:
             info = MQTTMessageInfo(local_mid)
             rc = self._send_publish(
-                local_mid, topic, local_payload, qos, retain, False, info, properties)
+                local_mid, topic, local_payload, qos, retain, False, info, properties, priority)
             info.rc = rc
             return info
         else:
@@ -1282,6 +1461,7 @@ class Client(object):
             message.retain = retain
             message.dup = False
             message.properties = properties
+            message.priority = priority
 
             with self._out_message_mutex:
                 if self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages:
@@ -1293,6 +1473,8 @@ class Client(object):
                     return message.info
 
                 self._out_messages[message.mid] = message
+                self._session_put(SESSION_OUTGOING, message)
+                self._retry_schedule(self._out_retries, message)
                 if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                     self._inflight_messages += 1
                     if qos == 1:
@@ -1301,7 +1483,7 @@ class Client(object):
                         message.state = mqtt_ms_wait_for_pubrec
 
                     rc = self._send_publish(message.mid, topic, message.payload, message.qos, message.retain,
-                                            message.dup, message.info, message.properties)
+                                            message.dup, message.info, message.properties, message.priority)
 
                     # remove from inflight messages so it will be send after a connection is made
                     if rc is MQTT_ERR_NO_CONN:
@@ -1312,9 +1494,119 @@ class Client(object):
                     return message.info
                 else:
                     message.state = mqtt_ms_queued
+                    self._out_queued.append(message)
                     message.info.rc = MQTT_ERR_SUCCESS
                     return message.info
 
+    def publish_many(self, msgs, priority=PRIORITY_NORMAL):
+        """Publish a batch of messages with a single hand-off to the network.
+
+        All of the PUBLISH packets in the batch are encoded into one contiguous
+        buffer and queued together, so the network thread is woken once and the
+        whole batch can be written to the socket with a single call. This is
+        much cheaper than calling publish() for each message when many small
+        messages are generated at the same time.
+
+        msgs: an iterable of messages. Each message is either a dict or a tuple.
+
+          If a dict, only the topic must be present and the remaining keys match
+          the arguments of publish():
+          msg = {'topic':"<topic>", 'payload':"<payload>", 'qos':<qos>,
+          'retain':<retain>, 'properties':<properties>}
+
+          If a tuple, then it must be of the form:
+          ("<topic>", "<payload>", qos, retain)
+          where all but the topic may be omitted.
+
+        priority: the priority of all of the messages, as for publish().
+
+        Returns a list with one MQTTMessageInfo per message, in the same order
+        as msgs. These behave exactly as those returned by publish().
+
+        Raises the same exceptions as publish() for any invalid message, in
+        which case none of the messages in the batch are sent."""
+        prepared = []
+        for msg in msgs:
+            if isinstance(msg, dict):
+                topic, payload, qos, retain, properties = (
+                    msg['topic'], msg.get('payload'), msg.get('qos', 0),
+                    msg.get('retain', False), msg.get('properties'))
+            elif isinstance(msg, (tuple, list)):
+                topic, payload, qos, retain, properties = (
+                    tuple(msg) + (None, 0, False, None)[len(msg) - 1:])[:5]
+            else:
+                raise TypeError('message must be a dict, tuple, or list')
+            topic, payload = self._publish_args_check(topic, payload, qos)
+            prepared.append((topic, payload, qos, retain, properties))
+        self._priority_check(priority)
+
+        infos = []
+        published = []
+        packet = bytearray()
+        with self._out_message_mutex:
+            for topic, payload, qos, retain, properties in prepared:
+                local_mid = self._mid_generate()
+
+                if qos == 0:
+                    info = MQTTMessageInfo(local_mid)
+                    infos.append(info)
+                    if self._sock is None:
+                        info.rc = MQTT_ERR_NO_CONN
+                        continue
+                    self._pack_publish(
+                        packet, local_mid, topic, payload, qos, retain, False, properties, priority)
+                    published.append((local_mid, info))
+                    continue
+
+                message = MQTTMessage(local_mid, topic)
+                message.timestamp = time_func()
+                message.payload = payload
+                message.qos = qos
+                message.retain = retain
+                message.dup = False
+                message.properties = properties
+                message.priority = priority
+                infos.append(message.info)
+
+                if ((self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages)
+                        or local_mid in self._out_messages):
+                    message.info.rc = MQTT_ERR_QUEUE_SIZE
+                    continue
+
+                self._out_messages[message.mid] = message
+                self._session_put(SESSION_OUTGOING, message)
+                self._retry_schedule(self._out_retries, message)
+                message.info.rc = MQTT_ERR_SUCCESS
+                if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+                    if self._sock is None:
+                        # send it after a connection is made
+                        message.state = mqtt_ms_publish
+                        message.info.rc = MQTT_ERR_NO_CONN
+                        continue
+                    self._inflight_messages += 1
+                    if qos == 1:
+                        message.state = mqtt_ms_wait_for_puback
+                    elif qos == 2:
+                        message.state = mqtt_ms_wait_for_pubrec
+                    self._pack_publish(
+                        packet, message.mid, topic, payload, qos, retain, False, properties, priority)
+                else:
+                    message.state = mqtt_ms_queued
+                    self._out_queued.append(message)
+
+            if len(packet) > 0:
+                self._easy_log(
+                    MQTT_LOG_DEBUG, "Sending %d PUBLISH packets in one batch (%d bytes)",
+                    len(infos), len(packet))
+                rc = self._packet_queue(
+                    PUBLISH, packet, 0, 0, batch=published, priority=priority)
+                if rc != MQTT_ERR_SUCCESS:
+                    for info in infos:
+                        if info.rc == MQTT_ERR_SUCCESS:
+                            info.rc = rc
+
+        return infos
+
     def username_pw_set(self, username, password=None):
         """Set a username and optionally a password for broker authentication.
 
@@ -1566,7 +1858,11 @@ class Client(object):
         if max_packets < 1:
             max_packets = 1
 
-        for _ in range(0, max_packets):
+        # Keep going while data remains buffered, as those packets won't be
+        # signalled by select() again.
+        count = 0
+        while count < max_packets or self._in_start < self._in_end:
+            count += 1
             if self._sock is None:
                 return MQTT_ERR_NO_CONN
             rc = self._packet_read()
@@ -1593,6 +1889,7 @@ class Client(object):
         if max_packets < 1:
             max_packets = 1
 
+        busy = self._busy_priority()
         try:
             for _ in range(0, max_packets):
                 rc = self._packet_write()
@@ -1606,11 +1903,22 @@ class Client(object):
                 self._call_socket_register_write()
             else:
                 self._call_socket_unregister_write()
+            drained = self._busy_priority()
+            if drained > busy:
+                self._call_priority_drained(drained - 1)
 
-    def want_write(self):
+    def want_write(self, priority=None):
         """Call to determine if there is network data waiting to be written.
         Useful if you are calling select() yourself rather than using loop().
+
+        If priority is given, only packets with that priority or higher are
+        considered.
         """
+        if priority is not None:
+            current = self._current_out_packet
+            if current and current.priority <= priority:
+                return True
+            return self._out_packet.count(priority) > 0
         if self._current_out_packet or len(self._out_packet) > 0:
             return True
         else:
@@ -1664,6 +1972,90 @@ class Client(object):
         self._max_queued_messages = queue_size
         return self
 
+    def topic_alias_maximum_set(self, maximum):
+        """Set the maximum number of topic aliases to use for outgoing messages
+        (MQTT v5.0 only). Defaults to 0, which disables topic aliases.
+
+        When enabled, aliases are assigned to topics as they are published. The
+        first message to a topic is sent with the full topic and its alias,
+        after which the topic is sent as just the alias. Each alias is only
+        used for messages of the priority it was first assigned to. A third of
+        the aliases (rounded down) is reserved for each of PRIORITY_HIGH,
+        PRIORITY_NORMAL and PRIORITY_LOW, and the remainder is shared by all
+        priorities. Once a priority has used up its share and no shared
+        aliases are left, the alias of its least recently used topic is
+        reassigned; if that priority has none, the message is sent with its
+        full topic.
+
+        The number of aliases actually used is limited to the Topic Alias
+        Maximum given by the broker in its CONNACK; if the broker doesn't give
+        one, no aliases are used. Messages that already have a TopicAlias
+        property are sent unchanged."""
+        if maximum < 0 or maximum > 65535:
+            raise ValueError('Invalid topic alias maximum.')
+        self._topic_alias_limit = maximum
+
+    def session_store_set(self, store):
+        """Set a store used to persist the QoS 1 and 2 messages of the session,
+        so that they survive the client being restarted. Must be called before
+        connect(), and is only useful with clean_session=False (or
+        clean_start=False for MQTT v5.0).
+
+        Any messages left in the store by a previous client are restored
+        immediately and resent once connected. After that the client keeps
+        the store up to date with the following methods, which may be called
+        from any thread:
+
+        store.put(direction, mid, topic, payload, qos, retain, state)
+            Add or replace the message with the given direction
+            (SESSION_OUTGOING or SESSION_INCOMING) and mid.
+        store.remove(direction, mid)
+            Remove a message once it has been completely handled.
+        store.commit()
+            Make the changes since the last commit durable. This is called
+            before queued packets are written to the network, so it only has
+            to do real work when something changed, and a single commit
+            covers every packet written at the same time.
+
+        store.restore() must return the (direction, mid, topic, payload, qos,
+        retain, state) of each message in the store.
+
+        Set store to None to stop using a store."""
+        self._session_store = store
+        if store is None:
+            return
+        with self._out_message_mutex, self._in_message_mutex:
+            for direction, mid, topic, payload, qos, retain, state in store.restore():
+                message = MQTTMessage(mid, topic)
+                message.payload = payload
+                message.qos = qos
+                message.retain = retain
+                message.properties = None
+                if direction == SESSION_INCOMING:
+                    message.state = mqtt_ms_wait_for_pubrel
+                    self._in_messages[mid] = message
+                    continue
+                # The message may have been sent before, unless the broker has
+                # already received it (PUBREC), in which case it is released
+                # again instead.
+                message.dup = True
+                if qos == 2 and state == mqtt_ms_wait_for_pubcomp:
+                    message.state = mqtt_ms_wait_for_pubcomp
+                else:
+                    message.state = mqtt_ms_publish
+                self._out_messages[mid] = message
+                self._last_mid = max(self._last_mid, mid)
+
+    def _session_put(self, direction, message):
+        if self._session_store is not None:
+            self._session_store.put(
+                direction, message.mid, message._topic, message.payload,
+                message.qos, message.retain, message.state)
+
+    def _session_remove(self, direction, mid):
+        if self._session_store is not None:
+            self._session_store.remove(direction, mid)
+
     def message_retry_set(self, retry):
         """Set the timeout in seconds before a message with QoS>0 is retried.
         20 seconds by default."""
@@ -1719,7 +2111,9 @@ class Client(object):
                 'payload must be a string, bytearray, int, float or None.')
 
         self._will = True
-        self._will_topic = topic.encode('utf-8')
+        if isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+        self._will_topic = topic
         self._will_qos = qos
         self._will_retain = retain
         self._will_properties = properties
@@ -2135,16 +2529,18 @@ class Client(object):
         if not self._sock or self._registered_write:
             return
         self._registered_write = True
-        with self._callback_mutex:
-            if self.on_socket_register_write:
-                try:
-                    self.on_socket_register_write(
-                        self, self._userdata, self._sock)
-                except Exception as err:
-                    self._easy_log(
-                        MQTT_LOG_ERR, 'Caught exception in on_socket_register_write: %s', err)
-                    if not self.suppress_exceptions:
-                        raise
+        # Called without _callback_mutex: packets are queued while holding
+        # _out_message_mutex, and other callbacks (e.g. on_connect) hold
+        # _callback_mutex while they publish, so taking it here could deadlock.
+        on_socket_register_write = self.on_socket_register_write
+        if on_socket_register_write:
+            try:
+                on_socket_register_write(self, self._userdata, self._sock)
+            except Exception as err:
+                self._easy_log(
+                    MQTT_LOG_ERR, 'Caught exception in on_socket_register_write: %s', err)
+                if not self.suppress_exceptions:
+                    raise
 
     @property
     def on_socket_unregister_write(self):
@@ -2174,15 +2570,66 @@ class Client(object):
             return
         self._registered_write = False
 
+        # Called without _callback_mutex, so that the callback can publish
+        # (see _call_socket_register_write()).
+        on_socket_unregister_write = self.on_socket_unregister_write
+        if on_socket_unregister_write:
+            try:
+                on_socket_unregister_write(self, self._userdata, sock)
+            except Exception as err:
+                self._easy_log(
+                    MQTT_LOG_ERR, 'Caught exception in on_socket_unregister_write: %s', err)
+                if not self.suppress_exceptions:
+                    raise
+
+    @property
+    def on_priority_drained(self):
+        """If implemented, called when all packets of a priority have been written."""
+        return self._on_priority_drained
+
+    @on_priority_drained.setter
+    def on_priority_drained(self, func):
+        """Define the priority_drained callback implementation.
+
+        This is called after writing to the socket when the packets that were
+        waiting to be written include none of the specified priority or
+        higher anymore, even though lower priority packets may still be
+        waiting. It can be used to hold messages back until
+        want_write(priority) is False, and send them as soon as it is.
+
+        Expected signature is:
+            priority_drained_callback(client, userdata, priority)
+
+        client:     the client instance for this callback
+        userdata:   the private user data as set in Client() or userdata_set()
+        priority:   the lowest priority (i.e. the highest PRIORITY_* value)
+                    that has no packets waiting to be written
+        """
         with self._callback_mutex:
-            if self.on_socket_unregister_write:
-                try:
-                    self.on_socket_unregister_write(self, self._userdata, sock)
-                except Exception as err:
-                    self._easy_log(
-                        MQTT_LOG_ERR, 'Caught exception in on_socket_unregister_write: %s', err)
-                    if not self.suppress_exceptions:
-                        raise
+            self._on_priority_drained = func
+
+    def _call_priority_drained(self, priority):
+        """Call the priority_drained callback with the drained priority"""
+        # Called without _callback_mutex, so that the callback can publish
+        # (see _call_socket_register_write()).
+        on_priority_drained = self.on_priority_drained
+        if on_priority_drained:
+            try:
+                on_priority_drained(self, self._userdata, priority)
+            except Exception as err:
+                self._easy_log(
+                    MQTT_LOG_ERR, 'Caught exception in on_priority_drained: %s', err)
+                if not self.suppress_exceptions:
+                    raise
+
+    def _busy_priority(self):
+        # The highest priority (i.e. the lowest value) of the packets waiting
+        # to be written, or PRIORITY_LANES if nothing is waiting.
+        busy = self._out_packet.first_priority()
+        current = self._current_out_packet
+        if current and current.priority < busy:
+            return current.priority
+        return busy
 
     def message_callback_add(self, sub, callback):
         """Register a message callback for a specific topic.
@@ -2229,110 +2676,146 @@ class Client(object):
         return rc
 
     def _packet_read(self):
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock_recv(1)
-            except WouldBlockError:
-                return MQTT_ERR_AGAIN
-            except socket.error as err:
-                self._easy_log(
-                    MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command, = struct.unpack("!B", command)
-                self._in_packet['command'] = command
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
-            # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    byte = self._sock_recv(1)
-                except WouldBlockError:
-                    return MQTT_ERR_AGAIN
-                except socket.error as err:
-                    self._easy_log(
-                        MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                    return 1
-                else:
-                    if len(byte) == 0:
-                        return 1
-                    byte, = struct.unpack("!B", byte)
-                    self._in_packet['remaining_count'].append(byte)
+        # This gets called if select() indicates that there is network data
+        # available - ie. at least one byte, or if data is already buffered.
+        # Incoming data is read into _in_buffer with recv_into(), as much as is
+        # available at once, so a single read will often pick up several
+        # packets (e.g. a burst of PUBACKs). Buffered data runs from _in_start
+        # to _in_end.
+        # Each call handles one complete packet from the buffer, reading more
+        # data from the socket only when a complete packet isn't available.
+        # The packet is passed to _packet_handle() as a memoryview slice of the
+        # buffer where that is safe (no properties to decode), to avoid copying.
+        while True:
+            start = self._in_start
+            end = self._in_end
+            buf = self._in_buffer
+            pos = None
+            if end - start >= 2:
+                # Decode the remaining length.
+                # Algorithm for decoding taken from pseudo code at
+                # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
+                remaining_length = 0
+                remaining_mult = 1
+                i = start + 1
+                while i < end:
+                    byte = buf[i]
+                    i += 1
+                    remaining_length += (byte & 127) * remaining_mult
+                    if (byte & 128) == 0:
+                        pos = i
+                        break
+                    remaining_mult *= 128
                     # Max 4 bytes length for remaining length as defined by protocol.
                     # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
+                    if i - start > 4:
                         return MQTT_ERR_PROTOCOL
 
-                    self._in_packet['remaining_length'] += (
-                        byte & 127) * self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
+            if pos is not None and end - pos >= remaining_length:
+                break
 
-                if (byte & 128) == 0:
-                    break
+            if pos is None:
+                needed = 5
+            else:
+                needed = pos - start + remaining_length
+            rc = self._in_buffer_fill(needed)
+            if rc != MQTT_ERR_SUCCESS:
+                return rc
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
+        # All data for this packet is buffered.
+        command = buf[start]
+        packet_end = pos + remaining_length
+        packet = memoryview(buf)[pos:packet_end]
+        if packet_end == end:
+            self._in_start = self._in_end = 0
+        else:
+            self._in_start = packet_end
 
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock_recv(self._in_packet['to_process'])
-            except WouldBlockError:
-                return MQTT_ERR_AGAIN
-            except socket.error as err:
-                self._easy_log(
-                    MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                return 1
-            else:
-                if len(data) == 0:
-                    return 1
-                self._in_packet['to_process'] -= len(data)
-                self._in_packet['packet'] += data
+        if (command & 0xF0) != PUBLISH and remaining_length > 2:
+            # Properties/reason codes are decoded from bytes.
+            packet = packet.tobytes()
 
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
+        self._in_packet.command = command
+        self._in_packet.remaining_length = remaining_length
+        self._in_packet.packet = packet
+        self._in_packet.pos = 0
         rc = self._packet_handle()
 
-        # Free data and reset values
-        self._in_packet = {
-            'command': 0,
-            'have_remaining': 0,
-            'remaining_count': [],
-            'remaining_mult': 1,
-            'remaining_length': 0,
-            'packet': b"",
-            'to_process': 0,
-            'pos': 0}
+        # Free data
+        self._in_packet.packet = b""
+        del packet
+        if self._in_end == 0 and len(self._in_buffer) > READ_BUFFER_SIZE:
+            self._in_buffer = bytearray(READ_BUFFER_SIZE)
 
         with self._msgtime_mutex:
             self._last_msg_in = time_func()
         return rc
 
+    def _in_buffer_fill(self, needed):
+        # Read whatever data is available from the socket into _in_buffer,
+        # first making sure there is room to hold at least the next `needed`
+        # bytes of the current packet.
+        buffered = self._in_end - self._in_start
+        if self._in_start + needed > len(self._in_buffer) or self._in_end == len(self._in_buffer):
+            if needed > len(self._in_buffer):
+                buf = bytearray(max(needed, 2 * len(self._in_buffer)))
+            else:
+                buf = self._in_buffer
+            buf[:buffered] = self._in_buffer[self._in_start:self._in_end]
+            self._in_buffer = buf
+            self._in_start = 0
+            self._in_end = buffered
+
+        try:
+            count = self._sock_recv_into(
+                memoryview(self._in_buffer)[self._in_end:])
+        except WouldBlockError:
+            return MQTT_ERR_AGAIN
+        except socket.error as err:
+            self._easy_log(
+                MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
+            return 1
+        if count == 0:
+            return 1
+        self._in_end += count
+        return MQTT_ERR_SUCCESS
+
     def _packet_write(self):
         self._current_out_packet_mutex.acquire()
 
         while self._current_out_packet:
-            packet = self._current_out_packet
+            # On TLS and websocket connections, a write that made no progress
+            # is retried with exactly the same data, even if higher priority
+            # packets were queued since: TLS requires a retried write to pass
+            # the same buffer, and the websocket wrapper sends its own copy of
+            # the data it was first given.
+            if self._out_retry is None:
+                packets = self._packet_write_gather()
+                joined = None
+            else:
+                packets, joined = self._out_retry
+            if self._session_store is not None:
+                # Messages are put in the session before their packets are
+                # queued, so committing after gathering persists everything
+                # that is about to be written before the broker can see (and
+                # acknowledge) any of it.
+                self._session_store.commit()
+            buffers = [memoryview(p.packet)[p.pos:] for p in packets]
 
             try:
-                write_length = self._sock_send(
-                    packet['packet'][packet['pos']:])
+                if len(buffers) == 1:
+                    if not self._sock_sendmsg_ok:
+                        self._out_retry = (packets, None)
+                    write_length = self._sock_send(buffers[0])
+                elif self._sock_sendmsg_ok:
+                    write_length = self._sock_sendmsg(buffers)
+                else:
+                    # No scatter/gather available (TLS, websockets, Windows), so
+                    # copy the queued packets into a single buffer instead.
+                    if joined is None:
+                        joined = b''.join(buffers)
+                    self._out_retry = (packets, joined)
+                    write_length = self._sock_send(joined)
             except (AttributeError, ValueError):
                 self._current_out_packet_mutex.release()
                 return MQTT_ERR_SUCCESS
@@ -2344,45 +2827,52 @@ class Client(object):
                 self._easy_log(
                     MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
                 return 1
+            finally:
+                del buffers
 
-            if write_length > 0:
-                packet['to_process'] -= write_length
-                packet['pos'] += write_length
+            if write_length <= 0:
+                break
+            self._out_retry = None
 
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        with self._callback_mutex:
-                            if self.on_publish:
-                                with self._in_callback_mutex:
-                                    try:
-                                        self.on_publish(
-                                            self, self._userdata, packet['mid'])
-                                    except Exception as err:
-                                        self._easy_log(
-                                            MQTT_LOG_ERR, 'Caught exception in on_publish: %s', err)
-                                        if not self.suppress_exceptions:
-                                            raise
+            # Account for the written bytes across as many packets as they cover.
+            for index, packet in enumerate(packets):
+                written = min(write_length, packet.to_process)
+                packet.to_process -= written
+                packet.pos += written
+                write_length -= written
 
-                        packet['info']._set_as_published()
+                if packet.to_process > 0:
+                    break
 
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._current_out_packet_mutex.release()
+                if (packet.command & 0xF0) == PUBLISH:
+                    if packet.batch is not None:
+                        for mid, info in packet.batch:
+                            self._handle_publish_sent(mid, info)
+                    elif packet.qos == 0:
+                        self._handle_publish_sent(
+                            packet.mid, packet.info)
 
-                        with self._msgtime_mutex:
-                            self._last_msg_out = time_func()
+                if (packet.command & 0xF0) == DISCONNECT:
+                    self._current_out_packet_mutex.release()
 
-                        self._do_on_disconnect(0)
+                    with self._msgtime_mutex:
+                        self._last_msg_out = time_func()
 
-                        self._sock_close()
-                        return MQTT_ERR_SUCCESS
+                    self._do_on_disconnect(0)
 
-                    with self._out_packet_mutex:
-                        if len(self._out_packet) > 0:
-                            self._current_out_packet = self._out_packet.popleft()
-                        else:
-                            self._current_out_packet = None
-            else:
-                break
+                    self._sock_close()
+                    return MQTT_ERR_SUCCESS
+
+                with self._out_packet_mutex:
+                    if write_length > 0:
+                        # The next gathered packet has been (partly) written,
+                        # even if higher priority packets were queued since.
+                        self._current_out_packet = packets[index + 1]
+                        self._out_packet.remove_first(packets[index + 1])
+                    elif len(self._out_packet) > 0:
+                        self._current_out_packet = self._out_packet.popleft()
+                    else:
+                        self._current_out_packet = None
 
         self._current_out_packet_mutex.release()
 
@@ -2391,6 +2881,37 @@ class Client(object):
 
         return MQTT_ERR_SUCCESS
 
+    def _packet_write_gather(self):
+        # Return the current packet followed by as many queued packets as can be
+        # written with a single call. Queued packets are left in _out_packet;
+        # they are popped in order by _packet_write() as they are completed.
+        # Nothing may be written after a DISCONNECT, so gathering stops there.
+        packets = [self._current_out_packet]
+        if (packets[0].command & 0xF0) == DISCONNECT:
+            return packets
+        with self._out_packet_mutex:
+            for packet in itertools.islice(
+                    self._out_packet, 0, MAX_GATHER_PACKETS - 1):
+                packets.append(packet)
+                if (packet.command & 0xF0) == DISCONNECT:
+                    break
+        return packets
+
+    def _handle_publish_sent(self, mid, info):
+        # A QoS 0 message is complete as soon as it has been written out.
+        with self._callback_mutex:
+            if self.on_publish:
+                with self._in_callback_mutex:
+                    try:
+                        self.on_publish(self, self._userdata, mid)
+                    except Exception as err:
+                        self._easy_log(
+                            MQTT_LOG_ERR, 'Caught exception in on_publish: %s', err)
+                        if not self.suppress_exceptions:
+                            raise
+
+        info._set_as_published()
+
     def _easy_log(self, level, fmt, *args):
         if self.on_log is not None:
             buf = fmt % args
@@ -2403,6 +2924,13 @@ class Client(object):
             level_std = LOGGING_LEVEL[level]
             self._logger.log(level_std, fmt, *args)
 
+    def _easy_log_enabled(self, level):
+        # Return True if a message logged at level would go anywhere, so that
+        # busy code paths can skip building the message's arguments.
+        if self.on_log is not None:
+            return True
+        return self._logger is not None and self._logger.isEnabledFor(LOGGING_LEVEL[level])
+
     def _check_keepalive(self):
         if self._keepalive == 0:
             return MQTT_ERR_SUCCESS
@@ -2495,21 +3023,102 @@ class Client(object):
         packet.extend(struct.pack("!H", len(data)))
         packet.extend(data)
 
-    def _send_publish(self, mid, topic, payload=b'', qos=0, retain=False, dup=False, info=None, properties=None):
-        # we assume that topic and payload are already properly encoded
-        assert not isinstance(topic, unicode) and not isinstance(
-            payload, unicode) and payload is not None
+    def _priority_check(self, priority):
+        if priority not in (PRIORITY_CONTROL, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+            raise ValueError('Invalid priority.')
+
+    def _publish_args_check(self, topic, payload, qos):
+        # Validate the arguments to publish(), returning the encoded topic and
+        # payload.
+        if self._protocol != MQTTv5:
+            if topic is None or len(topic) == 0:
+                raise ValueError('Invalid topic.')
+
+        if isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+
+        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        if qos < 0 or qos > 2:
+            raise ValueError('Invalid QoS level.')
+
+        if isinstance(payload, unicode):
+            local_payload = payload.encode('utf-8')
+        elif isinstance(payload, (bytes, bytearray)):
+            local_payload = payload
+        elif isinstance(payload, (int, float)):
+            local_payload = str(payload).encode('ascii')
+        elif payload is None:
+            local_payload = b''
+        else:
+            raise TypeError(
+                'payload must be a string, bytearray, int, float or None.')
+
+        if len(local_payload) > 268435455:
+            raise ValueError('Payload too large.')
 
+        return topic, local_payload
+
+    def _send_publish(self, mid, topic, payload=b'', qos=0, retain=False, dup=False, info=None, properties=None, priority=PRIORITY_NORMAL):
         if self._sock is None:
             return MQTT_ERR_NO_CONN
 
-        command = PUBLISH | ((dup & 0x1) << 3) | (qos << 1) | retain
         packet = bytearray()
+        # Packets must be queued in the order they were packed, as this is
+        # the order in which topic aliases are assigned.
+        with self._out_message_mutex:
+            self._pack_publish(packet, mid, topic, payload, qos, retain, dup, properties, priority)
+            return self._packet_queue(PUBLISH, packet, mid, qos, info, priority=priority)
+
+    def _pack_publish(self, packet, mid, topic, payload=b'', qos=0, retain=False, dup=False, properties=None, priority=PRIORITY_NORMAL):
+        # Append a complete PUBLISH packet to the packet bytearray.
+        # we assume that topic and payload are already properly encoded
+        assert not isinstance(topic, unicode) and not isinstance(
+            payload, unicode) and payload is not None
+
+        command = PUBLISH | ((dup & 0x1) << 3) | (qos << 1) | retain
         packet.append(command)
 
-        payloadlen = len(payload)
-        remaining_length = 2 + len(topic) + payloadlen
+        if self._protocol == MQTTv5:
+            topic, packed_properties = self._pack_publish_properties(topic, properties, priority)
+        else:
+            packed_properties = b''
+
+        if self._easy_log_enabled(MQTT_LOG_DEBUG):
+            self._log_publish(mid, topic, payload, qos, retain, dup, properties)
 
+        # The length prefixed topic is the same for every message to a topic.
+        try:
+            topic_str16 = self._topic_str16[topic]
+        except KeyError:
+            if len(self._topic_str16) >= _TOPIC_STR16_CACHE_MAX:
+                self._topic_str16.clear()
+            topic_str16 = _UINT16.pack(len(topic)) + topic
+            self._topic_str16[topic] = topic_str16
+
+        remaining_length = len(topic_str16) + len(packed_properties) + len(payload)
+        if qos > 0:
+            # For message id
+            remaining_length += 2
+
+        if remaining_length < 128:
+            packet.append(remaining_length)
+        else:
+            self._pack_remaining_length(packet, remaining_length)
+        packet += topic_str16
+
+        if qos > 0:
+            # For message id
+            packet += _UINT16.pack(mid)
+
+        packet += packed_properties
+        packet += payload
+
+        return packet
+
+    def _log_publish(self, mid, topic, payload, qos, retain, dup, properties):
+        payloadlen = len(payload)
         if payloadlen == 0:
             if self._protocol == MQTTv5:
                 self._easy_log(
@@ -2537,30 +3146,40 @@ class Client(object):
                     dup, qos, retain, mid, topic, payloadlen
                 )
 
-        if qos > 0:
-            # For message id
-            remaining_length += 2
-
-        if self._protocol == MQTTv5:
-            if properties == None:
-                packed_properties = b'\x00'
+    def _pack_publish_properties(self, topic, properties, priority):
+        # Return the topic and packed properties to use in a v5.0 PUBLISH,
+        # substituting a topic alias for the topic if aliases are enabled.
+        aliases = self._topic_aliases[priority]
+        alias = None
+        if self._topic_alias_maximum > 0 and not hasattr(properties, 'TopicAlias'):
+            alias = aliases.get(topic)
+            if alias is not None:
+                aliases.move_to_end(topic)
+                alias_topic = b''
             else:
-                packed_properties = properties.pack()
-            remaining_length += len(packed_properties)
-
-        self._pack_remaining_length(packet, remaining_length)
-        self._pack_str16(packet, topic)
-
-        if qos > 0:
-            # For message id
-            packet.extend(struct.pack("!H", mid))
-
-        if self._protocol == MQTTv5:
-            packet.extend(packed_properties)
-
-        packet.extend(payload)
-
-        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+                if self._topic_alias_available(priority):
+                    alias = self._topic_alias_next
+                    self._topic_alias_next += 1
+                elif aliases:
+                    # Reassign the alias of the least recently used topic.
+                    alias = aliases.popitem(last=False)[1]
+                if alias is not None:
+                    aliases[topic] = alias
+                    alias_topic = topic
+
+        if alias is None:
+            if properties is None:
+                return topic, b'\x00'
+            return topic, properties.pack()
+
+        # Topic Alias property identifier followed by a two byte integer.
+        packed_properties = struct.pack('!BH', 0x23, alias)
+        if properties is not None:
+            other = properties.pack()
+            other = other[VariableByteIntegers.decode(other)[1]:]
+            packed_properties = other + packed_properties
+        return (alias_topic,
+                VariableByteIntegers.encode(len(packed_properties)) + packed_properties)
 
     def _send_pubrec(self, mid):
         self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %d)", mid)
@@ -2720,7 +3339,7 @@ class Client(object):
                 if properties != None:
                     packet += packed_props
 
-        return self._packet_queue(command, packet, 0, 0)
+        return self._packet_queue(command, packet, 0, 0, priority=PRIORITY_LOW)
 
     def _send_subscribe(self, dup, topics, properties=None):
         remaining_length = 2
@@ -2803,35 +3422,48 @@ class Client(object):
             )
         return (self._packet_queue(command, packet, local_mid, 1), local_mid)
 
-    def _message_retry_check_actual(self, messages, mutex):
+    def _retry_schedule(self, retries, message):
+        # Must be called whenever message.timestamp is set on a message that
+        # is (or may later be) waiting for an acknowledgement.
+        heapq.heappush(retries, (message.timestamp, message.mid))
+
+    def _message_retry_check_actual(self, messages, retries, mutex):
         with mutex:
             now = time_func()
-            for m in messages.values():
-                if m.timestamp + self._message_retry < now:
-                    if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                        m.timestamp = now
-                        m.dup = True
-                        self._send_publish(
-                            m.mid,
-                            m.topic.encode('utf-8'),
-                            m.payload,
-                            m.qos,
-                            m.retain,
-                            m.dup,
-                            properties=m.properties,
-                        )
-                    elif m.state == mqtt_ms_wait_for_pubrel:
-                        m.timestamp = now
-                        self._send_pubrec(m.mid)
-                    elif m.state == mqtt_ms_wait_for_pubcomp:
-                        m.timestamp = now
-                        self._send_pubrel(m.mid)
+            while retries and retries[0][0] + self._message_retry < now:
+                timestamp, mid = heapq.heappop(retries)
+                m = messages.get(mid)
+                if m is None or m.timestamp != timestamp:
+                    # acknowledged, or rescheduled since this entry was pushed
+                    continue
+                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+                    m.timestamp = now
+                    m.dup = True
+                    self._retry_schedule(retries, m)
+                    self._send_publish(
+                        m.mid,
+                        m.topic.encode('utf-8'),
+                        m.payload,
+                        m.qos,
+                        m.retain,
+                        m.dup,
+                        properties=m.properties,
+                        priority=m.priority,
+                    )
+                elif m.state == mqtt_ms_wait_for_pubrel:
+                    m.timestamp = now
+                    self._retry_schedule(retries, m)
+                    self._send_pubrec(m.mid)
+                elif m.state == mqtt_ms_wait_for_pubcomp:
+                    m.timestamp = now
+                    self._retry_schedule(retries, m)
+                    self._send_pubrel(m.mid)
 
     def _message_retry_check(self):
         self._message_retry_check_actual(
-            self._out_messages, self._out_message_mutex)
+            self._out_messages, self._out_retries, self._out_message_mutex)
         self._message_retry_check_actual(
-            self._in_messages, self._in_message_mutex)
+            self._in_messages, self._in_retries, self._in_message_mutex)
 
     def _check_clean_session(self):
         if self._protocol == MQTTv5:
@@ -2845,6 +3477,9 @@ class Client(object):
     def _messages_reconnect_reset_out(self):
         with self._out_message_mutex:
             self._inflight_messages = 0
+            # every message is rescheduled once the connection is acknowledged
+            del self._out_retries[:]
+            self._out_queued.clear()
             for m in self._out_messages.values():
                 m.timestamp = 0
                 if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
@@ -2870,10 +3505,14 @@ class Client(object):
                                 m.state = mqtt_ms_publish
                 else:
                     m.state = mqtt_ms_queued
+                    self._out_queued.append(m)
 
     def _messages_reconnect_reset_in(self):
         with self._in_message_mutex:
+            del self._in_retries[:]
             if self._check_clean_session():
+                for mid in self._in_messages:
+                    self._session_remove(SESSION_INCOMING, mid)
                 self._in_messages = collections.OrderedDict()
                 return
             for m in self._in_messages.values():
@@ -2882,21 +3521,36 @@ class Client(object):
                     self._in_messages.pop(m.mid)
                 else:
                     # Preserve current state
-                    pass
+                    self._retry_schedule(self._in_retries, m)
 
     def _messages_reconnect_reset(self):
         self._messages_reconnect_reset_out()
         self._messages_reconnect_reset_in()
 
-    def _packet_queue(self, command, packet, mid, qos, info=None):
-        mpkt = {
-            'command': command,
-            'mid': mid,
-            'qos': qos,
-            'pos': 0,
-            'to_process': len(packet),
-            'packet': packet,
-            'info': info}
+    def _topic_alias_available(self, priority):
+        # Return True if an unused alias may be assigned to a topic of the
+        # priority. An equal share of the aliases is reserved for each of the
+        # message priorities (PRIORITY_HIGH to PRIORITY_LOW), and only the
+        # rest are shared first come first served, so that a burst of new
+        # topics of one priority can't take all the aliases before the other
+        # priorities get any.
+        unused = self._topic_alias_maximum - self._topic_alias_next + 1
+        reserve = self._topic_alias_maximum // (PRIORITY_LANES - PRIORITY_HIGH)
+        for other in range(PRIORITY_HIGH, PRIORITY_LANES):
+            held = len(self._topic_aliases[other])
+            if other != priority and held < reserve:
+                unused -= reserve - held
+        return unused > 0
+
+    def _topic_aliases_clear(self):
+        for aliases in self._topic_aliases:
+            aliases.clear()
+        self._topic_alias_next = 1
+
+    def _packet_queue(self, command, packet, mid, qos, info=None, batch=None, priority=PRIORITY_CONTROL):
+        # batch is a list of (mid, info) for the QoS 0 messages contained in a
+        # packet built by publish_many(), which may hold many PUBLISH packets.
+        mpkt = _OutPacket(command, mid, qos, packet, info, batch, priority)
 
         with self._out_packet_mutex:
             self._out_packet.append(mpkt)
@@ -2923,7 +3577,7 @@ class Client(object):
         return MQTT_ERR_SUCCESS
 
     def _packet_handle(self):
-        cmd = self._in_packet['command'] & 0xF0
+        cmd = self._in_packet.command & 0xF0
         if cmd == PINGREQ:
             return self._handle_pingreq()
         elif cmd == PINGRESP:
@@ -2952,14 +3606,14 @@ class Client(object):
             return MQTT_ERR_PROTOCOL
 
     def _handle_pingreq(self):
-        if self._in_packet['remaining_length'] != 0:
+        if self._in_packet.remaining_length != 0:
             return MQTT_ERR_PROTOCOL
 
         self._easy_log(MQTT_LOG_DEBUG, "Received PINGREQ")
         return self._send_pingresp()
 
     def _handle_pingresp(self):
-        if self._in_packet['remaining_length'] != 0:
+        if self._in_packet.remaining_length != 0:
             return MQTT_ERR_PROTOCOL
 
         # No longer waiting for a PINGRESP.
@@ -2969,19 +3623,19 @@ class Client(object):
 
     def _handle_connack(self):
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] < 2:
+            if self._in_packet.remaining_length < 2:
                 return MQTT_ERR_PROTOCOL
-        elif self._in_packet['remaining_length'] != 2:
+        elif self._in_packet.remaining_length != 2:
             return MQTT_ERR_PROTOCOL
 
         if self._protocol == MQTTv5:
             (flags, result) = struct.unpack(
-                "!BB", self._in_packet['packet'][:2])
+                "!BB", self._in_packet.packet[:2])
             reason = ReasonCodes(CONNACK >> 4, identifier=result)
             properties = Properties(CONNACK >> 4)
-            properties.unpack(self._in_packet['packet'][2:])
+            properties.unpack(self._in_packet.packet[2:])
         else:
-            (flags, result) = struct.unpack("!BB", self._in_packet['packet'])
+            (flags, result) = struct.unpack("!BB", self._in_packet.packet)
         if self._protocol == MQTTv311:
             if result == CONNACK_REFUSED_PROTOCOL_VERSION:
                 self._easy_log(
@@ -3005,6 +3659,12 @@ class Client(object):
         if result == 0:
             self._state = mqtt_cs_connected
             self._reconnect_delay = None
+            if self._protocol == MQTTv5:
+                with self._out_message_mutex:
+                    self._topic_aliases_clear()
+                    self._topic_alias_maximum = min(
+                        self._topic_alias_limit,
+                        getattr(properties, 'TopicAliasMaximum', 0))
 
         if self._protocol == MQTTv5:
             self._easy_log(
@@ -3039,6 +3699,7 @@ class Client(object):
             with self._out_message_mutex:
                 for m in self._out_messages.values():
                     m.timestamp = time_func()
+                    self._retry_schedule(self._out_retries, m)
                     if m.state == mqtt_ms_queued:
                         self.loop_write()  # Process outgoing messages that have just been queued up
                         return MQTT_ERR_SUCCESS
@@ -3052,7 +3713,8 @@ class Client(object):
                                 m.qos,
                                 m.retain,
                                 m.dup,
-                                properties=m.properties
+                                properties=m.properties,
+                                priority=m.priority
                             )
                         if rc != 0:
                             return rc
@@ -3068,7 +3730,8 @@ class Client(object):
                                     m.qos,
                                     m.retain,
                                     m.dup,
-                                    properties=m.properties
+                                    properties=m.properties,
+                                    priority=m.priority
                                 )
                             if rc != 0:
                                 return rc
@@ -3084,7 +3747,8 @@ class Client(object):
                                     m.qos,
                                     m.retain,
                                     m.dup,
-                                    properties=m.properties
+                                    properties=m.properties,
+                                    priority=m.priority
                                 )
                             if rc != 0:
                                 return rc
@@ -3106,13 +3770,13 @@ class Client(object):
     def _handle_disconnect(self):
         packet_type = DISCONNECT >> 4
         reasonCode = properties = None
-        if self._in_packet['remaining_length'] > 2:
+        if self._in_packet.remaining_length > 2:
             reasonCode = ReasonCodes(packet_type)
-            reasonCode.unpack(self._in_packet['packet'])
-            if self._in_packet['remaining_length'] > 3:
+            reasonCode.unpack(self._in_packet.packet)
+            if self._in_packet.remaining_length > 3:
                 properties = Properties(packet_type)
                 props, props_len = properties.unpack(
-                    self._in_packet['packet'][1:])
+                    self._in_packet.packet[1:])
         self._easy_log(MQTT_LOG_DEBUG, "Received DISCONNECT %s %s",
                        reasonCode,
                        properties
@@ -3124,8 +3788,8 @@ class Client(object):
 
     def _handle_suback(self):
         self._easy_log(MQTT_LOG_DEBUG, "Received SUBACK")
-        pack_format = "!H" + str(len(self._in_packet['packet']) - 2) + 's'
-        (mid, packet) = struct.unpack(pack_format, self._in_packet['packet'])
+        pack_format = "!H" + str(len(self._in_packet.packet) - 2) + 's'
+        (mid, packet) = struct.unpack(pack_format, self._in_packet.packet)
 
         if self._protocol == MQTTv5:
             properties = Properties(SUBACK >> 4)
@@ -3160,14 +3824,14 @@ class Client(object):
     def _handle_publish(self):
         rc = 0
 
-        header = self._in_packet['command']
+        header = self._in_packet.command
         message = MQTTMessage()
         message.dup = (header & 0x08) >> 3
         message.qos = (header & 0x06) >> 1
         message.retain = (header & 0x01)
 
-        pack_format = "!H" + str(len(self._in_packet['packet']) - 2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
+        pack_format = "!H" + str(len(self._in_packet.packet) - 2) + 's'
+        (slen, packet) = struct.unpack(pack_format, self._in_packet.packet)
         pack_format = '!' + str(slen) + 's' + str(len(packet) - slen) + 's'
         (topic, packet) = struct.unpack(pack_format, packet)
 
@@ -3220,22 +3884,23 @@ class Client(object):
             self._handle_on_message(message)
             return rc
         elif message.qos == 2:
-            rc = self._send_pubrec(message.mid)
             message.state = mqtt_ms_wait_for_pubrel
             with self._in_message_mutex:
                 self._in_messages[message.mid] = message
-            return rc
+                self._session_put(SESSION_INCOMING, message)
+                self._retry_schedule(self._in_retries, message)
+            return self._send_pubrec(message.mid)
         else:
             return MQTT_ERR_PROTOCOL
 
     def _handle_pubrel(self):
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] < 2:
+            if self._in_packet.remaining_length < 2:
                 return MQTT_ERR_PROTOCOL
-        elif self._in_packet['remaining_length'] != 2:
+        elif self._in_packet.remaining_length != 2:
             return MQTT_ERR_PROTOCOL
 
-        mid, = struct.unpack("!H", self._in_packet['packet'])
+        mid, = struct.unpack("!H", self._in_packet.packet)
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: %d)", mid)
 
         with self._in_message_mutex:
@@ -3243,6 +3908,7 @@ class Client(object):
                 # Only pass the message on if we have removed it from the queue - this
                 # prevents multiple callbacks for the same message.
                 message = self._in_messages.pop(mid)
+                self._session_remove(SESSION_INCOMING, mid)
                 self._handle_on_message(message)
                 self._inflight_messages -= 1
                 if self._max_inflight_messages > 0:
@@ -3253,74 +3919,79 @@ class Client(object):
 
         # FIXME: this should only be done if the message is known
         # If unknown it's a protocol error and we should close the connection.
-        # But since we don't have (on disk) persistence for the session, it
-        # is possible that we must known about this message.
+        # But unless a session store is used, the session isn't persisted, so
+        # it is possible that we must known about this message.
         # Choose to acknwoledge this messsage (and thus losing a message) but
         # avoid hanging. See #284.
         return self._send_pubcomp(mid)
 
     def _update_inflight(self):
         # Dont lock message_mutex here
-        for m in self._out_messages.values():
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages += 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(
-                        m.mid,
-                        m.topic.encode('utf-8'),
-                        m.payload,
-                        m.qos,
-                        m.retain,
-                        m.dup,
-                        properties=m.properties,
-                    )
-                    if rc != 0:
-                        return rc
-            else:
-                return MQTT_ERR_SUCCESS
+        while self._out_queued and self._inflight_messages < self._max_inflight_messages:
+            m = self._out_queued.popleft()
+            if m.state != mqtt_ms_queued or self._out_messages.get(m.mid) is not m:
+                continue
+            self._inflight_messages += 1
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            # the retry timeout starts once the message is actually sent
+            m.timestamp = time_func()
+            self._retry_schedule(self._out_retries, m)
+            rc = self._send_publish(
+                m.mid,
+                m.topic.encode('utf-8'),
+                m.payload,
+                m.qos,
+                m.retain,
+                m.dup,
+                properties=m.properties,
+                priority=m.priority,
+            )
+            if rc != 0:
+                return rc
         return MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self):
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] < 2:
+            if self._in_packet.remaining_length < 2:
                 return MQTT_ERR_PROTOCOL
-        elif self._in_packet['remaining_length'] != 2:
+        elif self._in_packet.remaining_length != 2:
             return MQTT_ERR_PROTOCOL
 
-        mid, = struct.unpack("!H", self._in_packet['packet'][:2])
+        mid, = struct.unpack("!H", self._in_packet.packet[:2])
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] > 2:
+            if self._in_packet.remaining_length > 2:
                 reasonCode = ReasonCodes(PUBREC >> 4)
-                reasonCode.unpack(self._in_packet['packet'][2:])
-                if self._in_packet['remaining_length'] > 3:
+                reasonCode.unpack(self._in_packet.packet[2:])
+                if self._in_packet.remaining_length > 3:
                     properties = Properties(PUBREC >> 4)
                     props, props_len = properties.unpack(
-                        self._in_packet['packet'][3:])
+                        self._in_packet.packet[3:])
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: %d)", mid)
 
         with self._out_message_mutex:
             if mid in self._out_messages:
                 msg = self._out_messages[mid]
                 msg.state = mqtt_ms_wait_for_pubcomp
+                self._session_put(SESSION_OUTGOING, msg)
                 msg.timestamp = time_func()
+                self._retry_schedule(self._out_retries, msg)
                 return self._send_pubrel(mid)
 
         return MQTT_ERR_SUCCESS
 
     def _handle_unsuback(self):
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] < 4:
+            if self._in_packet.remaining_length < 4:
                 return MQTT_ERR_PROTOCOL
-        elif self._in_packet['remaining_length'] != 2:
+        elif self._in_packet.remaining_length != 2:
             return MQTT_ERR_PROTOCOL
 
-        mid, = struct.unpack("!H", self._in_packet['packet'][:2])
+        mid, = struct.unpack("!H", self._in_packet.packet[:2])
         if self._protocol == MQTTv5:
-            packet = self._in_packet['packet'][2:]
+            packet = self._in_packet.packet[2:]
             properties = Properties(UNSUBACK >> 4)
             props, props_len = properties.unpack(packet)
             reasoncodes = []
@@ -3379,6 +4050,7 @@ class Client(object):
         msg = self._out_messages.pop(mid)
         msg.info._set_as_published()
         if msg.qos > 0:
+            self._session_remove(SESSION_OUTGOING, mid)
             self._inflight_messages -= 1
             if self._max_inflight_messages > 0:
                 rc = self._update_inflight()
@@ -3388,22 +4060,22 @@ class Client(object):
 
     def _handle_pubackcomp(self, cmd):
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] < 2:
+            if self._in_packet.remaining_length < 2:
                 return MQTT_ERR_PROTOCOL
-        elif self._in_packet['remaining_length'] != 2:
+        elif self._in_packet.remaining_length != 2:
             return MQTT_ERR_PROTOCOL
 
         packet_type = PUBACK if cmd == "PUBACK" else PUBCOMP
         packet_type = packet_type >> 4
-        mid, = struct.unpack("!H", self._in_packet['packet'][:2])
+        mid, = struct.unpack("!H", self._in_packet.packet[:2])
         if self._protocol == MQTTv5:
-            if self._in_packet['remaining_length'] > 2:
+            if self._in_packet.remaining_length > 2:
                 reasonCode = ReasonCodes(packet_type)
-                reasonCode.unpack(self._in_packet['packet'][2:])
-                if self._in_packet['remaining_length'] > 3:
+                reasonCode.unpack(self._in_packet.packet[2:])
+                if self._in_packet.remaining_length > 3:
                     properties = Properties(packet_type)
                     props, props_len = properties.unpack(
-                        self._in_packet['packet'][3:])
+                        self._in_packet.packet[3:])
         self._easy_log(MQTT_LOG_DEBUG, "Received %s (Mid: %d)", cmd, mid)
 
         with self._out_message_mutex:
@@ -3451,9 +4123,9 @@ class Client(object):
     def _thread_main(self):
         self.loop_forever(retry_first_connection=True)
 
-    def _reconnect_wait(self):
-        # See reconnect_delay_set for details
-        now = time_func()
+    def _reconnect_delay_next(self):
+        # Return the delay before the next reconnection attempt, backing off on
+        # each call. See reconnect_delay_set for details
         with self._reconnect_delay_mutex:
             if self._reconnect_delay is None:
                 self._reconnect_delay = self._reconnect_min_delay
@@ -3462,8 +4134,11 @@ class Client(object):
                     self._reconnect_delay * 2,
                     self._reconnect_max_delay,
                 )
+            return self._reconnect_delay
 
-            target_time = now + self._reconnect_delay
+    def _reconnect_wait(self):
+        now = time_func()
+        target_time = now + self._reconnect_delay_next()
 
         remaining = target_time - now
         while (self._state != mqtt_cs_disconnecting
@@ -0,0 +1,303 @@
+# Copyright (c) 2012-2019 Roger Light and others
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# and Eclipse Distribution License v1.0 which accompany this distribution.
+#
+# The Eclipse Public License is available at
+#    http://www.eclipse.org/legal/epl-v10.html
+# and the Eclipse Distribution License is available at
+#   http://www.eclipse.org/org/documents/edl-v10.php.
+
+"""
+This module provides SelectorLoop, an alternative to Client.loop() /
+loop_start() built on the selectors module (epoll/kqueue where available).
+Sockets are registered once rather than being passed to select() on every
+iteration, and a single SelectorLoop can drive any number of clients - for
+example connections to several brokers - from one thread.
+"""
+from __future__ import absolute_import
+
+import selectors
+import socket
+import threading
+
+from . import client as paho
+
+_SOCKET = 0
+_WAKE = 1
+
+
+class SelectorLoop(object):
+    """Network loop for one or more Client instances.
+
+    General usage flow:
+
+    * Create the clients, set their callbacks and call connect_async()
+    * Add each client with add_client()
+    * Call loop_start() to run the loop in a new thread, or call
+      loop_forever() or loop() yourself.
+
+    Clients are (re)connected by the loop, using the delays configured with
+    reconnect_delay_set(), in the same way as loop_forever(). The connection
+    itself (name lookup, TCP connect and TLS handshake) is made in a short-lived
+    worker thread, so a slow or unreachable broker doesn't hold up the other
+    clients; the client is left alone by the loop until the worker is done.
+
+    Only the socket and wake-up socket of each client are registered with the
+    selector, once each; write interest is toggled only when the client's
+    want_write() changes. Do not call loop(), loop_forever() or loop_start() on
+    a client that has been added to a SelectorLoop.
+    """
+
+    def __init__(self, selector=None):
+        """selector is an optional selectors.BaseSelector instance to use. By
+        default a selectors.DefaultSelector() is created."""
+        self._selector = selector or selectors.DefaultSelector()
+        self._clients = []
+        self._clients_mutex = threading.Lock()
+        # client -> [socket, wake socket, write interest, next reconnect time,
+        #            connect thread]
+        self._registered = {}
+        self._thread = None
+        self._thread_terminate = False
+
+    def add_client(self, client):
+        """Add a client to be driven by this loop. May be called from any thread."""
+        with self._clients_mutex:
+            if client not in self._clients:
+                self._clients.append(client)
+                if self._thread is not None:
+                    client._thread = self._thread
+        self._wake(client)
+
+    def remove_client(self, client):
+        """Stop driving a client from this loop. The client is not disconnected.
+        May be called from any thread."""
+        with self._clients_mutex:
+            if client in self._clients:
+                self._clients.remove(client)
+                if client._thread is self._thread:
+                    client._thread = None
+        self._wake(client)
+
+    def loop(self, timeout=1.0):
+        """Process network events for all clients.
+
+        timeout: The maximum time in seconds to wait for network traffic.
+
+        Returns the number of clients that are currently connected."""
+        if timeout < 0.0:
+            raise ValueError('Invalid timeout.')
+
+        now = paho.time_func()
+        for client, entry in self._reconcile():
+            if entry[4] is not None:
+                # woken up by the connect thread when it is done
+                continue
+            if entry[0] is None and entry[3] is not None:
+                timeout = max(0.0, min(timeout, entry[3] - now))
+            elif entry[0] is not None and hasattr(entry[0], 'pending') and entry[0].pending() > 0:
+                # don't wait if bytes are pending in the (SSL) socket
+                timeout = 0.0
+
+        try:
+            events = self._selector.select(timeout)
+        except (OSError, ValueError):
+            # A socket was closed by another thread; it is removed on the next
+            # call.
+            events = []
+
+        for key, mask in events:
+            client, kind = key.data
+            entry = self._registered.get(client)
+            if entry is None or entry[4] is not None:
+                # still connecting; the wake-up is handled once it is done
+                continue
+            if kind == _WAKE:
+                # Drain the wake-up socket, then try writing whatever has just
+                # been queued.
+                try:
+                    key.fileobj.recv(4096)
+                except socket.error:
+                    pass
+                mask = selectors.EVENT_WRITE
+            elif hasattr(key.fileobj, 'pending') and key.fileobj.pending() > 0:
+                mask |= selectors.EVENT_READ
+
+            if client.socket() is None:
+                continue
+            if mask & selectors.EVENT_READ:
+                client.loop_read()
+            if mask & selectors.EVENT_WRITE and client.socket() is not None:
+                client.loop_write()
+
+        connected = 0
+        for client, entry in list(self._registered.items()):
+            if entry[4] is not None:
+                continue
+            if client.socket() is not None:
+                client.loop_misc()
+            if client.socket() is not None:
+                connected += 1
+
+        return connected
+
+    def loop_forever(self, timeout=1.0):
+        """Call loop() repeatedly until loop_stop() is called."""
+        while not self._thread_terminate:
+            self.loop(timeout)
+
+        # Unregister everything so a later loop starts from a clean state,
+        # after letting connection attempts in progress finish.
+        for client, entry in list(self._registered.items()):
+            if entry[4] is not None:
+                entry[4].join()
+            self._unregister(client)
+
+    def loop_start(self):
+        """Start a new thread running loop_forever()."""
+        if self._thread is not None:
+            return paho.MQTT_ERR_INVAL
+
+        self._thread_terminate = False
+        self._thread = threading.Thread(target=self.loop_forever)
+        self._thread.daemon = True
+        with self._clients_mutex:
+            # Clients queue outgoing packets for this thread to write, rather
+            # than writing them from the calling thread.
+            for client in self._clients:
+                client._thread = self._thread
+        self._thread.start()
+
+    def loop_stop(self):
+        """Stop the thread previously created with loop_start(). This call will
+        block until the thread finishes."""
+        if self._thread is None:
+            return paho.MQTT_ERR_INVAL
+
+        self._thread_terminate = True
+        with self._clients_mutex:
+            clients = list(self._clients)
+        for client in clients:
+            self._wake(client)
+        if threading.current_thread() != self._thread:
+            self._thread.join()
+            with self._clients_mutex:
+                for client in self._clients:
+                    if client._thread is self._thread:
+                        client._thread = None
+            self._thread = None
+
+    def _wake(self, client):
+        # Break out of select() in the loop thread.
+        try:
+            client._sockpairW.send(paho.sockpair_data)
+        except (AttributeError, socket.error):
+            pass
+
+    def _reconcile(self):
+        # Bring the selector registrations in line with the current clients and
+        # their sockets, (re)connecting clients that are due. Only called from
+        # the loop thread. Returns the registered (client, entry) pairs.
+        with self._clients_mutex:
+            clients = list(self._clients)
+
+        for client in list(self._registered):
+            if client not in clients:
+                self._unregister(client)
+
+        now = paho.time_func()
+        for client in clients:
+            entry = self._registered.get(client)
+            if entry is None:
+                entry = self._registered[client] = [None, None, False, None, None]
+
+            if entry[4] is not None:
+                if entry[4].is_alive():
+                    continue
+                entry[4] = None
+
+            if client._sockpairR is not entry[1]:
+                self._selector_unregister(entry[1])
+                entry[1] = client._sockpairR
+                if entry[1] is not None:
+                    self._selector.register(
+                        entry[1], selectors.EVENT_READ, (client, _WAKE))
+
+            if client.socket() is None and entry[0] is not None and entry[3] is None:
+                # The connection was lost since the last call; schedule a
+                # reconnection unless it was closed deliberately.
+                if client._state != paho.mqtt_cs_disconnecting:
+                    entry[3] = now + client._reconnect_delay_next()
+
+            if client.socket() is None and self._reconnect_due(client, entry, now):
+                entry[3] = None
+                self._selector_unregister(entry[0])
+                entry[0] = None
+                entry[4] = threading.Thread(
+                    target=self._connect, args=(client, entry))
+                entry[4].daemon = True
+                entry[4].start()
+                continue
+
+            sock = client.socket()
+            want_write = sock is not None and client.want_write()
+            if sock is not entry[0]:
+                self._selector_unregister(entry[0])
+                entry[0] = sock
+                entry[2] = want_write
+                if sock is not None:
+                    self._selector.register(
+                        sock, self._events(want_write), (client, _SOCKET))
+            elif sock is not None and want_write != entry[2]:
+                entry[2] = want_write
+                self._selector.modify(
+                    sock, self._events(want_write), (client, _SOCKET))
+
+        return list(self._registered.items())
+
+    def _connect(self, client, entry):
+        # Runs in a connect thread. The loop thread doesn't touch the client
+        # until this thread has finished, and is woken up when it has.
+        try:
+            client.reconnect()
+        except (socket.error, OSError, paho.WebsocketConnectionError):
+            client._easy_log(
+                paho.MQTT_LOG_DEBUG, "Connection failed, retrying")
+            entry[3] = paho.time_func() + client._reconnect_delay_next()
+        else:
+            with self._clients_mutex:
+                removed = client not in self._clients
+            if removed:
+                # Nothing would drive the new connection.
+                client._sock_close()
+        finally:
+            self._wake(client)
+
+    def _reconnect_due(self, client, entry, now):
+        if client._state == paho.mqtt_cs_disconnecting or len(client._host) == 0:
+            entry[3] = None
+            return False
+        if client._state == paho.mqtt_cs_connect_async and entry[3] is None:
+            return True
+        return entry[3] is not None and entry[3] <= now
+
+    def _unregister(self, client):
+        entry = self._registered.pop(client)
+        self._selector_unregister(entry[0])
+        self._selector_unregister(entry[1])
+
+    def _selector_unregister(self, fileobj):
+        if fileobj is None:
+            return
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    @staticmethod
+    def _events(want_write):
+        if want_write:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
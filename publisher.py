@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Code related to the publisher worker thread for the EDMC-Telemetry plugin."""
+
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+
+class Publisher:
+    """Runs the work handed over by EDMC's hooks on a dedicated worker thread.
+
+    EDMC calls the plugin's hooks on its Tk main thread, so they only capture their
+    arguments and queue them here; processing, serialization and publishing happen on
+    the worker.  The queue has a single producer (the main thread) and a single
+    consumer (the worker), so it relies on deque's atomic append() and popleft()
+    instead of a lock.  It is bounded: while the worker is more than `limit` entries
+    behind, new entries are dropped (and counted) rather than held in memory.
+
+    Work running on the worker can also schedule calls for later with call_at().
+    """
+
+    def __init__(self, logger: logging.Logger, limit: int) -> None:
+        """Create a stopped publisher with a queue of the specified size."""
+        self._logger = logger
+        self.limit = limit
+        self._queue: Deque[Tuple[Callable[..., Any], Tuple[Any, ...]]] = deque()
+        # (deadline, sequence, function, args) heap, only used by the worker thread
+        self._timers: List[Tuple[float, int, Callable[..., Any], Tuple[Any, ...]]] = []
+        self._sequence = 0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def start(self) -> None:
+        """Start the worker thread."""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="EDMC-Telemetry publisher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Process everything already queued, then stop the worker thread."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._logger.error("Timeout waiting for publisher to stop.")
+        self._thread = None
+
+    def put(
+        self, function: Callable[..., Any], *args: Any, force: bool = False
+    ) -> bool:
+        """Queue a call of function(*args) on the worker, without waiting for it.
+
+        Returns False if the queue is full and the call was dropped.  Calls queued with
+        force=True (e.g. connecting and disconnecting) are never dropped.
+        """
+        if not force and len(self._queue) >= self.limit:
+            self.dropped += 1
+            return False
+        self._queue.append((function, args))
+        self._wake.set()
+        return True
+
+    def call_at(
+        self, deadline: float, function: Callable[..., Any], *args: Any
+    ) -> None:
+        """Call function(*args) on the worker at the time.monotonic() deadline.
+
+        Must only be called on the worker thread (i.e. by queued work); calls that are
+        still scheduled when the publisher stops are discarded.
+        """
+        self._sequence += 1
+        heapq.heappush(self._timers, (deadline, self._sequence, function, args))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued so far has been processed."""
+        done = threading.Event()
+        return self.put(done.set) and done.wait(timeout)
+
+    def _run(self) -> None:
+        """Process queued calls in order until the publisher is stopped."""
+        reported = 0
+        while True:
+            timeout = None
+            if len(self._timers):
+                timeout = max(0.0, self._timers[0][0] - time.monotonic())
+            self._wake.wait(timeout)
+            self._wake.clear()
+            while len(self._queue):
+                function, args = self._queue.popleft()
+                self._call(function, args)
+            now = time.monotonic()
+            while len(self._timers) and self._timers[0][0] <= now:
+                _, _, function, args = heapq.heappop(self._timers)
+                self._call(function, args)
+            if self.dropped != reported:
+                self._logger.warning(
+                    f"Publisher queue full, {self.dropped - reported} entries dropped."
+                )
+                reported = self.dropped
+            if self._stopping:
+                self._timers.clear()
+                break
+
+    def _call(self, function: Callable[..., Any], args: Tuple[Any, ...]) -> None:
+        """Call function(*args), logging rather than raising any exception."""
+        try:
+            function(*args)
+        except Exception:
+            self._logger.exception("Unable to process telemetry.")
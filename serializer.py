@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Code related to JSON serialization of payloads for the EDMC-Telemetry plugin."""
+
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+try:
+    import orjson  # type: ignore (optional)
+except ImportError:
+    orjson = None
+
+try:
+    import ujson  # type: ignore (optional)
+except ImportError:
+    ujson = None
+
+Payload = Union[str, bytes]
+# (topic, payload, qos, retain)
+Message = Tuple[bytes, Payload, int, bool]
+
+
+def _default(obj: Any) -> Any:
+    """Convert objects that JSON can't represent natively (i.e. EDMC's Friends set)."""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_dumps(obj: Any) -> Payload:
+    """Encode using the standard library encoder."""
+    return json.dumps(obj, separators=(",", ":"), default=_default)
+
+
+def _orjson_dumps(obj: Any) -> Payload:
+    """Encode using orjson, falling back to the standard library if it can't cope."""
+    try:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # i.e. integers larger than 64 bits
+        return _json_dumps(obj)
+
+
+def _ujson_dumps(obj: Any) -> Payload:
+    """Encode using ujson, falling back to the standard library if it can't cope."""
+    try:
+        return ujson.dumps(
+            obj, ensure_ascii=False, escape_forward_slashes=False, default=_default
+        )
+    except (TypeError, OverflowError):
+        return _json_dumps(obj)
+
+
+# Available encoders, fastest first.
+BACKENDS: Dict[str, Callable[[Any], Payload]] = {}
+if orjson is not None:
+    BACKENDS["orjson"] = _orjson_dumps
+if ujson is not None:
+    BACKENDS["ujson"] = _ujson_dumps
+BACKENDS["json"] = _json_dumps
+
+
+class Serializer:
+    """Encodes payloads as compact JSON with the fastest available encoder.
+
+    orjson or ujson are used if they can be imported, otherwise the standard library
+    json module.  Depending on the encoder, payloads are either str or UTF-8 bytes;
+    both can be published as-is.
+    """
+
+    def __init__(self, backend: Optional[str] = None) -> None:
+        """Create a serializer using the specified (or the fastest) encoder."""
+        if backend is None:
+            backend = next(iter(BACKENDS))
+        elif backend not in BACKENDS:
+            raise ValueError(f"JSON encoder '{backend}' is not available.")
+        self.backend = backend
+        self._dumps = BACKENDS[backend]
+
+    @staticmethod
+    def available() -> List[str]:
+        """Return the names of the available encoders, fastest first."""
+        return list(BACKENDS)
+
+    def dumps(self, obj: Any) -> Payload:
+        """Encode the specified object."""
+        return self._dumps(obj)
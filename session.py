@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Code related to persisting the MQTT session for the EDMC-Telemetry plugin."""
+
+import logging
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+# (direction, mid, topic, payload, qos, retain, state)
+SessionMessage = Tuple[int, int, bytes, bytes, int, bool, int]
+
+# Every record is a header followed by a body.  A body starts with the operation,
+# direction and mid; put records continue with the message fields, topic and payload.
+_HEADER = struct.Struct("<II")  # body length, CRC-32 of body
+_KEY = struct.Struct("<BBH")  # operation, direction, mid
+_FIELDS = struct.Struct("<BB?H")  # state, qos, retain, topic length
+_PUT = 1
+_REMOVE = 2
+
+
+class SessionStore:
+    """Append-only, on-disk store for the QoS 1 and 2 messages of the MQTT session.
+
+    The MQTT client reports every message it adds, updates or removes, and the
+    changes are appended to the store's file as records.  Changes are only collected
+    in memory until the client calls commit(), which it does right before writing to
+    the network, so a single write and fsync covers everything published since the
+    last one (group commit).  The file is rewritten with just the messages that are
+    still in the session whenever it is opened, and whenever it grows past
+    COMPACT_SIZE.
+    """
+
+    COMPACT_SIZE = 1024 * 1024
+
+    def __init__(self, path: Path, logger: logging.Logger) -> None:
+        """Create a session store that keeps its records in the specified file."""
+        self._path = path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._file: Optional[BinaryIO] = None
+        # Body of the latest put record by (direction, mid)
+        self._messages: Dict[Tuple[int, int], bytes] = {}
+        self._pending = bytearray()
+
+    def open(self) -> None:
+        """Load the messages left by a previous session and compact the file."""
+        with self._lock:
+            if self._file is not None:
+                return
+            self._messages.clear()
+            if self._path.exists():
+                self._load(self._path.read_bytes())
+                if len(self._messages):
+                    self._logger.info(
+                        f"Found {len(self._messages)} message(s) in the MQTT session."
+                    )
+            try:
+                self._compact()
+            except OSError as e:
+                self._logger.error(f"Unable to compact MQTT session. {e}")
+                self._reopen()
+
+    def close(self) -> None:
+        """Commit any pending changes and close the file."""
+        self.commit()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._messages.clear()
+
+    def clear(self) -> None:
+        """Close the store and delete its file, discarding the session."""
+        self.close()
+        with self._lock:
+            self._path.unlink(missing_ok=True)
+
+    # MQTT client session store interface
+    def restore(self) -> List[SessionMessage]:
+        """Return the messages in the store."""
+        with self._lock:
+            return [self._unpack(body) for body in self._messages.values()]
+
+    def put(
+        self,
+        direction: int,
+        mid: int,
+        topic: bytes,
+        payload: bytes,
+        qos: int,
+        retain: bool,
+        state: int,
+    ) -> None:
+        """Add or replace a message."""
+        body = (
+            _KEY.pack(_PUT, direction, mid)
+            + _FIELDS.pack(state, qos, retain, len(topic))
+            + topic
+            + payload
+        )
+        with self._lock:
+            if self._file is None:
+                return
+            self._messages[(direction, mid)] = body
+            self._append(body)
+
+    def remove(self, direction: int, mid: int) -> None:
+        """Remove a message."""
+        with self._lock:
+            if self._file is None:
+                return
+            if self._messages.pop((direction, mid), None) is not None:
+                self._append(_KEY.pack(_REMOVE, direction, mid))
+
+    def commit(self) -> None:
+        """Write all pending changes to disk."""
+        with self._lock:
+            if self._file is None or not len(self._pending):
+                return
+            try:
+                self._file.write(self._pending)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                compact = self._file.tell() > SessionStore.COMPACT_SIZE
+            except OSError as e:
+                self._logger.error(f"Unable to save MQTT session. {e}")
+                compact = False
+            self._pending.clear()
+            if compact:
+                self._file.close()
+                self._file = None
+                try:
+                    self._compact()
+                except OSError as e:
+                    self._logger.error(f"Unable to compact MQTT session. {e}")
+                    self._reopen()
+
+    def _append(self, body: bytes) -> None:
+        """Add a record with the specified body to the pending changes."""
+        self._pending += _HEADER.pack(len(body), zlib.crc32(body))
+        self._pending += body
+
+    def _load(self, data: bytes) -> None:
+        """Replay the records in data, stopping at the first incomplete one."""
+        position = 0
+        while position + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, position)
+            start = position + _HEADER.size
+            body = data[start : start + length]
+            if length < _KEY.size or len(body) != length or zlib.crc32(body) != crc:
+                # the tail of a commit that was interrupted
+                self._logger.warning("Discarding incomplete MQTT session data.")
+                break
+            operation, direction, mid = _KEY.unpack_from(body)
+            if operation == _PUT:
+                self._messages[(direction, mid)] = body
+            else:
+                self._messages.pop((direction, mid), None)
+            position = start + length
+
+    def _compact(self) -> None:
+        """Replace the file with one holding only the messages in the session."""
+        records = bytearray()
+        for body in self._messages.values():
+            records += _HEADER.pack(len(body), zlib.crc32(body))
+            records += body
+        temp_path = self._path.with_suffix(".tmp")
+        with open(temp_path, mode="wb") as file:
+            file.write(records)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._path)
+        self._file = open(self._path, mode="ab")
+
+    def _reopen(self) -> None:
+        """Keep appending to the existing file, or stop saving if that fails too."""
+        try:
+            self._file = open(self._path, mode="ab")
+        except OSError as e:
+            self._logger.error(f"MQTT session will no longer be saved. {e}")
+
+    @staticmethod
+    def _unpack(body: bytes) -> SessionMessage:
+        """Return the message stored in the body of a put record."""
+        _, direction, mid = _KEY.unpack_from(body)
+        state, qos, retain, topic_length = _FIELDS.unpack_from(body, _KEY.size)
+        topic_start = _KEY.size + _FIELDS.size
+        payload_start = topic_start + topic_length
+        return (
+            direction,
+            mid,
+            body[topic_start:payload_start],
+            body[payload_start:],
+            qos,
+            retain,
+            state,
+        )
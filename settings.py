@@ -39,13 +39,22 @@ class Settings:
         "certfile": "",
         "keyfile": "",
         "tls_insecure": False,
+        "topic_aliases": False,
+        "persistent_session": False,
         "dashboard": True,
         "dashboard_format": "Processed",
         "journal": True,
         "journal_format": "Processed",
         "location": True,
+        "retain_latest": False,
         "state": False,
+        "state_format": "Full",
         "lowercase_topics": False,
+        "spool": False,
+        "spool_limit": 64,
+        "spool_rate": 20,
+        "throttles": {},
+        "brokers": [],
         "topics": {
             "root": "Telemetry",
             "gamerunning": "GameRunning",
@@ -63,6 +72,8 @@ class Settings:
             "fuel": "Fuel",
             "fuelreservoir": "Reservoir",
             "fuelmain": "Main",
+            "packed": "Packed",
+            "schema": "Schema",
         },
     }
 
@@ -198,6 +209,26 @@ class Settings:
         self._options["tls_insecure"] = new_value
         self._tls_insecure_tk.set(new_value)
 
+    @property
+    def topic_aliases(self) -> bool:
+        """Connect using MQTT v5 and use topic aliases to shorten published topics."""
+        return self._options["topic_aliases"]
+
+    @topic_aliases.setter
+    def topic_aliases(self, new_value: bool) -> None:
+        self._options["topic_aliases"] = new_value
+        self._topic_aliases_tk.set(new_value)
+
+    @property
+    def persistent_session(self) -> bool:
+        """Keep the MQTT session (and unacknowledged messages) across restarts."""
+        return self._options["persistent_session"]
+
+    @persistent_session.setter
+    def persistent_session(self, new_value: bool) -> None:
+        self._options["persistent_session"] = new_value
+        self._persistent_session_tk.set(new_value)
+
     @property
     def root_topic(self) -> str:
         """Root MQTT topic that all other topics will be published under."""
@@ -258,6 +289,16 @@ class Settings:
         self._options["location"] = new_value
         self._location_tk.set(new_value)
 
+    @property
+    def retain_latest(self) -> bool:
+        """Publish dashboard and location telemetry as retained messages."""
+        return self._options["retain_latest"]
+
+    @retain_latest.setter
+    def retain_latest(self, new_value: bool) -> None:
+        self._options["retain_latest"] = new_value
+        self._retain_latest_tk.set(new_value)
+
     @property
     def state(self) -> bool:
         """Enable/disable publishing of EDMC-generated state telemetry."""
@@ -268,6 +309,16 @@ class Settings:
         self._options["state"] = new_value
         self._state_tk.set(new_value)
 
+    @property
+    def state_format(self) -> str:
+        """Format of published EDMC-generated state telemetry."""
+        return self._options["state_format"]
+
+    @state_format.setter
+    def state_format(self, new_value: str) -> None:
+        self._options["state_format"] = new_value
+        self._state_format_tk.set(new_value)
+
     @property
     def lowercase_topics(self) -> bool:
         """Enable/disable forcing of all topics to lowercase."""
@@ -278,6 +329,46 @@ class Settings:
         self._options["lowercase_topics"] = new_value
         self._lowercase_topics_tk.set(new_value)
 
+    @property
+    def spool(self) -> bool:
+        """Enable/disable spooling of journal telemetry to disk while offline."""
+        return self._options["spool"]
+
+    @spool.setter
+    def spool(self, new_value: bool) -> None:
+        self._options["spool"] = new_value
+        self._spool_tk.set(new_value)
+
+    @property
+    def spool_limit(self) -> int:
+        """Maximum disk space used by spooled telemetry, in megabytes."""
+        return self._options["spool_limit"]
+
+    @spool_limit.setter
+    def spool_limit(self, new_value: int) -> None:
+        self._options["spool_limit"] = new_value
+        self._spool_limit_tk.set(new_value)
+
+    @property
+    def spool_rate(self) -> int:
+        """Rate at which spooled telemetry is replayed, in messages per second."""
+        return self._options["spool_rate"]
+
+    @spool_rate.setter
+    def spool_rate(self, new_value: int) -> None:
+        self._options["spool_rate"] = new_value
+        self._spool_rate_tk.set(new_value)
+
+    @property
+    def throttles(self) -> dict[str, dict[str, float]]:
+        """Interval/deadband limits by MQTT topic filter (only set in settings file)."""
+        return self._options["throttles"]
+
+    @property
+    def brokers(self) -> list[dict[str, Any]]:
+        """Additional MQTT brokers to publish to (only set in settings file)."""
+        return self._options["brokers"]
+
     # This one isn't a 'property' but is grouped with the other properties because it is
     # used like a getter.
     def topic(self, requested_topic: str) -> str:
@@ -293,6 +384,7 @@ class Settings:
         self._version = telemetry_version
         self._logger = logger
         self._options = {}
+        self.topics_modified = False
         self._load()
 
     def _load(self) -> None:
@@ -331,14 +423,21 @@ class Settings:
         self._certfile_tk = tk.StringVar(value=self.certfile)
         self._keyfile_tk = tk.StringVar(value=self.keyfile)
         self._tls_insecure_tk = tk.BooleanVar(value=self.tls_insecure)
+        self._topic_aliases_tk = tk.BooleanVar(value=self.topic_aliases)
+        self._persistent_session_tk = tk.BooleanVar(value=self.persistent_session)
         self._dashboard_tk = tk.BooleanVar(value=self.dashboard)
         self._dashboard_format_tk = tk.StringVar(value=self.dashboard_format)
         self._journal_tk = tk.BooleanVar(value=self.journal)
         self._journal_format_tk = tk.StringVar(value=self.journal_format)
         self._location_tk = tk.BooleanVar(value=self.location)
+        self._retain_latest_tk = tk.BooleanVar(value=self.retain_latest)
         self._state_tk = tk.BooleanVar(value=self.state)
+        self._state_format_tk = tk.StringVar(value=self.state_format)
         self._root_topic_tk = tk.StringVar(value=self.root_topic)
         self._lowercase_topics_tk = tk.BooleanVar(value=self.lowercase_topics)
+        self._spool_tk = tk.BooleanVar(value=self.spool)
+        self._spool_limit_tk = tk.IntVar(value=self.spool_limit)
+        self._spool_rate_tk = tk.IntVar(value=self.spool_rate)
 
     def _save(self, is_backup: bool = False) -> None:
         """Write telemetry settings to a file."""
@@ -463,6 +562,24 @@ class Settings:
             padx=PADX, pady=PADY, row=row, column=1, sticky=tk.EW
         )
 
+        # mqtt v5 topic aliases
+        row += 1
+        nb.Checkbutton(
+            tnb_comm,
+            text="Use MQTT v5 Topic Aliases",
+            variable=self._topic_aliases_tk,
+            command="",
+        ).grid(padx=PADX, row=row, column=1, sticky=tk.W)
+
+        # persistent session
+        row += 1
+        nb.Checkbutton(
+            tnb_comm,
+            text="Persistent Session",
+            variable=self._persistent_session_tk,
+            command="",
+        ).grid(padx=PADX, row=row, column=1, sticky=tk.W)
+
         # broker auth settings
         row += 1
         ttk.Separator(tnb_comm, orient=tk.HORIZONTAL).grid(
@@ -573,6 +690,7 @@ class Settings:
             self._dashboard_format_tk.get(),
             "Raw",
             "Processed",
+            "Packed",
         ).grid(padx=PADX, pady=PADY, row=row, column=1, sticky=tk.W)
 
         # journal
@@ -600,6 +718,15 @@ class Settings:
             command="",
         ).grid(padx=PADX, row=row, sticky=tk.W)
 
+        # retain dashboard and location
+        row += 1
+        nb.Checkbutton(
+            tnb_data,
+            text="Retain Latest Dashboard/Location",
+            variable=self._retain_latest_tk,
+            command="",
+        ).grid(padx=PADX, row=row, sticky=tk.W)
+
         # state
         row += 1
         nb.Checkbutton(
@@ -608,6 +735,41 @@ class Settings:
             variable=self._state_tk,
             command="",
         ).grid(padx=PADX, row=row, sticky=tk.W)
+        nb.OptionMenu(
+            tnb_data,
+            self._state_format_tk,
+            self._state_format_tk.get(),
+            "Full",
+            "Keys",
+            "Patch",
+        ).grid(padx=PADX, pady=PADY, row=row, column=1, sticky=tk.W)
+
+        # spool
+        row += 1
+        nb.Checkbutton(
+            tnb_data,
+            text="Spool Journal While Offline",
+            variable=self._spool_tk,
+            command="",
+        ).grid(padx=PADX, row=row, sticky=tk.W)
+
+        # spool size limit
+        row += 1
+        nb.Label(tnb_data, text="Spool Size Limit (MB)").grid(
+            padx=PADX, row=row, sticky=tk.W
+        )
+        nb.Entry(tnb_data, textvariable=self._spool_limit_tk).grid(
+            padx=PADX, pady=PADY, row=row, column=1, sticky=tk.EW
+        )
+
+        # spool replay rate
+        row += 1
+        nb.Label(tnb_data, text="Spool Replay Rate (msgs/sec)").grid(
+            padx=PADX, row=row, sticky=tk.W
+        )
+        nb.Entry(tnb_data, textvariable=self._spool_rate_tk).grid(
+            padx=PADX, pady=PADY, row=row, column=1, sticky=tk.EW
+        )
 
         # add the preferences tabs we've created to our assigned EDMC settings tab
         tnb.add(tnb_comm, text="Connection")
@@ -688,6 +850,20 @@ class Settings:
             self.tls_insecure = self._tls_insecure_tk.get()
             reset_connection = True
 
+        if self.topic_aliases != self._topic_aliases_tk.get():
+            self.topic_aliases = self._topic_aliases_tk.get()
+            reset_connection = True
+
+        if self.persistent_session != self._persistent_session_tk.get():
+            self.persistent_session = self._persistent_session_tk.get()
+            reset_connection = True
+
+        # Cached topics must be rebuilt if any of these settings changed.
+        self.topics_modified = (
+            self.root_topic != self._root_topic_tk.get()
+            or self.lowercase_topics != self._lowercase_topics_tk.get()
+        )
+
         # The rest of these options can be adjusted on-the-fly while connected.
         self.root_topic = self._root_topic_tk.get()
         self.lowercase_topics = self._lowercase_topics_tk.get()
@@ -697,7 +873,12 @@ class Settings:
         self.journal = self._journal_tk.get()
         self.journal_format = self._journal_format_tk.get()
         self.location = self._location_tk.get()
+        self.retain_latest = self._retain_latest_tk.get()
         self.state = self._state_tk.get()
+        self.state_format = self._state_format_tk.get()
+        self.spool = self._spool_tk.get()
+        self.spool_limit = self._spool_limit_tk.get()
+        self.spool_rate = self._spool_rate_tk.get()
 
         self._save()
 
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Code related to spooling of messages to disk for the EDMC-Telemetry plugin."""
+
+import logging
+import mmap
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from serializer import Message
+from settings import Settings
+
+# Every record is a header followed by a body containing the message fields, topic
+# and payload.  Unused space at the end of a segment is zero-filled, and a zero
+# length marks the end of the records in a segment.
+_HEADER = struct.Struct("<II")  # body length, CRC-32 of body
+_FIELDS = struct.Struct("<HB?")  # topic length, qos, retain
+_CURSOR = struct.Struct("<QQ")  # segment number, read offset
+
+
+class Spool:
+    """Append-only, on-disk queue for messages that can't be sent to the broker yet.
+
+    Records are written to memory-mapped segment files of a fixed size, and a new
+    segment is started whenever the current one fills up.  If the total size of the
+    segments exceeds the configured limit, the oldest segment is discarded.  Records
+    are read back in the order they were written, but are only removed once the
+    reader acknowledges them (i.e. after they have been delivered); until then,
+    rewind() makes them readable again.  Segments are deleted as soon as all of
+    their records have been removed, and the position of the first record that
+    hasn't been removed is saved by compact() so that replay can resume where it
+    left off after a restart.
+    """
+
+    SEGMENT_SIZE = 1024 * 1024
+
+    def __init__(
+        self, folder: Path, settings: Settings, logger: logging.Logger
+    ) -> None:
+        """Create a spool that keeps its segment files in the specified folder."""
+        self._folder = folder
+        self._settings = settings
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._open = False
+        self._maps: Dict[int, mmap.mmap] = {}
+        # Segment numbers in the order they were written; writing takes place in the
+        # segment created by this session.
+        self._segments: List[int] = []
+        # Offset of the first record in the first segment that hasn't been removed
+        self._ack_pos = 0
+        # Index (in _segments) and offset of the next record to be read
+        self._read_index = 0
+        self._read_pos = 0
+        self._write_segment: Optional[int] = None
+        self._write_pos = 0
+
+    @property
+    def pending(self) -> bool:
+        """True if there are spooled messages that have not been removed yet."""
+        with self._lock:
+            return self._pending()
+
+    def open(self) -> None:
+        """Pick up any segments (and the read position) left by a previous session."""
+        with self._lock:
+            if self._open:
+                return
+            self._open = True
+            if self._folder.exists():
+                self._segments = sorted(
+                    int(path.stem)
+                    for path in self._folder.glob("*.spool")
+                    if path.stem.isdigit()
+                )
+            cursor_file = self._folder / "cursor"
+            if len(self._segments) and cursor_file.exists():
+                segment, position = _CURSOR.unpack(cursor_file.read_bytes())
+                if segment == self._segments[0]:
+                    self._ack_pos = self._read_pos = position
+            if len(self._segments):
+                self._logger.info(
+                    f"Found {len(self._segments)} spool segment(s) to be replayed."
+                )
+
+    def close(self) -> None:
+        """Compact the spool and release all of its segment files."""
+        self.compact()
+        with self._lock:
+            for spool_map in self._maps.values():
+                spool_map.flush()
+                spool_map.close()
+            self._maps.clear()
+            self._segments.clear()
+            self._write_segment = None
+            self._ack_pos = self._read_index = self._read_pos = self._write_pos = 0
+            self._open = False
+
+    def append(self, messages: Iterable[Message], only_if_pending=False) -> bool:
+        """Write the specified messages to the end of the spool.
+
+        If only_if_pending is True the messages are only written if the spool still
+        holds messages that haven't been removed, so that they aren't sent ahead of
+        older messages.  Returns True if the messages were written.
+        """
+        with self._lock:
+            if not self._open:
+                return False
+            if only_if_pending and not self._pending():
+                return False
+            for topic, payload, qos, retain in messages:
+                if isinstance(payload, str):
+                    payload = payload.encode("utf-8")
+                self._write(_FIELDS.pack(len(topic), qos, retain) + topic + payload)
+            return True
+
+    def read(self, count: int) -> List[Message]:
+        """Return up to the specified number of messages following those already read.
+
+        The messages stay in the spool until acknowledge() is called.
+        """
+        messages = []
+        with self._lock:
+            while self._open and len(messages) < count:
+                body = self._next_record(consume=True)
+                if body is None:
+                    break
+                topic_length, qos, retain = _FIELDS.unpack_from(body)
+                payload_start = _FIELDS.size + topic_length
+                messages.append(
+                    (
+                        body[_FIELDS.size : payload_start],
+                        body[payload_start:],
+                        qos,
+                        retain,
+                    )
+                )
+        return messages
+
+    def acknowledge(self) -> None:
+        """Remove all of the messages that have been read so far."""
+        with self._lock:
+            while self._read_index > 0:
+                self._drop(self._segments[0])
+            self._ack_pos = self._read_pos
+
+    def rewind(self) -> None:
+        """Make the messages that have been read, but not removed, readable again."""
+        with self._lock:
+            self._read_index = 0
+            self._read_pos = self._ack_pos
+
+    def compact(self) -> None:
+        """Reclaim disk space used by messages that have been removed.
+
+        Segments are already deleted by acknowledge() once all of their messages have
+        been removed; this also deletes the current segment once the spool is empty,
+        and saves the position of the first message that hasn't been removed.
+        """
+        with self._lock:
+            if not self._open:
+                return
+            if not self._pending():
+                for segment in list(self._segments):
+                    self._drop(segment)
+            cursor_file = self._folder / "cursor"
+            if len(self._segments):
+                cursor_file.write_bytes(_CURSOR.pack(self._segments[0], self._ack_pos))
+            elif cursor_file.exists():
+                cursor_file.unlink()
+
+    def _path(self, segment: int) -> Path:
+        """Return the path of the file for the specified segment."""
+        return self._folder / f"{segment:08d}.spool"
+
+    def _map(self, segment: int) -> mmap.mmap:
+        """Return the memory map for the specified segment, mapping it if needed."""
+        try:
+            return self._maps[segment]
+        except KeyError:
+            with open(self._path(segment), mode="r+b") as file:
+                spool_map = self._maps[segment] = mmap.mmap(file.fileno(), 0)
+            return spool_map
+
+    def _drop(self, segment: int) -> None:
+        """Delete the specified segment."""
+        spool_map = self._maps.pop(segment, None)
+        if spool_map is not None:
+            spool_map.close()
+        self._path(segment).unlink(missing_ok=True)
+        index = self._segments.index(segment)
+        if index == 0:
+            self._ack_pos = 0
+        if index < self._read_index:
+            self._read_index -= 1
+        elif index == self._read_index:
+            self._read_pos = 0
+        self._segments.remove(segment)
+        if segment == self._write_segment:
+            self._write_segment = None
+            self._write_pos = 0
+
+    def _pending(self) -> bool:
+        """Return True if there are records that haven't been removed."""
+        if self._read_index > 0 or self._read_pos != self._ack_pos:
+            return True
+        return self._next_record(consume=False) is not None
+
+    def _next_record(self, consume: bool) -> Optional[bytes]:
+        """Return the body of the next unread record, or None if there isn't one.
+
+        Reading moves on to the next segment once a segment contains no more (valid)
+        records; a segment with no records left to remove is dropped along the way.
+        """
+        while self._read_index < len(self._segments):
+            segment = self._segments[self._read_index]
+            try:
+                buffer = self._map(segment)
+            except (OSError, ValueError):
+                # missing or empty segment file (i.e. from an interrupted session)
+                buffer = b""
+            if segment == self._write_segment:
+                end = self._write_pos
+            else:
+                end = len(buffer)
+
+            start = self._read_pos + _HEADER.size
+            if start <= end:
+                length, crc = _HEADER.unpack_from(buffer, self._read_pos)
+                if length and start + length <= end:
+                    body = buffer[start : start + length]
+                    if zlib.crc32(body) == crc:
+                        if consume:
+                            self._read_pos = start + length
+                        return body
+                    self._logger.warning(
+                        f"Discarding corrupt data in spool segment {segment}."
+                    )
+
+            if segment == self._write_segment:
+                return None
+            if self._read_index == 0 and self._read_pos == self._ack_pos:
+                self._drop(segment)
+            else:
+                self._read_index += 1
+                self._read_pos = 0
+
+        return None
+
+    def _write(self, body: bytes) -> None:
+        """Append a record with the specified body, starting a new segment if needed."""
+        size = _HEADER.size + len(body)
+        if self._write_segment is None:
+            self._rotate(size)
+        elif self._write_pos + size > len(self._maps[self._write_segment]):
+            self._rotate(size)
+
+        buffer = self._maps[self._write_segment]
+        _HEADER.pack_into(buffer, self._write_pos, len(body), zlib.crc32(body))
+        start = self._write_pos + _HEADER.size
+        buffer[start : start + len(body)] = body
+        self._write_pos += size
+
+    def _rotate(self, size: int) -> None:
+        """Start a new segment big enough for a record of the specified size."""
+        if self._write_segment is not None:
+            self._maps[self._write_segment].flush()
+
+        segment = self._segments[-1] + 1 if len(self._segments) else 1
+        self._folder.mkdir(parents=True, exist_ok=True)
+        with open(self._path(segment), mode="wb") as file:
+            file.truncate(max(Spool.SEGMENT_SIZE, size))
+        self._segments.append(segment)
+        self._write_segment = segment
+        self._write_pos = 0
+        self._map(segment)
+
+        # Make room for the new segment by discarding the oldest ones.
+        limit = self._settings.spool_limit * 1024 * 1024
+        while len(self._segments) > 1 and self._size() > limit:
+            self._logger.warning(
+                "Spool size limit reached, discarding the oldest spooled messages."
+            )
+            self._drop(self._segments[0])
+
+    def _size(self) -> int:
+        """Return the total size of all segment files."""
+        return sum(self._path(segment).stat().st_size for segment in self._segments)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Code related to tracking changes in EDMC's state for the EDMC-Telemetry plugin."""
+
+from itertools import chain
+from typing import Any, Dict, List, Optional, Tuple
+
+from serializer import Payload, Serializer
+
+# Journal events (lowercase) that EDMC handles by updating each of its (container)
+# state entries.  Containers are only serialized and hashed when one of their events
+# is seen, or when EDMC has replaced or resized them; containers that aren't listed
+# here are checked after every journal entry.
+STATE_KEY_EVENTS: Dict[str, Tuple[str, ...]] = {
+    "Cargo": (
+        "buydrones",
+        "cargo",
+        "cargotransfer",
+        "collectcargo",
+        "ejectcargo",
+        "engineercontribution",
+        "launchdrone",
+        "marketbuy",
+        "marketsell",
+        "miningrefined",
+        "missionabandoned",
+        "missioncompleted",
+        "missionfailed",
+        "powerplaycollect",
+        "powerplaydeliver",
+        "searchandrescue",
+        "selldrones",
+    ),
+    "CargoJSON": ("cargo",),
+    "Raw": (
+        "engineercontribution",
+        "engineercraft",
+        "engineerlegacyconvert",
+        "materialcollected",
+        "materialdiscarded",
+        "materials",
+        "materialtrade",
+        "missioncompleted",
+        "scientificresearch",
+        "synthesis",
+        "technologybroker",
+    ),
+    "Modules": (
+        "loadout",
+        "massmodulestore",
+        "modulebuy",
+        "moduleretrieve",
+        "modulesell",
+        "modulesellremote",
+        "modulestore",
+        "moduleswap",
+        "shipyardbuy",
+        "shipyardnew",
+        "shipyardswap",
+    ),
+    "ModuleInfo": ("moduleinfo",),
+    "Engineers": ("engineerprogress",),
+    "Rank": ("progress", "promotion", "rank"),
+    "Reputation": ("reputation",),
+    "Statistics": ("statistics",),
+    "Friends": ("friends",),
+    "NavRoute": ("navroute", "navrouteclear"),
+    "Component": (
+        "backpackchange",
+        "buymicroresources",
+        "collectitems",
+        "deliverpowermicroresources",
+        "dropitems",
+        "engineercontribution",
+        "missioncompleted",
+        "requestpowermicroresources",
+        "sellmicroresources",
+        "shiplocker",
+        "trademicroresources",
+        "transfermicroresources",
+        "useconsumable",
+    ),
+    "ShipLockerJSON": ("shiplocker",),
+    "BackPack": (
+        "backpack",
+        "backpackchange",
+        "buymicroresources",
+        "collectitems",
+        "dropitems",
+        "transfermicroresources",
+        "useconsumable",
+    ),
+    "BackpackJSON": ("backpack",),
+    "SuitLoadouts": (
+        "buysuit",
+        "buyweapon",
+        "createsuitloadout",
+        "deletesuitloadout",
+        "loadoutequipmodule",
+        "loadoutremovemodule",
+        "renamesuitloadout",
+        "sellsuit",
+        "sellweapon",
+        "suitloadout",
+        "switchsuitloadout",
+        "upgradesuit",
+        "upgradeweapon",
+    ),
+}
+# Materials, micro-resources and suits are each tracked in several containers that
+# are updated together.
+STATE_KEY_EVENTS.update(
+    {key: STATE_KEY_EVENTS["Raw"] for key in ("Manufactured", "Encoded")}
+)
+STATE_KEY_EVENTS.update(
+    {key: STATE_KEY_EVENTS["Component"] for key in ("Item", "Consumable", "Data")}
+)
+STATE_KEY_EVENTS.update(
+    {
+        key: STATE_KEY_EVENTS["SuitLoadouts"]
+        for key in ("Suits", "SuitCurrent", "SuitLoadoutCurrent")
+    }
+)
+
+# Events after which every state entry is checked.
+RESYNC_EVENTS = (
+    "commander",
+    "died",
+    "loadgame",
+    "newcommander",
+    "resurrect",
+    "startup",
+)
+
+CONTAINERS = (dict, list, set, frozenset, tuple)
+
+
+class StateTracker:
+    """Works out which top-level entries of EDMC's state changed since last time.
+
+    Scalar entries are compared directly.  Container entries (i.e. Cargo, Modules,
+    Materials) are compared using a hash of their serialized value, which is only
+    recalculated when a journal event that could have changed them is seen.
+    """
+
+    def __init__(self, serializer: Serializer) -> None:
+        """Create a tracker that serializes values with the specified serializer."""
+        self._serializer = serializer
+        self._events: Dict[str, frozenset] = {}
+        for key, events in STATE_KEY_EVENTS.items():
+            for event in events:
+                self._events[event] = self._events.get(event, frozenset()) | {key}
+        self._scalars: Dict[str, Any] = {}
+        # (id, length, hash of serialized value) of each container entry
+        self._containers: Dict[str, Tuple[int, int, int]] = {}
+        # the above as they were before the last update(), for revert()
+        self._previous: Optional[Tuple[Dict[str, Any], Dict[str, Any]]] = None
+        self._reset = False
+        self._resync = False
+
+    def reset(self) -> None:
+        """Forget the previous state, so that all entries are reported as changed.
+
+        May be called from any thread; the previous state is only forgotten by the
+        next update(), on the thread that calls it.
+        """
+        self._reset = True
+
+    def update(
+        self, state: Dict[str, Any], event: str
+    ) -> Tuple[Dict[str, Payload], List[str]]:
+        """Compare the state with the previous state, after the specified event.
+
+        Returns a dictionary of the serialized values of the entries that changed (or
+        were added), and a list of the keys of entries that were removed.
+        """
+        if self._reset:
+            self._reset = False
+            self._scalars.clear()
+            self._containers.clear()
+        self._previous = (dict(self._scalars), dict(self._containers))
+
+        resync = self._resync or event in RESYNC_EVENTS
+        self._resync = False
+        touched = self._events.get(event, ())
+        changed: Dict[str, Payload] = {}
+
+        for key, value in state.items():
+            if isinstance(value, CONTAINERS):
+                previous = self._containers.get(key)
+                if (
+                    previous is not None
+                    and not resync
+                    and key in STATE_KEY_EVENTS
+                    and key not in touched
+                    and previous[0] == id(value)
+                    and previous[1] == len(value)
+                ):
+                    continue
+                payload = self._serializer.dumps(value)
+                digest = hash(payload)
+                if previous is None or previous[2] != digest:
+                    changed[key] = payload
+                self._containers[key] = (id(value), len(value), digest)
+                self._scalars.pop(key, None)
+            else:
+                if (
+                    key in self._scalars
+                    and type(self._scalars[key]) is type(value)
+                    and self._scalars[key] == value
+                ):
+                    continue
+                changed[key] = self._serializer.dumps(value)
+                self._scalars[key] = value
+                self._containers.pop(key, None)
+
+        removed = [
+            key for key in chain(self._scalars, self._containers) if key not in state
+        ]
+        for key in removed:
+            self._scalars.pop(key, None)
+            self._containers.pop(key, None)
+
+        return changed, removed
+
+    def revert(self) -> None:
+        """Undo the last update(), so that its changes are reported again by the next.
+
+        Used when the changes could not be published.  Every entry is checked by the
+        next update(), as the containers that changed may not be touched by its event.
+        Must be called on the thread that calls update().
+        """
+        if self._previous is not None:
+            self._scalars, self._containers = self._previous
+            self._previous = None
+        self._resync = True
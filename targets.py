@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Code related to publishing to additional brokers for the EDMC-Telemetry plugin."""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List
+
+import paho.mqtt.client as mqtt_client
+from paho.mqtt.selectorloop import SelectorLoop
+from serializer import Message
+
+
+class Target:
+    """An additional MQTT broker that receives a copy of the published telemetry.
+
+    Each target has its own MQTT client, QoS level, topic filters and queue; the
+    clients of all targets are driven by one shared SelectorLoop.  Messages are held
+    in the queue until the client has nothing left to write, then handed to it as
+    one batch, so a slow broker only ever delays its own messages.  The queue is
+    bounded: when it is full, the oldest messages are discarded.  Payloads are
+    shared with the other targets rather than copied.
+    """
+
+    # Options that aren't given for a target.
+    DEFAULT: Dict[str, Any] = {
+        "broker": "127.0.0.1",
+        "port": 1883,
+        "keepalive": 60,
+        "qos": 0,
+        "username": "",
+        "password": "",
+        "client_id": "",
+        "encryption": False,
+        "ca_certs": "",
+        "certfile": "",
+        "keyfile": "",
+        "tls_insecure": False,
+        "topics": [],
+        "queue_limit": 1000,
+    }
+
+    def __init__(
+        self,
+        options: Dict[str, Any],
+        feedactive: bytes,
+        loop: SelectorLoop,
+        logger: logging.Logger,
+    ) -> None:
+        """Create a disconnected target for the specified broker options."""
+        self._options = {**Target.DEFAULT, **options}
+        self._feedactive = feedactive
+        self._loop = loop
+        self._logger = logger
+        self.name = f"{self._options['broker']}:{self._options['port']}"
+        if not isinstance(self._options["topics"], list):
+            raise ValueError("'topics' must be a list of topic filters.")
+        self._filters: List[str] = self._options["topics"]
+        self._qos = int(self._options["qos"])
+        self._limit = int(self._options["queue_limit"])
+        # True/False by topic, depending on whether it matches one of the filters
+        self._matches: Dict[bytes, bool] = {}
+        self._lock = threading.Lock()
+        self._sending = threading.Lock()
+        self._queue: Deque[Message] = deque()
+        self._connected = False
+        self._disconnected = threading.Event()
+        self.dropped = 0
+        self._mqtt = mqtt_client.Client(client_id=self._options["client_id"])
+
+    def connect(self) -> None:
+        """Start connecting to the broker; the client reconnects if it loses it."""
+        self._mqtt.on_connect = self._on_connect
+        self._mqtt.on_disconnect = self._on_disconnect
+        self._mqtt.on_socket_unregister_write = self._on_socket_unregister_write
+        self._mqtt.max_queued_messages_set(self._limit)
+        if len(self._options["username"]):
+            self._mqtt.username_pw_set(
+                self._options["username"], self._options["password"]
+            )
+        self._mqtt.will_set(self._feedactive, payload="False", qos=0, retain=True)
+        if self._options["encryption"]:
+            self._mqtt.tls_set(
+                ca_certs=self._options["ca_certs"] or None,
+                certfile=self._options["certfile"] or None,
+                keyfile=self._options["keyfile"] or None,
+            )
+            self._mqtt.tls_insecure_set(self._options["tls_insecure"])
+        self._mqtt.connect_async(
+            self._options["broker"], self._options["port"], self._options["keepalive"]
+        )
+        self._loop.add_client(self._mqtt)
+
+    def disconnect(self, deadline: float) -> None:
+        """Disconnect from the broker, waiting until the time.monotonic() deadline."""
+        if self._connected:
+            self._disconnected.clear()
+            self._mqtt.publish(self._feedactive, payload="False", retain=True)
+            self._mqtt.disconnect()
+            if not self._disconnected.wait(max(0.0, deadline - time.monotonic())):
+                self._logger.error(f"Timeout waiting for {self.name} to disconnect.")
+        else:
+            # stops any further connection attempts
+            self._mqtt.disconnect()
+        self._loop.remove_client(self._mqtt)
+        with self._lock:
+            self._queue.clear()
+
+    def put(self, messages: Iterable[Message]) -> None:
+        """Queue the messages that match the target's topic filters, then send them."""
+        with self._lock:
+            for topic, payload, _, retain in messages:
+                if self._match(topic):
+                    self._queue.append((topic, payload, self._qos, retain))
+            overflow = len(self._queue) - self._limit
+            if overflow > 0:
+                if not self.dropped:
+                    self._logger.warning(
+                        f"Queue for {self.name} is full, discarding old messages."
+                    )
+                self.dropped += overflow
+                for _ in range(overflow):
+                    self._queue.popleft()
+        self._flush()
+
+    def _flush(self) -> None:
+        """Send the queued messages as one batch if the client has nothing to write."""
+        # publish_many() can call back into _on_socket_unregister_write(), so it must
+        # be called without holding _lock; _sending keeps batches in order, and
+        # whoever holds it sends what is queued.  A flush that finds _sending taken
+        # gives up, so the holder checks again after releasing it, in case the
+        # client became writable (or more was queued) in the meantime.
+        while self._sending.acquire(blocking=False):
+            try:
+                with self._lock:
+                    batch = list(self._queue) if self._ready() else None
+                    if batch is not None:
+                        self._queue.clear()
+                        self.dropped = 0
+                if batch is not None:
+                    self._mqtt.publish_many(batch)
+            finally:
+                self._sending.release()
+            if not self._ready():
+                return
+
+    def _ready(self) -> bool:
+        """Return True if there is something to send and the client can take it."""
+        return self._connected and len(self._queue) > 0 and not self._mqtt.want_write()
+
+    def _match(self, topic: bytes) -> bool:
+        """Return True if the topic matches one of the filters (or there are none)."""
+        try:
+            return self._matches[topic]
+        except KeyError:
+            decoded = topic.decode("utf-8")
+            match = not len(self._filters) or any(
+                mqtt_client.topic_matches_sub(topic_filter, decoded)
+                for topic_filter in self._filters
+            )
+            self._matches[topic] = match
+            return match
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None) -> None:
+        """Announce the feed and send whatever was queued while offline."""
+        if rc != 0:
+            return
+        if not self._connected:
+            self._logger.info(f"Connected to MQTT Broker {self.name}")
+        self._connected = True
+        self._mqtt.publish(self._feedactive, payload="True", retain=True)
+        self._flush()
+
+    def _on_disconnect(self, client, userdata, rc, properties=None) -> None:
+        """Keep queueing (up to the limit) until the connection is re-established."""
+        if self._connected:
+            self._logger.info(f"Disconnected from MQTT Broker {self.name}")
+        self._connected = False
+        self._disconnected.set()
+
+    def _on_socket_unregister_write(self, client, userdata, sock) -> None:
+        """Send the next batch once everything before it has been written."""
+        self._flush()
+
+
+def create_targets(
+    brokers: List[Dict[str, Any]],
+    feedactive: bytes,
+    loop: SelectorLoop,
+    logger: logging.Logger,
+) -> List[Target]:
+    """Return a target, driven by loop, for each valid entry in the broker options."""
+    targets = []
+    for index, options in enumerate(brokers):
+        try:
+            targets.append(Target(options, feedactive, loop, logger))
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid broker #{index + 1}. {e}")
+    return targets
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Shared fixtures for the EDMC-Telemetry tests.
+
+The vendored paho client is driven by hand (without its network thread) over one
+end of a socket pair, while the test plays the broker on the other end.
+"""
+
+import errno
+import socket
+import struct
+import sys
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import paho.mqtt.client as mqtt_client  # noqa: E402
+
+
+class LimitedSocket:
+    """Wraps a socket, writing at most `limit` bytes per call.
+
+    Once `budget` bytes have been written, writes fail as if the socket buffer was
+    full until the budget is raised (None means no limit).  Every write call is
+    recorded in `writes` as the bytes that were offered.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self._sock = sock
+        self.limit: Optional[int] = None
+        self.budget: Optional[int] = None
+        self.writes: List[bytes] = []
+
+    def __getattr__(self, name: str):
+        return getattr(self._sock, name)
+
+    def send(self, data) -> int:
+        return self._write(bytes(data))
+
+    def sendmsg(self, buffers) -> int:
+        return self._write(b"".join(bytes(buffer) for buffer in buffers))
+
+    def _write(self, data: bytes) -> int:
+        self.writes.append(data)
+        if self.budget == 0:
+            raise BlockingIOError(errno.EAGAIN, "Resource temporarily unavailable")
+        if self.limit is not None:
+            data = data[: self.limit]
+        if self.budget is not None:
+            data = data[: self.budget]
+        written = self._sock.send(data)
+        if self.budget is not None:
+            self.budget -= written
+        return written
+
+
+class Peer:
+    """The broker end of the socket pair, which reads and writes raw packets."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.sock.settimeout(5.0)
+
+    def read_packet(self) -> Tuple[int, bytes]:
+        """Return the (first byte, body) of the next packet sent by the client."""
+        header = self._read(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self._read(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self._read(length)
+
+    def read_publish(self, version: int = mqtt_client.MQTTv311):
+        """Read a PUBLISH packet, returning (header, topic, mid, properties, payload).
+
+        For MQTT v5, properties are returned as the raw bytes of the property list.
+        """
+        header, body = self.read_packet()
+        assert header & 0xF0 == mqtt_client.PUBLISH
+        length = struct.unpack_from("!H", body)[0]
+        topic = body[2 : 2 + length]
+        position = 2 + length
+        mid = None
+        if header & 0x06:
+            mid = struct.unpack_from("!H", body, position)[0]
+            position += 2
+        properties = None
+        if version == mqtt_client.MQTTv5:
+            length = body[position]
+            properties = body[position + 1 : position + 1 + length]
+            position += 1 + length
+        return header, topic, mid, properties, body[position:]
+
+    def pending(self) -> bytes:
+        """Return whatever the client has sent that hasn't been read yet."""
+        self.sock.setblocking(False)
+        try:
+            return self.sock.recv(1 << 20)
+        except BlockingIOError:
+            return b""
+        finally:
+            self.sock.settimeout(5.0)
+
+    def send(self, data: bytes) -> None:
+        self.sock.sendall(data)
+
+    def _read(self, count: int) -> bytes:
+        data = b""
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+
+def connack(version: int = mqtt_client.MQTTv311, properties: bytes = b"") -> bytes:
+    """Return a successful CONNACK packet."""
+    if version == mqtt_client.MQTTv5:
+        return bytes([0x20, 3 + len(properties), 0, 0, len(properties)]) + properties
+    return b"\x20\x02\x00\x00"
+
+
+@pytest.fixture
+def connect() -> Iterator:
+    """Connect a client over a socket pair, returning (LimitedSocket, Peer).
+
+    The broker end reads the CONNECT, answers with the given CONNACK and the client
+    reads it, so the client is connected when this returns.
+    """
+    sockets = []
+
+    def connect(client, ack: Optional[bytes] = None):
+        ours, theirs = socket.socketpair()
+        sockets.extend((ours, theirs))
+        wrapped = LimitedSocket(ours)
+        client._create_socket_connection = lambda: wrapped
+        peer = Peer(theirs)
+        client.connect("localhost", 1883)
+        header, _ = peer.read_packet()
+        assert header == mqtt_client.CONNECT
+        peer.send(ack if ack is not None else connack(client._protocol))
+        client.loop_read()
+        assert client.is_connected()
+        return wrapped, peer
+
+    yield connect
+    for sock in sockets:
+        sock.close()
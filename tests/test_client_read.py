@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Tests for buffered reading of incoming packets."""
+
+import struct
+
+import paho.mqtt.client as mqtt_client
+
+
+def publish_packet(topic: bytes, payload: bytes) -> bytes:
+    """Return a QoS 0 PUBLISH packet as sent by a broker."""
+    body = struct.pack("!H", len(topic)) + topic + payload
+    length = bytearray()
+    remaining = len(body)
+    while True:
+        byte = remaining % 128
+        remaining //= 128
+        length.append(byte | 0x80 if remaining else byte)
+        if not remaining:
+            return bytes([mqtt_client.PUBLISH]) + length + body
+
+
+def receiving_client(connect):
+    """Return a connected client, its broker peer and the messages it receives."""
+    client = mqtt_client.Client("test")
+    received = []
+    client.on_message = lambda client, userdata, message: received.append(
+        (message.topic, message.payload)
+    )
+    _, peer = connect(client)
+    return client, peer, received
+
+
+def test_packet_split_across_reads(connect):
+    client, peer, received = receiving_client(connect)
+    packet = publish_packet(b"a/b", b"x" * 300)
+
+    for i in range(len(packet) - 1):
+        peer.send(packet[i : i + 1])
+        assert client.loop_read() == mqtt_client.MQTT_ERR_SUCCESS
+        assert received == []
+    peer.send(packet[-1:])
+    client.loop_read()
+
+    assert received == [("a/b", b"x" * 300)]
+    assert type(received[0][1]) is bytes
+
+
+def test_several_packets_in_one_read(connect):
+    client, peer, received = receiving_client(connect)
+    packets = [publish_packet(b"t", str(i).encode()) for i in range(5)]
+
+    # the last packet is incomplete, and finished by the next read
+    data = b"".join(packets)
+    peer.send(data[:-2])
+    client.loop_read()
+    assert received == [("t", str(i).encode()) for i in range(4)]
+
+    peer.send(data[-2:])
+    client.loop_read()
+    assert received[-1] == ("t", b"4")
+
+
+def test_packet_larger_than_read_buffer(connect):
+    client, peer, received = receiving_client(connect)
+    payload = bytes(range(256)) * (mqtt_client.READ_BUFFER_SIZE // 64)
+    packet = publish_packet(b"big", payload) + publish_packet(b"small", b"1")
+
+    peer.send(packet)
+    while len(received) < 2:
+        client.loop_read()
+
+    assert received == [("big", payload), ("small", b"1")]
+    assert len(client._in_buffer) == mqtt_client.READ_BUFFER_SIZE
+
+
+def test_invalid_remaining_length_closes_connection(connect):
+    client, peer, received = receiving_client(connect)
+
+    peer.send(b"\x30\xff\xff\xff\xff\x01")
+
+    assert client.loop_read() == mqtt_client.MQTT_ERR_PROTOCOL
+    assert client.socket() is None
+    assert received == []
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Tests for gathered (vectored) writes of queued packets."""
+
+import paho.mqtt.client as mqtt_client
+
+
+def test_partial_writes_resume_mid_packet(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.writes.clear()
+    sock.limit = 5
+    sock.budget = 13
+
+    infos = client.publish_many([(f"t/{i}", f"payload-{i}") for i in range(3)])
+
+    # each write picks up exactly where the previous one stopped
+    stream = sock.writes[0]
+    assert sock.writes == [stream, stream[5:], stream[10:], stream[13:]]
+    assert client.want_write()
+    assert not any(info.is_published() for info in infos)
+
+    sock.budget = None
+    client.loop_write()
+
+    assert not client.want_write()
+    assert all(info.is_published() for info in infos)
+    assert sock.writes[-1] == stream[-5:]
+    for i in range(3):
+        _, topic, _, _, payload = peer.read_publish()
+        assert (topic, payload) == (f"t/{i}".encode(), f"payload-{i}".encode())
+
+
+def test_queued_packets_are_gathered_into_one_write(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+    count = mqtt_client.MAX_GATHER_PACKETS + 6
+    infos = [client.publish("t", str(i)) for i in range(count)]
+    sock.writes.clear()
+    sock.budget = None
+
+    client.loop_write()
+
+    assert len(sock.writes) == 2
+    assert all(info.is_published() for info in infos)
+    payloads = [peer.read_publish()[4] for _ in range(count)]
+    assert payloads == [str(i).encode() for i in range(count)]
+
+
+def test_messages_are_published_as_their_packet_completes(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+    first = client.publish("t", b"first")
+    second = client.publish("t", b"second")
+
+    # the first packet is 2 + 2 + 1 + 5 bytes long
+    sock.budget = 10
+    client.loop_write()
+    assert first.is_published()
+    assert not second.is_published()
+    assert client.want_write()
+
+    sock.budget = None
+    client.loop_write()
+    assert second.is_published()
+    assert [peer.read_publish()[4] for _ in range(2)] == [b"first", b"second"]
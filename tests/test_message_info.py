@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Tests for waiting on MQTTMessageInfo, whose condition is only created on demand."""
+
+import threading
+
+import pytest
+
+import paho.mqtt.client as mqtt_client
+
+
+def test_waiters_are_woken_when_published(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+    info = client.publish("t", b"a")
+    results = []
+    waiters = [
+        threading.Thread(target=lambda: results.append(info.wait_for_publish(5.0)))
+        for _ in range(4)
+    ]
+    for waiter in waiters:
+        waiter.start()
+
+    sock.budget = None
+    client.loop_write()
+    for waiter in waiters:
+        waiter.join(5.0)
+
+    assert results == [True] * 4
+
+
+def test_wait_returns_at_once_if_already_published(connect):
+    client = mqtt_client.Client("test")
+    connect(client)
+
+    info = client.publish("t", b"a")
+
+    assert info.wait_for_publish(0)
+    assert info._condition is None
+
+
+def test_wait_times_out(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+
+    info = client.publish("t", b"a")
+
+    assert not info.wait_for_publish(0.05)
+    assert not info.is_published()
+
+
+def test_messages_that_were_not_queued_cannot_be_waited_for(connect):
+    client = mqtt_client.Client("test")
+    connect(client)
+    client.max_queued_messages_set(1)
+    client.publish("t", b"a", qos=1)
+
+    info = client.publish("t", b"b", qos=1)
+
+    assert info.rc == mqtt_client.MQTT_ERR_QUEUE_SIZE
+    with pytest.raises(ValueError):
+        info.wait_for_publish(0)
+    with pytest.raises(ValueError):
+        info.is_published()
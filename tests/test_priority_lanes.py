@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Tests for the priority lanes of the outgoing packet queue."""
+
+import pytest
+
+import paho.mqtt.client as mqtt_client
+from coalescer import Coalescer
+
+
+def payloads(peer, count):
+    """Read the payloads of the next count PUBLISH packets."""
+    return [peer.read_publish()[4] for _ in range(count)]
+
+
+def test_lanes_are_written_in_priority_then_queue_order(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+    client.publish("t", b"first")
+    lanes = [
+        mqtt_client.PRIORITY_LOW,
+        mqtt_client.PRIORITY_NORMAL,
+        mqtt_client.PRIORITY_HIGH,
+    ]
+    for i in range(3):
+        for priority in lanes:
+            client.publish("t", f"{priority}-{i}", priority=priority)
+
+    sock.budget = None
+    client.loop_write()
+
+    # the packet already being written always goes first
+    assert payloads(peer, 10) == [b"first"] + [
+        f"{priority}-{i}".encode() for priority in sorted(lanes) for i in range(3)
+    ]
+
+
+def test_partly_written_packet_is_finished_first(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+    client.publish("t", b"a", priority=mqtt_client.PRIORITY_LOW)
+    client.publish("t", b"b", priority=mqtt_client.PRIORITY_LOW)
+    # all of a, and part of b (which was gathered behind it)
+    sock.budget = 8
+    client.loop_write()
+    client.publish("t", b"urgent", priority=mqtt_client.PRIORITY_HIGH)
+
+    sock.budget = None
+    client.loop_write()
+
+    assert payloads(peer, 3) == [b"a", b"b", b"urgent"]
+    assert not client.want_write()
+
+
+def test_nothing_is_written_after_disconnect(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.budget = 0
+    client.publish("t", b"a")
+    client.publish("t", b"b", priority=mqtt_client.PRIORITY_LOW)
+    client.disconnect()
+    late = client.publish("t", b"late", priority=mqtt_client.PRIORITY_LOW)
+
+    sock.budget = None
+    client.loop_write()
+
+    assert payloads(peer, 2) == [b"a", b"b"]
+    assert peer.read_packet() == (mqtt_client.DISCONNECT, b"")
+    assert peer.pending() == b""
+    assert not late.is_published()
+
+
+def test_stalled_write_is_retried_with_the_same_data_without_sendmsg(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    # as for TLS and websocket connections
+    client._sock_sendmsg_ok = False
+    sock.budget = 0
+    client.publish("t", b"a")
+    client.publish("t", b"b")
+    stalled = sock.writes[-1]
+    client.publish("t", b"urgent", priority=mqtt_client.PRIORITY_HIGH)
+    assert sock.writes[-1] == stalled
+
+    sock.writes.clear()
+    sock.budget = None
+    client.loop_write()
+
+    assert sock.writes[0] == stalled
+    assert payloads(peer, 3) == [b"a", b"urgent", b"b"]
+
+
+def test_drained_priority_is_reported_while_lower_priority_packets_wait(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    drained = []
+
+    def on_priority_drained(client, userdata, priority):
+        drained.append(priority)
+
+    client.on_priority_drained = on_priority_drained
+    sock.budget = 0
+    for _ in range(3):
+        client.publish("t", b"low", priority=mqtt_client.PRIORITY_LOW)
+    client.publish("t", b"high", priority=mqtt_client.PRIORITY_HIGH)
+    assert drained == []
+
+    # the low packet already being written, then the high one
+    sock.budget = 8 + 9
+    client.loop_write()
+
+    assert payloads(peer, 2) == [b"low", b"high"]
+    assert drained == [mqtt_client.PRIORITY_NORMAL]
+    sock.budget = None
+    client.loop_write()
+    assert drained == [mqtt_client.PRIORITY_NORMAL, mqtt_client.PRIORITY_LOW]
+
+
+def test_coalescer_is_flushed_ahead_of_a_lower_priority_backlog(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    coalescer = Coalescer(client, mqtt_client.PRIORITY_HIGH)
+    client.on_priority_drained = lambda client, userdata, priority: coalescer.flush()
+    sock.budget = 0
+    for _ in range(3):
+        client.publish("t", b"low", priority=mqtt_client.PRIORITY_LOW)
+    client.publish("t", b"high", priority=mqtt_client.PRIORITY_HIGH)
+    coalescer.put([(b"c", b"1", 0, False)])
+    coalescer.put([(b"c", b"2", 0, False)])
+
+    sock.budget = 8 + 9
+    client.loop_write()
+    sock.budget = None
+    client.loop_write()
+
+    # the next low packet was already current when the high lane drained
+    assert payloads(peer, 5) == [b"low", b"high", b"low", b"2", b"low"]
+    assert not client.want_write()
+
+
+def test_invalid_priority_is_rejected(connect):
+    client = mqtt_client.Client("test")
+    connect(client)
+
+    with pytest.raises(ValueError):
+        client.publish("t", b"a", priority=mqtt_client.PRIORITY_LANES)
+    with pytest.raises(ValueError):
+        client.publish_many([("t", b"a")], priority=-1)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Tests for PUBLISH packet encoding, including MQTT v5 topic aliases."""
+
+import struct
+
+import pytest
+
+import paho.mqtt.client as mqtt_client
+from conftest import connack
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+MQTTv5 = mqtt_client.MQTTv5
+
+
+@pytest.mark.parametrize(
+    "qos, retain, payload, expected",
+    [
+        (0, False, b"", b"\x30\x03\x00\x01t"),
+        (0, True, b"x", b"\x31\x04\x00\x01tx"),
+        (1, False, b"x", b"\x32\x06\x00\x01t\x00\x01x"),
+        (2, True, b"x", b"\x35\x06\x00\x01t\x00\x01x"),
+        (0, False, b"x" * 200, b"\x30\xcb\x01\x00\x01t" + b"x" * 200),
+        (0, False, b"x" * 20000, b"\x30\xa3\x9c\x01\x00\x01t" + b"x" * 20000),
+    ],
+)
+def test_publish_packets(connect, qos, retain, payload, expected):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.writes.clear()
+
+    client.publish("t", payload, qos=qos, retain=retain)
+
+    assert sock.writes == [expected]
+
+
+def test_payload_types(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+
+    for payload in ("é", bytearray(b"a"), 5, 1.5, None):
+        client.publish("t", payload)
+
+    assert [peer.read_publish()[4] for _ in range(5)] == [
+        "é".encode(),
+        b"a",
+        b"5",
+        b"1.5",
+        b"",
+    ]
+
+
+def alias_client(connect, limit, broker_maximum):
+    """Return an MQTT v5 client with topic aliases, connected to a broker stand-in."""
+    client = mqtt_client.Client("test", protocol=MQTTv5)
+    client.topic_alias_maximum_set(limit)
+    properties = b""
+    if broker_maximum:
+        properties = struct.pack("!BH", 0x22, broker_maximum)
+    sock, peer = connect(client, connack(MQTTv5, properties))
+    return client, peer
+
+
+def published(client, peer, topics, priority=mqtt_client.PRIORITY_NORMAL):
+    """Publish to each topic in turn, returning the (topic, properties) sent."""
+    sent = []
+    for topic in topics:
+        client.publish(topic, b"x", priority=priority)
+        _, topic, _, properties, _ = peer.read_publish(MQTTv5)
+        sent.append((topic, properties))
+    return sent
+
+
+def alias(number):
+    return struct.pack("!BH", 0x23, number)
+
+
+def test_no_aliases_without_broker_maximum(connect):
+    client, peer = alias_client(connect, 10, 0)
+
+    assert published(client, peer, ["a", "a"]) == [(b"a", b""), (b"a", b"")]
+
+
+def test_no_aliases_without_client_limit(connect):
+    client, peer = alias_client(connect, 0, 10)
+
+    assert published(client, peer, ["a", "a"]) == [(b"a", b""), (b"a", b"")]
+
+
+def test_aliases_are_assigned_and_reused(connect):
+    client, peer = alias_client(connect, 10, 2)
+
+    assert published(client, peer, ["a", "b", "a", "c", "b", "b"]) == [
+        (b"a", alias(1)),
+        (b"b", alias(2)),
+        (b"", alias(1)),
+        # the least recently used alias (b's) is reassigned
+        (b"c", alias(2)),
+        (b"b", alias(1)),
+        (b"", alias(1)),
+    ]
+
+
+def test_client_limit_caps_broker_maximum(connect):
+    client, peer = alias_client(connect, 1, 5)
+
+    assert published(client, peer, ["a", "b", "b"]) == [
+        (b"a", alias(1)),
+        (b"b", alias(1)),
+        (b"", alias(1)),
+    ]
+
+
+def test_aliases_belong_to_one_priority(connect):
+    client, peer = alias_client(connect, 10, 1)
+    published(client, peer, ["a"])
+
+    # a single alias can't be shared out, so it is used by the normal lane and the
+    # high lane has none to reuse
+    assert published(client, peer, ["a", "b"], mqtt_client.PRIORITY_HIGH) == [
+        (b"a", b""),
+        (b"b", b""),
+    ]
+    assert published(client, peer, ["a"]) == [(b"", alias(1))]
+
+
+def test_each_priority_has_a_share_of_the_aliases(connect):
+    # two aliases reserved for each of the high, normal and low priorities
+    client, peer = alias_client(connect, 10, 6)
+    low = published(client, peer, ["a", "b", "c"], mqtt_client.PRIORITY_LOW)
+
+    # the low burst only gets its own share, leaving the high lane's alone
+    assert low == [(b"a", alias(1)), (b"b", alias(2)), (b"c", alias(1))]
+    assert published(client, peer, ["x", "y", "x"], mqtt_client.PRIORITY_HIGH) == [
+        (b"x", alias(3)),
+        (b"y", alias(4)),
+        (b"", alias(3)),
+    ]
+
+
+def test_shared_aliases_go_to_the_first_priority_to_ask(connect):
+    # one alias reserved for each priority, and one shared
+    client, peer = alias_client(connect, 10, 4)
+    published(client, peer, ["a", "b"], mqtt_client.PRIORITY_LOW)
+
+    assert published(client, peer, ["x", "y", "x"], mqtt_client.PRIORITY_HIGH) == [
+        (b"x", alias(3)),
+        (b"y", alias(3)),
+        (b"x", alias(3)),
+    ]
+
+
+def test_aliases_are_forgotten_on_reconnect(connect):
+    client, peer = alias_client(connect, 10, 2)
+    published(client, peer, ["a", "b"])
+
+    _, peer = connect(client, connack(MQTTv5, struct.pack("!BH", 0x22, 2)))
+
+    assert published(client, peer, ["b", "b"]) == [(b"b", alias(1)), (b"", alias(1))]
+
+
+def test_explicit_alias_is_left_alone(connect):
+    client, peer = alias_client(connect, 10, 2)
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.TopicAlias = 2
+
+    client.publish("a", b"x", properties=properties)
+
+    _, topic, _, properties, _ = peer.read_publish(MQTTv5)
+    assert (topic, properties) == (b"a", alias(2))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Tests for Client.publish_many()."""
+
+import struct
+
+import pytest
+
+import paho.mqtt.client as mqtt_client
+
+
+def test_batch_is_written_with_one_call(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+    sock.writes.clear()
+
+    infos = client.publish_many(
+        [("a", b"1"), {"topic": "b", "payload": b"2"}, ("c", b"3", 0, True)]
+    )
+
+    assert len(sock.writes) == 1
+    assert [info.rc for info in infos] == [mqtt_client.MQTT_ERR_SUCCESS] * 3
+    assert all(info.is_published() for info in infos)
+    received = [peer.read_publish() for _ in range(3)]
+    assert [(topic, payload) for _, topic, _, _, payload in received] == [
+        (b"a", b"1"),
+        (b"b", b"2"),
+        (b"c", b"3"),
+    ]
+    assert received[2][0] & 0x01  # retain
+
+
+def test_qos1_messages_are_published_when_acknowledged(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+
+    infos = client.publish_many([("a", b"1", 1), ("b", b"2", 0), ("c", b"3", 1)])
+
+    received = [peer.read_publish() for _ in range(3)]
+    assert [header & 0x06 for header, *_ in received] == [0x02, 0x00, 0x02]
+    assert [info.is_published() for info in infos] == [False, True, False]
+    for header, _, mid, _, _ in received:
+        if header & 0x06:
+            peer.send(struct.pack("!BBH", mqtt_client.PUBACK, 2, mid))
+    client.loop_read()
+    assert all(info.is_published() for info in infos)
+
+
+def test_invalid_message_sends_nothing(connect):
+    client = mqtt_client.Client("test")
+    sock, peer = connect(client)
+
+    with pytest.raises(ValueError):
+        client.publish_many([("a", b"1"), ("b/#", b"2")])
+
+    assert peer.pending() == b""
+    assert not client.want_write()
+
+
+def test_messages_are_not_sent_while_disconnected():
+    client = mqtt_client.Client("test")
+
+    infos = client.publish_many([("a", b"1", 0), ("b", b"2", 1)])
+
+    assert [info.rc for info in infos] == [mqtt_client.MQTT_ERR_NO_CONN] * 2
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Tests for the retry scheduling of QoS 1 and 2 messages."""
+
+import struct
+
+import pytest
+
+import paho.mqtt.client as mqtt_client
+
+RETRY = 10
+
+
+class Clock:
+    """Stand-in for the client's time function that only moves when told to."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mqtt_client, "time_func", clock)
+    return clock
+
+
+@pytest.fixture
+def client(clock):
+    client = mqtt_client.Client("test")
+    client.message_retry_set(RETRY)
+    return client
+
+
+def advance(client, clock, seconds):
+    """Move the clock forward and let the client check for messages to retry."""
+    clock.now += seconds
+    client.loop_misc()
+
+
+def ack(command, mid):
+    return struct.pack("!BBH", command, 2, mid)
+
+
+def test_qos1_is_retried_after_the_timeout(client, clock, connect):
+    sock, peer = connect(client)
+    info = client.publish("t", b"a", qos=1)
+    header, _, mid, _, _ = peer.read_publish()
+    assert not header & 0x08
+
+    advance(client, clock, RETRY / 2)
+    assert peer.pending() == b""
+
+    advance(client, clock, RETRY / 2 + 1)
+    header, topic, retried, _, payload = peer.read_publish()
+    assert header & 0x08  # DUP
+    assert (topic, retried, payload) == (b"t", mid, b"a")
+
+    # rescheduled from the time of the retry
+    advance(client, clock, RETRY / 2)
+    assert peer.pending() == b""
+    advance(client, clock, RETRY / 2 + 1)
+    assert peer.read_publish()[2] == mid
+
+    peer.send(ack(mqtt_client.PUBACK, mid))
+    client.loop_read()
+    assert info.is_published()
+    advance(client, clock, RETRY * 2)
+    assert peer.pending() == b""
+
+
+def test_only_unacknowledged_messages_are_retried_in_order(client, clock, connect):
+    sock, peer = connect(client)
+    mids = []
+    for payload in (b"a", b"b", b"c"):  # at 1000, 1001 and 1002
+        client.publish("t", payload, qos=1)
+        mids.append(peer.read_publish()[2])
+        clock.now += 1
+    peer.send(ack(mqtt_client.PUBACK, mids[1]))
+    client.loop_read()
+
+    # only a is due at 1011.5
+    advance(client, clock, RETRY - 1.5)
+    assert peer.read_publish()[4] == b"a"
+    assert peer.pending() == b""
+
+    advance(client, clock, 2)
+    assert peer.read_publish()[4] == b"c"
+    assert peer.pending() == b""
+
+
+def test_qos2_release_is_retried(client, clock, connect):
+    sock, peer = connect(client)
+    info = client.publish("t", b"a", qos=2)
+    mid = peer.read_publish()[2]
+
+    advance(client, clock, RETRY + 1)
+    assert peer.read_publish()[2] == mid
+
+    # once the broker has the message, PUBREL is retried instead of PUBLISH
+    peer.send(ack(mqtt_client.PUBREC, mid))
+    client.loop_read()
+    assert peer.read_packet() == (mqtt_client.PUBREL | 0x02, struct.pack("!H", mid))
+    advance(client, clock, RETRY + 1)
+    assert peer.read_packet() == (mqtt_client.PUBREL | 0x02, struct.pack("!H", mid))
+
+    peer.send(ack(mqtt_client.PUBCOMP, mid))
+    client.loop_read()
+    assert info.is_published()
+    advance(client, clock, RETRY * 2)
+    assert peer.pending() == b""
+
+
+def test_incoming_qos2_receipt_is_retried(client, clock, connect):
+    sock, peer = connect(client)
+    received = []
+    client.on_message = lambda client, userdata, message: received.append(message)
+    peer.send(bytes([mqtt_client.PUBLISH | 0x04, 6]) + b"\x00\x01t\x00\x07a")
+    client.loop_read()
+    assert peer.read_packet() == (mqtt_client.PUBREC, b"\x00\x07")
+
+    advance(client, clock, RETRY + 1)
+    assert peer.read_packet() == (mqtt_client.PUBREC, b"\x00\x07")
+
+    peer.send(ack(mqtt_client.PUBREL | 0x02, 7))
+    client.loop_read()
+    assert peer.read_packet() == (mqtt_client.PUBCOMP, b"\x00\x07")
+    assert len(received) == 1
+    advance(client, clock, RETRY * 2)
+    assert peer.pending() == b""
+
+
+def test_messages_over_the_inflight_limit_wait_in_order(client, clock, connect):
+    sock, peer = connect(client)
+    client.max_inflight_messages_set(1)
+    for payload in (b"a", b"b", b"c"):
+        client.publish("t", payload, qos=1)
+
+    for payload in (b"a", b"b", b"c"):
+        _, _, mid, _, received = peer.read_publish()
+        assert received == payload
+        assert peer.pending() == b""
+        peer.send(ack(mqtt_client.PUBACK, mid))
+        client.loop_read()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Tests for persisting the MQTT session with SessionStore."""
+
+import logging
+import struct
+
+import pytest
+
+import paho.mqtt.client as mqtt_client
+from session import SessionStore
+
+logger = logging.getLogger("test")
+
+
+def start(connect, path):
+    """Start a persistent client with a store at path, as after launching EDMC."""
+    store = SessionStore(path, logger)
+    store.open()
+    client = mqtt_client.Client("test", clean_session=False)
+    client.session_store_set(store)
+    sock, peer = connect(client)
+    return client, store, peer
+
+
+def ack(command, mid):
+    return struct.pack("!BBH", command, 2, mid)
+
+
+def test_inflight_messages_survive_a_restart(connect, tmp_path):
+    path = tmp_path / "session.bin"
+    client, store, peer = start(connect, path)
+    client.publish("t/1", b"a", qos=1)
+    client.publish("t/2", b"b", qos=2)
+    mid_a = peer.read_publish()[2]
+    mid_b = peer.read_publish()[2]
+    peer.send(ack(mqtt_client.PUBREC, mid_b))
+    client.loop_read()
+    assert peer.read_packet() == (mqtt_client.PUBREL | 0x02, struct.pack("!H", mid_b))
+
+    # the process dies without closing anything
+    client, store, peer = start(connect, path)
+
+    header, topic, mid, _, payload = peer.read_publish()
+    assert header & 0x08  # DUP
+    assert (topic, mid, payload) == (b"t/1", mid_a, b"a")
+    # the broker already has b, so it is only released again
+    assert peer.read_packet() == (mqtt_client.PUBREL | 0x02, struct.pack("!H", mid_b))
+    # new messages don't reuse the mids of restored ones
+    client.publish("t/3", b"c", qos=1)
+    assert peer.read_publish()[2] not in (mid_a, mid_b)
+
+    peer.send(ack(mqtt_client.PUBACK, mid_a) + ack(mqtt_client.PUBCOMP, mid_b))
+    client.loop_read()
+    store.close()
+
+    store = SessionStore(path, logger)
+    store.open()
+    assert [message[:2] for message in store.restore()] == [
+        (mqtt_client.SESSION_OUTGOING, mid_b + 1)
+    ]
+
+
+def test_incoming_release_survives_a_restart(connect, tmp_path):
+    path = tmp_path / "session.bin"
+    client, store, peer = start(connect, path)
+    received = []
+    client.on_message = lambda client, userdata, message: received.append(message)
+    peer.send(bytes([mqtt_client.PUBLISH | 0x04, 6]) + b"\x00\x01t\x00\x07a")
+    client.loop_read()
+    assert peer.read_packet() == (mqtt_client.PUBREC, b"\x00\x07")
+    # the message is only delivered once the broker releases it
+    assert received == []
+
+    client, store, peer = start(connect, path)
+    client.on_message = lambda client, userdata, message: received.append(message)
+    peer.send(ack(mqtt_client.PUBREL | 0x02, 7))
+    client.loop_read()
+
+    assert peer.read_packet() == (mqtt_client.PUBCOMP, b"\x00\x07")
+    assert [(message.topic, message.payload) for message in received] == [("t", b"a")]
+    store.close()
+    store.open()
+    assert store.restore() == []
+
+
+def test_incomplete_commit_is_discarded(tmp_path):
+    path = tmp_path / "session.bin"
+    store = SessionStore(path, logger)
+    store.open()
+    store.put(mqtt_client.SESSION_OUTGOING, 1, b"t", b"a", 1, False, 0)
+    store.commit()
+    store.put(mqtt_client.SESSION_OUTGOING, 2, b"t", b"b", 1, False, 0)
+    store.commit()
+    data = path.read_bytes()
+    path.write_bytes(data[:-3])
+
+    store = SessionStore(path, logger)
+    store.open()
+
+    assert store.restore() == [
+        (mqtt_client.SESSION_OUTGOING, 1, b"t", b"a", 1, False, 0)
+    ]
+
+
+def test_store_keeps_saving_if_compaction_fails(tmp_path, monkeypatch, caplog):
+    path = tmp_path / "session.bin"
+    store = SessionStore(path, logger)
+    store.open()
+    monkeypatch.setattr(SessionStore, "COMPACT_SIZE", 10)
+
+    def fail():
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "_compact", fail)
+    store.put(mqtt_client.SESSION_OUTGOING, 1, b"t", b"a", 1, False, 0)
+    store.commit()
+    assert "Unable to compact MQTT session" in caplog.text
+
+    store.put(mqtt_client.SESSION_OUTGOING, 2, b"t", b"b", 1, False, 0)
+    store.commit()
+    monkeypatch.undo()
+
+    store = SessionStore(path, logger)
+    store.open()
+    assert sorted(message[1] for message in store.restore()) == [1, 2]
+
+
+@pytest.mark.parametrize("puts", [1, 3])
+def test_changes_are_only_written_on_commit(tmp_path, puts):
+    path = tmp_path / "session.bin"
+    store = SessionStore(path, logger)
+    store.open()
+    size = path.stat().st_size
+
+    for mid in range(puts):
+        store.put(mqtt_client.SESSION_OUTGOING, mid, b"t", b"a", 1, False, 0)
+    assert path.stat().st_size == size
+    store.remove(mqtt_client.SESSION_OUTGOING, 0)
+    store.commit()
+
+    assert path.stat().st_size > size
+    store = SessionStore(path, logger)
+    store.open()
+    assert len(store.restore()) == puts - 1
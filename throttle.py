@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Code related to per-topic rate limiting for the EDMC-Telemetry plugin."""
+
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from paho.mqtt.client import topic_matches_sub
+from serializer import Message, Payload
+
+
+def _number(payload: Payload) -> Optional[float]:
+    """Return the numeric value of the payload, or None if it isn't a number."""
+    try:
+        return float(payload)
+    except ValueError:
+        return None
+
+
+class Throttle:
+    """Limits how often messages are published to specific topics.
+
+    Rules map MQTT topic filters (which may contain + and # wildcards) to an
+    "interval", the minimum number of seconds between messages to a matching topic,
+    and/or a "deadband" for numeric payloads.  A message that arrives before the
+    interval is over is held back, replacing any message already held for the topic,
+    and is released once the interval is over, so the latest value is always
+    delivered.  A numeric payload that differs from the last one sent by less than
+    the deadband is dropped.
+    """
+
+    def __init__(
+        self, rules: Dict[str, Dict[str, Any]], logger: logging.Logger
+    ) -> None:
+        """Create a throttle for the specified rules."""
+        self._rules: List[Tuple[str, float, float]] = []
+        for topic_filter, rule in rules.items():
+            try:
+                interval = float(rule.get("interval", 0.0))
+                deadband = float(rule.get("deadband", 0.0))
+            except (AttributeError, TypeError, ValueError):
+                logger.warning(f"Ignoring invalid throttle for '{topic_filter}'.")
+                continue
+            self._rules.append((topic_filter, interval, deadband))
+        # (interval, deadband) of the first matching rule by topic, or None
+        self._matches: Dict[bytes, Optional[Tuple[float, float]]] = {}
+        # (time, numeric value) of the last message sent by topic
+        self._sent: Dict[bytes, Tuple[float, Optional[float]]] = {}
+        self._held: Dict[bytes, Message] = {}
+
+    @property
+    def active(self) -> bool:
+        """True if there are any rules."""
+        return len(self._rules) > 0
+
+    @property
+    def next_release(self) -> Optional[float]:
+        """Time at which the next held back message is due, or None."""
+        if not len(self._held):
+            return None
+        return min(self._sent[topic][0] + self._match(topic)[0] for topic in self._held)
+
+    def filter(self, messages: List[Message], now: float) -> List[Message]:
+        """Return the messages that can be sent now, holding back the others."""
+        allowed = []
+        for message in messages:
+            topic = message[0]
+            rule = self._match(topic)
+            if rule is None:
+                allowed.append(message)
+                continue
+            interval, deadband = rule
+            value = _number(message[1]) if deadband > 0 else None
+            sent = self._sent.get(topic)
+            if sent is not None:
+                if (
+                    value is not None
+                    and sent[1] is not None
+                    and abs(value - sent[1]) < deadband
+                ):
+                    # the last value sent is still close enough
+                    self._held.pop(topic, None)
+                    continue
+                if now - sent[0] < interval:
+                    self._held[topic] = message
+                    continue
+            self._held.pop(topic, None)
+            self._sent[topic] = (now, value)
+            allowed.append(message)
+        return allowed
+
+    def release(self, now: float) -> List[Message]:
+        """Return the held back messages that are due, in the order they were held."""
+        due = [
+            message
+            for topic, message in self._held.items()
+            if now - self._sent[topic][0] >= self._match(topic)[0]
+        ]
+        for topic, payload, _, _ in due:
+            del self._held[topic]
+            deadband = self._match(topic)[1]
+            self._sent[topic] = (now, _number(payload) if deadband > 0 else None)
+        return due
+
+    def clear(self) -> None:
+        """Discard held back messages and forget what was sent."""
+        self._sent.clear()
+        self._held.clear()
+
+    def _match(self, topic: bytes) -> Optional[Tuple[float, float]]:
+        """Return the (interval, deadband) of the first rule matching the topic."""
+        try:
+            return self._matches[topic]
+        except KeyError:
+            decoded = topic.decode("utf-8")
+            match = next(
+                (
+                    (interval, deadband)
+                    for topic_filter, interval, deadband in self._rules
+                    if topic_matches_sub(topic_filter, decoded)
+                ),
+                None,
+            )
+            self._matches[topic] = match
+            return match
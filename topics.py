@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Code related to MQTT topic resolution for the EDMC-Telemetry plugin."""
+
+from typing import Dict, Iterable, Tuple
+
+from settings import Settings
+
+
+class Topics:
+    """Resolves and caches fully-qualified, UTF-8 encoded MQTT topics."""
+
+    def __init__(self, settings: Settings) -> None:
+        """Initialize an empty topic cache backed by the specified settings."""
+        self._settings = settings
+        self._cache: Dict[Tuple[str, ...], bytes] = {}
+
+    def resolve(self, *keys: str) -> bytes:
+        """Return the encoded topic for the specified sequence of topic keys.
+
+        Each key is mapped through Settings.topic() and the results are joined below
+        the root topic, so resolve("dashboard", "Fuel", "FuelMain") would normally
+        produce b"Telemetry/Dashboard/Fuel/Main".  Topics are built on first use and
+        served from the cache until invalidate() is called.
+        """
+        try:
+            return self._cache[keys]
+        except KeyError:
+            topic = "/".join(
+                [self._settings.topic("root")]
+                + [self._settings.topic(key) for key in keys]
+            )
+            if self._settings.lowercase_topics:
+                topic = topic.lower()
+            encoded = self._cache[keys] = topic.encode("utf-8")
+            return encoded
+
+    def precompile(self, topics: Iterable[Tuple[str, ...]]) -> None:
+        """Build and cache all of the specified topics ahead of time."""
+        for keys in topics:
+            self.resolve(*keys)
+
+    def invalidate(self) -> None:
+        """Discard all cached topics (i.e. after topic settings have changed)."""
+        self._cache.clear()